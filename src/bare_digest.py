@@ -0,0 +1,193 @@
+"""BareMail message coalescing
+
+During an incident a daemon may send the same alert thousands of times.
+The digest stage sits between the end of SMTP DATA and the mailbox.  The
+first message of a kind is stored at once, so alerts are never delayed.
+Repeats of it that arrive within the window are only counted.  When the
+window closes, a single digest message is stored.  It gives the number of
+repeats, the times of the first and last, and the text of the last.
+
+Messages are of a kind when they have the same mailbox, sender and Subject
+and the same body once digits and white space are ignored, so counters and
+time stamps in an alert body do not split the group.
+
+Only the last repeat of each group is held in memory and the number of open
+groups is limited, the oldest group being flushed early when the limit is
+reached.  Repeats counted but not yet flushed are lost if the server stops.
+"""
+
+import bare_io
+import bare_sched
+import collections
+import email.utils
+import hashlib
+import logging
+import re
+import time
+
+# create logger
+log = logging.getLogger('baremail.digest')
+
+CRLF = '\r\n'
+
+COUNT_HEADER = 'X-BareMail-Digest-Count'
+FIRST_HEADER = 'X-BareMail-Digest-First'
+LAST_HEADER = 'X-BareMail-Digest-Last'
+
+DIGITS = re.compile(r'\d+')
+SPACE = re.compile(r'\s+')
+
+# The digest stage in use, if any.  Set by configure().
+digest = None
+
+def configure(cfgdict):
+    """Start the digest stage described by the "digest" configuration."""
+    global digest
+    digest = BareDigest(cfgdict)
+    return digest
+
+def deliver(mbx, sender, msg_str, callback):
+    """Store msg_str in mbx, or count it if it repeats a recent message.
+
+    callback(msg_id, error) is called with the id the SMTP server reports
+    for the message once it is safely stored or counted.
+    """
+    if digest is None:
+        bare_io.add(mbx, msg_str, callback)
+    else:
+        digest.deliver(mbx, sender, msg_str, callback)
+
+def _normalize(text):
+    return SPACE.sub(' ', DIGITS.sub('#', text)).strip().lower()
+
+def _split(msg_str):
+    """Return (subject, body) of msg_str."""
+    pos = msg_str.find(CRLF + CRLF)
+    if pos < 0:
+        header, body = msg_str, ''
+    else:
+        header, body = msg_str[:pos], msg_str[pos + 4:]
+    subject = ''
+    in_subject = False
+    for line in header.split(CRLF):
+        if in_subject and line[:1] in (' ', '\t'):
+            subject += line
+            continue
+        in_subject = False
+        if line[:8].lower() == 'subject:':
+            subject = line[8:]
+            in_subject = True
+    return subject.strip(), body
+
+class _group():
+    """Repeats of one message seen during a window."""
+    def __init__(self, key, mbx, subject, now):
+        self.key = key
+        self.mbx = mbx
+        self.subject = subject
+        self.first = now
+        self.last = now
+        self.count = 0
+        self.msg_str = None
+        self.timer = None
+
+    def stored(self, key, error):
+        """Log the outcome of storing the digest of this group."""
+        if error is not None:
+            log.error('Error storing digest of {} messages: {}'.format(
+                self.count, error))
+        else:
+            log.info('Stored digest of {} repeats of "{}"'.format(
+                self.count, self.subject))
+
+class BareDigest():
+    """Collapse repeated messages into digests."""
+
+    def __init__(self, cfgdict):
+        """cfgdict holds window, the seconds repeats are collected for,
+        and max_groups, the most groups open at a time.
+        """
+        self.window = float(cfgdict.get('window', 60))
+        self.max_groups = int(cfgdict.get('max_groups', 1000))
+        self._groups = collections.OrderedDict()
+        # metrics
+        self.received = 0
+        self.stored = 0
+        self.digests = 0
+        self.coalesced = 0
+        log.info('Coalescing repeats within {}s, at most {} groups'.format(
+            self.window, self.max_groups))
+
+    def key(self, mbx, sender, msg_str):
+        subject, body = _split(msg_str)
+        body_hash = hashlib.sha1(_normalize(body)).hexdigest()
+        return (mbx._key, sender.lower(), subject, body_hash), subject
+
+    def deliver(self, mbx, sender, msg_str, callback):
+        self.received += 1
+        now = time.time()
+        key, subject = self.key(mbx, sender, msg_str)
+        group = self._groups.get(key)
+        if group is not None:
+            group.count += 1
+            group.last = now
+            group.msg_str = msg_str
+            self.coalesced += 1
+            callback('digest {}'.format(group.count), None)
+            return
+
+        # the group opens at once so repeats arriving while the first
+        # message is written are counted
+        if len(self._groups) >= self.max_groups:
+            oldest = self._groups.keys()[0]
+            self.flush(oldest)
+        group = _group(key, mbx, subject, now)
+        group.timer = bare_sched.call_later(self.window, self.flush, key)
+        self._groups[key] = group
+        self.stored += 1
+        bare_io.add(mbx, msg_str, callback)
+
+    def flush(self, key):
+        """Close the group for key, storing a digest if it had repeats."""
+        group = self._groups.pop(key, None)
+        if group is None:
+            return
+        group.timer.cancel()
+        if not group.count:
+            return
+        self.stored += 1
+        self.digests += 1
+        bare_io.add(group.mbx, self.digest_message(group), group.stored)
+
+    def digest_message(self, group):
+        """Return the digest for group: the last repeat, with its Subject
+        marked and headers giving the count and first and last times.
+        """
+        first = email.utils.formatdate(group.first, localtime=True)
+        last = email.utils.formatdate(group.last, localtime=True)
+        lines = ['{}: {}'.format(COUNT_HEADER, group.count),
+                 '{}: {}'.format(FIRST_HEADER, first),
+                 '{}: {}'.format(LAST_HEADER, last)]
+        prefix = '[{} repeats] '.format(group.count)
+        in_header = True
+        for line in group.msg_str.split(CRLF):
+            if not line:
+                in_header = False
+            if in_header and line[:8].lower() == 'subject:':
+                line = 'Subject: ' + prefix + line[8:].lstrip()
+                prefix = None
+            lines.append(line)
+        if prefix is not None:
+            lines.insert(3, 'Subject: ' + prefix.rstrip())
+        return CRLF.join(lines)
+
+    def stats(self):
+        """Return the digest metrics as a dictionary."""
+        return dict(groups=len(self._groups), received=self.received,
+                    stored=self.stored, digests=self.digests,
+                    coalesced=self.coalesced)
+
+    def close(self):
+        """Flush every open group."""
+        for key in self._groups.keys():
+            self.flush(key)
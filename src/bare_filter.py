@@ -0,0 +1,330 @@
+"""BareMail delivery filters
+
+A message accepted by the SMTP server passes through the filters named in
+the "filters" list of the configuration before it is stored.  Each filter
+either lets the message pass or asks for an action:
+
+drop
+    the message is accepted and thrown away
+tag
+    a header line is added to the message and the next filter runs
+reroute
+    the message is stored in another maildir instead
+
+A filter matches a header with a regular expression, matches the body with
+a regular expression or calls a Python function given by its dotted path::
+
+    "filters": [
+        {"name": "noise", "header": "Subject", "match": "^\\\\[noise\\\\]",
+         "action": "drop"},
+        {"name": "errors", "body": "Traceback|ERROR", "action": "tag",
+         "tag": "X-BareMail-Tag: error", "heavy": true},
+        {"name": "backups", "header": "From", "match": "backup@",
+         "action": "reroute", "maildir": "BackupMail"},
+        {"name": "custom", "callable": "site_filters.classify"}
+    ]
+
+A callable is given the message text and returns None to let it pass or an
+(action, argument) pair, the argument being the header line for 'tag' and
+the maildir for 'reroute'.
+
+Filters run in the server loop unless marked "heavy".  Heavy filters run in
+a pool of worker processes so a slow expression or parser never holds up
+the other sessions.  The results come back to the loop through
+bare_sched.call_soon_threadsafe().  The pool is started as the server loop
+starts, after root privileges have been given up and before any client has
+connected, so the workers do not hold client sockets open.
+"""
+
+import bare_maildir
+import bare_sched
+import logging
+import multiprocessing
+import re
+import time
+
+# create logger
+log = logging.getLogger('baremail.filter')
+
+CRLF = '\r\n'
+
+ACTIONS = ('drop', 'tag', 'reroute')
+
+# The pipeline in use, if any.  Set by configure().
+pipeline = None
+
+def configure(cfglist, cfgdict=None):
+    """Build the pipeline from the "filters" list.  cfgdict holds the
+    "filter_pool" options: processes and timeout.
+    """
+    global pipeline
+    pipeline = BareFilters(cfglist, cfgdict or {})
+    return pipeline
+
+def run(msg_str, callback):
+    """Filter msg_str and call callback(msg_str, action) with the message,
+    tagged if a filter asked for it, and the final action or None.  The
+    callback may run before run() returns.
+    """
+    if pipeline is None:
+        callback(msg_str, None)
+    else:
+        pipeline.run(msg_str, callback)
+
+def _header_values(msg_str, name):
+    """Return the values of the header called name in msg_str."""
+    pos = msg_str.find(CRLF + CRLF)
+    if pos >= 0:
+        msg_str = msg_str[:pos]
+    name = name.lower() + ':'
+    values = []
+    current = None
+    for line in msg_str.split(CRLF):
+        if current is not None and line[:1] in (' ', '\t'):
+            values[current] += line
+            continue
+        current = None
+        if line[:len(name)].lower() == name:
+            values.append(line[len(name):].strip())
+            current = len(values) - 1
+    return values
+
+def _body(msg_str):
+    pos = msg_str.find(CRLF + CRLF)
+    if pos < 0:
+        return ''
+    return msg_str[pos + 4:]
+
+def _import(path):
+    """Return the object named by the dotted path."""
+    module_name, attr = path.rsplit('.', 1)
+    module = __import__(module_name, fromlist=[attr])
+    return getattr(module, attr)
+
+def build(spec):
+    """Return a function of the message text for one filter entry."""
+    if spec.has_key('callable'):
+        return _import(spec['callable'])
+    action = spec['action']
+    if action not in ACTIONS:
+        raise ValueError('Unknown filter action {}'.format(action))
+    if action == 'tag':
+        arg = spec.get('tag', 'X-BareMail-Filter: {}'.format(spec['name']))
+    elif action == 'reroute':
+        arg = spec['maildir']
+    else:
+        arg = None
+    if spec.has_key('header'):
+        header = spec['header']
+        pattern = re.compile(spec['match'], re.IGNORECASE)
+        def header_filter(msg_str):
+            for value in _header_values(msg_str, header):
+                if pattern.search(value):
+                    return (action, arg)
+            return None
+        return header_filter
+    if spec.has_key('body'):
+        pattern = re.compile(spec['body'], re.MULTILINE)
+        def body_filter(msg_str):
+            if pattern.search(_body(msg_str)):
+                return (action, arg)
+            return None
+        return body_filter
+    raise ValueError('Filter {} has no header, body or callable'.format(
+        spec['name']))
+
+# Filters already built in a worker process, by name.
+_built = {}
+
+def _work(spec, msg_str):
+    """Run one heavy filter in a worker process.
+
+    Returns (result, elapsed, error) since a failure raised here would never
+    reach the server.
+    """
+    start = time.time()
+    try:
+        func = _built.get(spec['name'])
+        if func is None:
+            func = build(spec)
+            _built[spec['name']] = func
+        return (func(msg_str), time.time() - start, None)
+    except Exception as e:
+        return (None, time.time() - start, repr(e))
+
+class _filter():
+    """A configured filter and its timings."""
+    def __init__(self, spec):
+        self.spec = spec
+        self.name = spec['name']
+        self.heavy = spec.get('heavy', False)
+        self.func = build(spec)
+        self.calls = 0
+        self.matches = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        # time in the worker, which excludes the trip through the pool
+        self.work = 0.0
+        # results that came back after the filter timed out
+        self.late = 0
+
+    def timed(self, elapsed):
+        self.calls += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+class _run():
+    """One message on its way through the pipeline."""
+    def __init__(self, filters, msg_str, callback):
+        self.filters = filters
+        self.msg_str = msg_str
+        self.callback = callback
+        self.index = 0
+        self.start = 0.0
+        self.timer = None
+        self.done = False
+        # counts the heavy filters dispatched, so a late result is known
+        self.seq = 0
+
+class _dispatched():
+    """A heavy filter sent to the pool for one run.
+
+    The filter and the run's sequence number are bound when the work is
+    sent, so a result arriving after its filter timed out is not taken for
+    the verdict of the filter the run has moved on to.
+    """
+    def __init__(self, pipeline, r, f):
+        self.pipeline = pipeline
+        self.r = r
+        self.f = f
+        self.seq = r.seq
+
+    def post(self, res):
+        """Pool callback, run in the pool's result thread."""
+        bare_sched.call_soon_threadsafe(self.pipeline.returned, self, res)
+
+class BareFilters():
+    """The filter pipeline."""
+
+    def __init__(self, cfglist, cfgdict):
+        self.filters = []
+        for spec in cfglist:
+            self.filters.append(_filter(spec))
+        self.processes = cfgdict.get('processes')
+        self.timeout = float(cfgdict.get('timeout', 10))
+        self.pool = None
+        bare_sched.enable_wakeup()
+        for f in self.filters:
+            if f.heavy:
+                bare_sched.call_later(0, self.start)
+                break
+        log.info('{} delivery filters configured'.format(len(self.filters)))
+
+    def start(self):
+        """Start the worker processes for heavy filters."""
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+            log.info('Filter pool started')
+
+    def mailbox(self, dirname):
+        """Return the mailbox a reroute action delivers to."""
+        return bare_maildir.delivery_mailbox(dirname)
+
+    def run(self, msg_str, callback):
+        self.step(_run(self.filters, msg_str, callback))
+
+    def step(self, r):
+        """Run filters inline until one needs the pool or the run ends."""
+        while r.index < len(r.filters):
+            f = r.filters[r.index]
+            if f.heavy:
+                self.dispatch(r, f)
+                return
+            start = time.time()
+            try:
+                result = f.func(r.msg_str)
+            except Exception:
+                f.errors += 1
+                log.exception('filter {} failed'.format(f.name))
+                result = None
+            f.timed(time.time() - start)
+            if self.apply(r, f, result):
+                return
+        self.finish(r, None)
+
+    def dispatch(self, r, f):
+        self.start()
+        r.start = time.time()
+        r.done = False
+        r.seq += 1
+        r.timer = bare_sched.call_later(self.timeout, self.expired, r, f)
+        d = _dispatched(self, r, f)
+        self.pool.apply_async(_work, (f.spec, r.msg_str), callback=d.post)
+
+    def returned(self, d, res):
+        """Result of a heavy filter, back in the loop thread."""
+        r = d.r
+        f = d.f
+        if r.done or d.seq != r.seq:
+            f.late += 1
+            log.debug('late result of filter {} ignored'.format(f.name))
+            return
+        r.done = True
+        r.timer.cancel()
+        result, work, error = res
+        f.timed(time.time() - r.start)
+        f.work += work
+        if error is not None:
+            f.errors += 1
+            log.error('filter {} failed: {}'.format(f.name, error))
+        if not self.apply(r, f, result):
+            self.step(r)
+
+    def expired(self, r, f):
+        """A heavy filter took too long.  The message goes on without it."""
+        if r.done:
+            return
+        r.done = True
+        f.errors += 1
+        f.timed(time.time() - r.start)
+        log.warning('filter {} timed out'.format(f.name))
+        r.index += 1
+        self.step(r)
+
+    def apply(self, r, f, result):
+        """Act on the result of filter f.  Returns True if the run ended."""
+        r.index += 1
+        if result is None:
+            return False
+        f.matches += 1
+        action, arg = result
+        if action == 'tag':
+            r.msg_str = arg + CRLF + r.msg_str
+            return False
+        self.finish(r, (action, arg))
+        return True
+
+    def finish(self, r, action):
+        if action is not None:
+            log.debug('filter action {} {}'.format(action[0], action[1]))
+        r.callback(r.msg_str, action)
+
+    def stats(self):
+        """Return calls, matches, errors and timings for each filter."""
+        result = {}
+        for f in self.filters:
+            mean = 0.0
+            if f.calls:
+                mean = f.total / f.calls
+            result[f.name] = dict(calls=f.calls, matches=f.matches,
+                                  errors=f.errors, total=f.total,
+                                  mean=mean, max=f.max, work=f.work,
+                                  late=f.late, heavy=f.heavy)
+        return result
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
@@ -0,0 +1,429 @@
+"""BareMail header index
+
+Keeps the Date, From, Subject and Message-ID headers of every message in a
+maildir, plus any extra headers named in the configuration, in an sqlite3
+database.  Headers are read once, when the message is delivered, so queries
+never open message files.  They are read on the disk I/O threads and only
+the database is written from the loop.  Paths are kept relative to the
+maildir and refreshed at startup, so the index survives a reshard.
+
+From and Subject are also kept in a full text index, searched newest
+first, so a word search stays fast on a large spool.  Pages are chained by
+a cursor, the position of the last message returned, rather than by an
+offset that would have to skip every earlier match.
+
+The index follows deliveries and deletions through the mailbox listeners.
+At startup messages missing from the index are added a batch at a time and
+entries for vanished messages are dropped.  The
+database only holds data derived from the maildir and may be deleted to
+rebuild it.
+"""
+
+import bare_io
+import bare_maildir
+import bare_sched
+import email.header
+import email.parser
+import logging
+import os.path
+import re
+import sqlite3
+import time
+
+# create logger
+log = logging.getLogger('baremail.index')
+
+CRLF = '\r\n'
+
+# Bytes of a message read to find the end of its header.
+HEADER_LIMIT = 65536
+
+MAX_LIMIT = 1000
+
+WORD = re.compile(r'\w+\*?', re.UNICODE)
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS messages (uid TEXT UNIQUE, path TEXT, '
+    'length INTEGER, mtime REAL, date TEXT, sender TEXT, subject TEXT, '
+    'message_id TEXT)',
+    'CREATE INDEX IF NOT EXISTS messages_mtime ON messages (mtime)',
+    'CREATE INDEX IF NOT EXISTS messages_message_id ON messages (message_id)',
+    'CREATE TABLE IF NOT EXISTS headers (msg INTEGER, name TEXT, value TEXT)',
+    'CREATE INDEX IF NOT EXISTS headers_msg ON headers (msg)',
+    'CREATE INDEX IF NOT EXISTS headers_name_value ON headers '
+    '(name, value COLLATE NOCASE)',
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_text USING "
+    "fts4(content='messages', sender, subject, order=desc)",
+)
+
+COLUMNS = ('uid', 'path', 'length', 'mtime', 'date', 'sender', 'subject',
+           'message_id')
+
+def _decode(value):
+    """Return header value as unicode with encoded words decoded."""
+    if value is None:
+        return None
+    try:
+        parts = []
+        for text, charset in email.header.decode_header(value):
+            parts.append(text.decode(charset or 'ascii', 'replace'))
+        return u' '.join(parts)
+    except Exception:
+        return value.decode('latin-1')
+
+def _read_header(blocks):
+    """Return the header of a message given as an iterator of blocks."""
+    text = ''
+    for block in blocks:
+        text += block
+        pos = text.find(CRLF + CRLF)
+        if pos >= 0:
+            return text[:pos + 2]
+        if len(text) >= HEADER_LIMIT:
+            break
+    return text
+
+def _read_headers(mbx, msg_list):
+    """Return the headers of the messages in msg_list, None for those that
+    could not be read.  Only the filesystem is touched, so this may run on
+    a disk I/O thread.
+    """
+    headers = []
+    for msg in msg_list:
+        try:
+            headers.append(_read_header(mbx.open_entry(msg)))
+        except Exception:
+            log.exception('error reading {}'.format(msg.path))
+            headers.append(None)
+    return headers
+
+def _match_terms(column, value):
+    """Turn the words of value into full text terms on column.
+
+    Words are split as the index splits them, at anything but letters and
+    digits.  A word ending in '*' matches as a prefix.
+    """
+    terms = []
+    for word in WORD.findall(value):
+        terms.append('{}:{}'.format(column, word))
+    return terms
+
+class _delivered():
+    """Completion of the header read of a delivered message."""
+    def __init__(self, index, msg):
+        self.index = index
+        self.msg = msg
+
+    def done(self, headers, error):
+        if error is not None:
+            headers = [None]
+        self.index._headers_read([self.msg], headers)
+        self.index._changed()
+
+class _filled():
+    """Completion of the header reads of one backfill batch."""
+    def __init__(self, index, msg_list):
+        self.index = index
+        self.msg_list = msg_list
+
+    def done(self, headers, error):
+        if error is not None:
+            headers = [None] * len(self.msg_list)
+        self.index.filled(self.msg_list, headers)
+
+class BareIndex():
+    """The header index of one maildir."""
+
+    def __init__(self, dirname, cfgdict):
+        """Open or create the index database and bring it up to date.
+
+        cfgdict may give the database "path", defaulting to the maildir name
+        with '.index' appended, "headers", a list of extra headers to keep,
+        and "batch", the most messages indexed per step of the startup
+        catch up.
+        """
+        self.path = cfgdict.get('path', dirname.rstrip('/') + '.index')
+        self.extra = []
+        for name in cfgdict.get('headers', []):
+            self.extra.append(name.lower())
+        self.batch = int(cfgdict.get('batch', 500))
+        self._key = os.path.abspath(dirname)
+        self._prefix = os.path.join(self._key, '')
+        self._parser = email.parser.HeaderParser()
+        self._commit_timer = None
+        self._backfill_timer = None
+        self._reading = {}          # uid -> message whose header is read
+        self._closed = False
+
+        # index metrics
+        self.indexed = 0
+        self.removed = 0
+        self.queries = 0
+        self.query_time = 0.0
+
+        # used only from the server loop, which may not be the thread that
+        # configured the server
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+
+        self.mbx = bare_maildir.open_mailbox(dirname)
+        self._pending = self._sync(self.mbx.items())
+        self.mbx.entries = []
+        bare_maildir.add_listener(self.update)
+        log.info('Index {} of {}: {} messages to add'.format(
+            self.path, dirname, len(self._pending)))
+        if self._pending:
+            self._backfill_timer = bare_sched.call_later(0, self.backfill)
+
+    def _relative(self, path):
+        """Return path relative to the maildir."""
+        # os.path.relpath() is slow over a whole mailbox
+        if path.startswith(self._prefix):
+            return path[len(self._prefix):]
+        return os.path.relpath(path, self._key)
+
+    def _sync(self, entries):
+        """Drop entries for vanished messages and correct the paths of
+        those moved, as by a reshard.  Returns the messages that are not
+        yet indexed.
+        """
+        known = {}
+        for uid, path in self.db.execute('SELECT uid, path FROM messages'):
+            known[uid] = path
+        pending = []
+        for msg in entries:
+            path = known.pop(msg.basename, None)
+            if path is None:
+                pending.append(msg)
+            elif path != self._relative(msg.path):
+                self.db.execute('UPDATE messages SET path = ? WHERE uid = ?',
+                                (self._relative(msg.path), msg.basename))
+        for uid in known:
+            self.remove(uid)
+        self.db.commit()
+        pending.reverse()
+        return pending
+
+    def _read(self, msg_list, callback):
+        """Read the headers of msg_list, then call callback(headers, error).
+
+        The segment store maps its files from the loop and is read there.
+        """
+        for msg in msg_list:
+            self._reading[msg.basename] = msg
+        if isinstance(self.mbx, bare_maildir.BareMaildir):
+            bare_io.run(_read_headers, (self.mbx, msg_list), callback)
+        else:
+            callback(_read_headers(self.mbx, msg_list), None)
+
+    def _headers_read(self, msg_list, headers):
+        """Index the messages of msg_list whose headers were read, unless
+        removed meanwhile.
+        """
+        for i, msg in enumerate(msg_list):
+            if self._reading.pop(msg.basename, None) is None or \
+               headers[i] is None or self._closed:
+                continue
+            try:
+                self.add(msg, headers[i])
+            except Exception:
+                log.exception('error indexing {}'.format(msg.path))
+
+    def backfill(self):
+        """Index one batch of the messages found missing at startup."""
+        self._backfill_timer = None
+        batch = []
+        while self._pending and len(batch) < self.batch:
+            batch.append(self._pending.pop())
+        self._read(batch, _filled(self, batch).done)
+
+    def filled(self, msg_list, headers):
+        """Index a batch read by backfill() and start the next."""
+        if self._closed:
+            return
+        self._headers_read(msg_list, headers)
+        self.db.commit()
+        if self._pending:
+            self._backfill_timer = bare_sched.call_later(0, self.backfill)
+        else:
+            log.info('Index of {} complete'.format(self._key))
+
+    def update(self, event, dirname, msg):
+        """Follow deliveries and deletions."""
+        if dirname != self._key:
+            return
+        if event == 'add':
+            self._read([msg], _delivered(self, msg).done)
+        elif event == 'remove':
+            self._reading.pop(msg.basename, None)
+            try:
+                self.remove(msg.basename)
+            except Exception:
+                log.exception('error updating index for {}'.format(msg.path))
+            self._changed()
+
+    def _changed(self):
+        if self._commit_timer is None and not self._closed:
+            self._commit_timer = bare_sched.call_later(0.5, self.commit)
+
+    def commit(self):
+        """Write out index changes.  Changes are batched since the index
+        can be rebuilt from the maildir.
+        """
+        self._commit_timer = None
+        self.db.commit()
+
+    def add(self, msg, header):
+        """Add msg, whose header is header, to the index."""
+        fields = self._parser.parsestr(header)
+        sender = _decode(fields.get('From'))
+        subject = _decode(fields.get('Subject'))
+        cur = self.db.execute(
+            'INSERT OR IGNORE INTO messages (uid, path, length, mtime, date, '
+            'sender, subject, message_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (msg.basename, self._relative(msg.path), msg.length, msg.mtime,
+             _decode(fields.get('Date')), sender, subject,
+             _decode(fields.get('Message-ID'))))
+        if not cur.rowcount:
+            return
+        rowid = cur.lastrowid
+        self.db.execute('INSERT INTO messages_text (docid, sender, subject) '
+                        'VALUES (?, ?, ?)', (rowid, sender, subject))
+        for name in self.extra:
+            for value in fields.get_all(name, []):
+                self.db.execute('INSERT INTO headers (msg, name, value) '
+                                'VALUES (?, ?, ?)',
+                                (rowid, name, _decode(value)))
+        self.indexed += 1
+
+    def remove(self, uid):
+        row = self.db.execute('SELECT rowid FROM messages WHERE uid = ?',
+                              (uid,)).fetchone()
+        if row is None:
+            return
+        rowid = row[0]
+        # the text index reads the words to drop from the messages row
+        self.db.execute('DELETE FROM messages_text WHERE docid = ?', (rowid,))
+        self.db.execute('DELETE FROM headers WHERE msg = ?', (rowid,))
+        self.db.execute('DELETE FROM messages WHERE rowid = ?', (rowid,))
+        self.removed += 1
+
+    def _row(self, row):
+        result = {}
+        for name, value in zip(COLUMNS, row[1:]):
+            result[name] = value
+        result['cursor'] = row[0]
+        return result
+
+    def query(self, sender=None, subject=None, text=None, message_id=None,
+              since=None, until=None, headers=None, before=None, limit=50):
+        """Return (messages, next cursor) for messages matching every
+        given condition, newest first.
+
+        sender and subject match words in From and Subject, text is a full
+        text query on both, since and until bound the delivery time and
+        headers maps extra header names to values.  Pass the returned
+        cursor as before to get the next page.
+        """
+        start = time.time()
+        limit = max(1, min(int(limit), MAX_LIMIT))
+        terms = []
+        if sender:
+            terms.extend(_match_terms('sender', sender))
+        if subject:
+            terms.extend(_match_terms('subject', subject))
+        if text:
+            terms.append(text)
+        # With words to match, the text index leads and is walked newest
+        # first, which stops after one page even for common words.
+        sql = 'SELECT m.rowid, m.{} FROM messages m'.format(
+            ', m.'.join(COLUMNS))
+        order = 'm.rowid'
+        where = []
+        args = []
+        if terms:
+            sql = 'SELECT m.rowid, m.{} FROM messages_text t JOIN messages m ' \
+                  'ON m.rowid = t.docid'.format(', m.'.join(COLUMNS))
+            order = 't.docid'
+            where.append('messages_text MATCH ?')
+            args.append(' '.join(terms))
+        if message_id:
+            where.append('m.message_id = ?')
+            args.append(message_id)
+        if since is not None:
+            where.append('m.mtime >= ?')
+            args.append(float(since))
+        if until is not None:
+            where.append('m.mtime < ?')
+            args.append(float(until))
+        if before is not None:
+            where.append(order + ' < ?')
+            args.append(int(before))
+        if headers:
+            for name, value in headers.items():
+                where.append('m.rowid IN (SELECT msg FROM headers WHERE '
+                             'name = ? AND value = ? COLLATE NOCASE)')
+                args.append(name.lower())
+                args.append(value)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY {} DESC LIMIT ?'.format(order)
+        args.append(limit + 1)
+        messages = []
+        try:
+            for row in self.db.execute(sql, args):
+                messages.append(self._row(row))
+        except sqlite3.OperationalError as e:
+            # a malformed full text query
+            raise ValueError(str(e))
+        next_cursor = None
+        if len(messages) > limit:
+            messages = messages[:limit]
+            next_cursor = messages[-1]['cursor']
+        self.queries += 1
+        self.query_time += time.time() - start
+        return messages, next_cursor
+
+    def get(self, uid):
+        """Return the index entry of message uid with its extra headers, or
+        None.
+        """
+        row = self.db.execute('SELECT rowid, {} FROM messages WHERE uid = ?'
+                              .format(', '.join(COLUMNS)), (uid,)).fetchone()
+        if row is None:
+            return None
+        result = self._row(row)
+        headers = {}
+        for name, value in self.db.execute('SELECT name, value FROM headers '
+                                           'WHERE msg = ?', (row[0],)):
+            headers.setdefault(name, []).append(value)
+        result['headers'] = headers
+        return result
+
+    def open(self, uid):
+        """Return (length, blocks) for the text of message uid."""
+        entry = self.get(uid)
+        if entry is None:
+            raise KeyError('no message {}'.format(uid))
+        # entries written before paths were kept relative are absolute
+        msg = self.mbx.lookup(os.path.join(self._key, entry['path']))
+        return msg.length, self.mbx.open_entry(msg)
+
+    def stats(self):
+        """Return the index metrics as a dictionary."""
+        return dict(indexed=self.indexed, removed=self.removed,
+                    pending=len(self._pending), queries=self.queries,
+                    query_time=self.query_time)
+
+    def close(self):
+        self._closed = True
+        for t in (self._commit_timer, self._backfill_timer):
+            if t is not None:
+                t.cancel()
+        bare_maildir.remove_listener(self.update)
+        self.db.commit()
+        self.db.close()
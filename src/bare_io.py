@@ -0,0 +1,180 @@
+"""BareMail disk I/O threads
+
+Every session shares the one server thread, so a slow fsync, a rename on
+a busy disk or the listing of a large maildir holds up every client.
+Operations that may block on the disk are handed to a small, fixed pool of
+threads instead.  Their results come back to the loop through
+bare_sched.call_soon_threadsafe() and the session carries on from its
+callback: the SMTP server answers 250 once the message is synced and
+moved into the maildir, and the POP3 server greets its client once the
+maildir has been listed.
+
+Only the filesystem is touched on the threads.  Mailbox lists and the
+mailbox listeners are updated in the loop, when the result arrives.  The
+segment store keeps its index in memory and is used inline.  It answers
+a delivery once the group the message was appended to is synced.
+
+Until configure() has run, as in the command line tools, the operations
+run inline and the callbacks are called before the functions return.
+"""
+
+import bare_maildir
+import bare_sched
+import logging
+import multiprocessing.pool
+import time
+
+# create logger
+log = logging.getLogger('baremail.io')
+
+# The disk I/O threads in use, if any.  Set by configure().
+executor = None
+
+def configure(cfgdict):
+    """Set up the disk I/O threads from the "disk_io" configuration."""
+    global executor
+    executor = BareIO(cfgdict)
+    return executor
+
+def _work(func, args):
+    """Call func(*args) and return (result, error, elapsed)."""
+    start = time.time()
+    try:
+        return (func(*args), None, time.time() - start)
+    except Exception as e:
+        log.exception('disk operation {} failed'.format(func.__name__))
+        return (None, e, time.time() - start)
+
+def run(func, args, callback):
+    """Call func(*args) on a disk I/O thread, then callback(result, error)
+    from the loop.  error is None or the exception func raised.
+    """
+    if executor is None:
+        result, error, elapsed = _work(func, args)
+        callback(result, error)
+    else:
+        executor.run(func, args, callback)
+
+def _threaded(mbx):
+    return executor is not None and isinstance(mbx, bare_maildir.BareMaildir)
+
+class _add():
+    """Completion of add()."""
+    def __init__(self, mbx, callback):
+        self.mbx = mbx
+        self.callback = callback
+
+    def done(self, msg, error):
+        key = None
+        if error is None:
+            key = self.mbx.added(msg)
+        self.callback(key, error)
+
+def add(mbx, msg_str, callback):
+    """Store msg_str in mbx and call callback(key, error) once it is
+    safely on disk.
+    """
+    if _threaded(mbx):
+        run(mbx.write, (msg_str,), _add(mbx, callback).done)
+    elif isinstance(mbx, bare_maildir.BareMaildir):
+        run(mbx.add, (msg_str,), callback)
+    else:
+        # without the loop to run its sync timer, sync at once
+        mbx.add_synced(msg_str, callback, executor is None)
+
+def open_mailbox(dirname, callback):
+    """List the mailbox in dirname and call callback(mbx, error)."""
+    if executor is None or bare_maildir.BACKEND != 'maildir':
+        run(bare_maildir.open_mailbox, (dirname,), callback)
+    else:
+        run(bare_maildir.BareMaildir, (dirname,), callback)
+
+class _close():
+    """Completion of close()."""
+    def __init__(self, mbx, callback):
+        self.mbx = mbx
+        self.callback = callback
+
+    def done(self, msg_list, error):
+        if error is None:
+            self.mbx.removed(msg_list)
+        self.callback(None, error)
+
+def close(mbx, callback):
+    """Remove the messages marked for deletion in mbx and call
+    callback(None, error).
+    """
+    if not _threaded(mbx):
+        run(mbx.close, (), callback)
+    else:
+        run(mbx.purge, (), _close(mbx, callback).done)
+
+class _call():
+    """One operation on its way through the threads."""
+    def __init__(self, pool, callback):
+        self.pool = pool
+        self.callback = callback
+        self.start = time.time()
+
+    def post(self, res):
+        """Pool callback, run in the pool's result thread."""
+        bare_sched.call_soon_threadsafe(self.pool.returned, self, res)
+
+class BareIO():
+    """A bounded pool of threads for blocking filesystem calls."""
+
+    def __init__(self, cfgdict):
+        """cfgdict may give "threads", the size of the pool."""
+        self.threads = int(cfgdict.get('threads', 4))
+        self.pool = None
+        bare_sched.enable_wakeup()
+        # metrics
+        self.submitted = 0
+        self.completed = 0
+        self.errors = 0
+        self.work = 0.0
+        self.max_work = 0.0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        log.info('{} disk I/O threads'.format(self.threads))
+
+    def run(self, func, args, callback):
+        if self.pool is None:
+            # started on first use, after privileges have been dropped
+            self.pool = multiprocessing.pool.ThreadPool(self.threads)
+        self.submitted += 1
+        call = _call(self, callback)
+        self.pool.apply_async(_work, (func, args), callback=call.post)
+
+    def returned(self, call, res):
+        """Result of an operation, back in the loop thread."""
+        result, error, elapsed = res
+        latency = time.time() - call.start
+        self.completed += 1
+        self.work += elapsed
+        self.max_work = max(self.max_work, elapsed)
+        self.latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        if error is not None:
+            self.errors += 1
+        call.callback(result, error)
+
+    def stats(self):
+        """Return the disk I/O metrics as a dictionary.
+
+        work is the time spent in the operations and latency the time
+        from submission to the result reaching the loop.
+        """
+        return dict(threads=self.threads, submitted=self.submitted,
+                    completed=self.completed,
+                    pending=self.submitted - self.completed,
+                    errors=self.errors, work=self.work,
+                    max_work=self.max_work, latency=self.latency,
+                    max_latency=self.max_latency)
+
+    def close(self):
+        """Finish the queued operations and stop the threads."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
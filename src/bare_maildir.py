@@ -1,11 +1,354 @@
+import bare_sched
+import bz2
+import errno
+import fcntl
+import hashlib
+import itertools
 import logging
 import os
 import os.path
 import tempfile
+import time
+import zlib
 
 # create logger
 log = logging.getLogger('baremail.maildir')
 
+# Storage settings.  These are replaced by configure() from the "storage"
+# section of the configuration file.
+BACKEND = 'maildir'     # 'maildir' or 'segment'
+COMPRESSION = None      # None, 'zlib' or 'bz2'
+COMPRESS_LEVEL = 6
+DEDUP = False           # keep one copy of byte-identical messages
+SHARD_LAYOUT = None     # None, 'hash' or 'time'
+SHARD_WIDTH = 2         # hex digits of the hash used to pick a shard
+SHARD_BUCKET = 86400    # seconds of deliveries per time shard
+
+# Size of the blocks read from a message file when streaming it to a client.
+CHUNK_SIZE = 65536
+
+# Messages add_many() writes before syncing them together.  Each holds an
+# open file until the group is synced.
+SYNC_GROUP = 100
+
+# Compressors accepted for COMPRESSION.  bz2 is slower but packs cold,
+# rarely read mail tighter than zlib.
+CODECS = ('zlib', 'bz2')
+
+# Deliveries made by other processes, such as baremail_sendmail.py, are
+# listed in this file of the maildir for the server to pick up.
+JOURNAL = 'journal'
+JOURNAL_INTERVAL = 0.5
+
+# Messages deleted by POP3 clients are listed in files of this directory
+# of the maildir until they are unlinked.  See condemn().
+PURGE_DIR = 'purge'
+
+# Directories and files inside a maildir that do not hold messages.
+RESERVED = ('tmp', 'dedup', JOURNAL, PURGE_DIR)
+
+# Shard directories are named with this prefix followed by the shard key.
+SHARD_PREFIX = '_'
+LAYOUTS = ('hash', 'time')
+BACKENDS = ('maildir', 'segment')
+
+# Header prepended on retrieval to messages held in the dedup store.  It
+# gives the number of deliveries of the message's content.
+DEDUP_HEADER = 'X-BareMail-Duplicates'
+HITS_SUFFIX = '.hits'
+
+# Callables told about every delivery and removal.  See add_listener().
+_listeners = []
+
+def add_listener(func):
+    """Register func(event, dirname, msg) to follow mailbox changes.
+
+    event is 'add' after a message is committed to a maildir and 'remove'
+    after its file is unlinked or listed for unlinking by condemn().
+    dirname is the absolute maildir path.
+    """
+    _listeners.append(func)
+
+def remove_listener(func):
+    _listeners.remove(func)
+
+# Count of changes made to each maildir, by absolute path.
+_generations = {}
+
+def generation(dirname):
+    """Return the change count of the maildir with absolute path dirname.
+
+    The count goes up with every delivery and removal made through this
+    process, so two listings taken at the same count hold the same
+    messages.
+    """
+    return _generations.get(dirname, 0)
+
+# Paths of messages listed for unlinking but not yet unlinked.  They are
+# left out of maildir listings.
+_purging = set()
+
+def read_purge_file(dirname, purge_file):
+    """Return the paths of the messages of maildir dirname listed in
+    purge_file.
+    """
+    paths = []
+    f = open(purge_file)
+    try:
+        for line in f:
+            line = line.strip()
+            if line:
+                paths.append(os.path.join(dirname, line))
+    finally:
+        f.close()
+    return paths
+
+def purge_listed(dirname):
+    """Return the set of paths listed in the purge files of maildir
+    dirname: messages deleted by clients whose files a reaper has yet to
+    unlink.  For tools reading the maildir while the server may be down.
+    """
+    purge_dir = os.path.join(dirname, PURGE_DIR)
+    try:
+        names = os.listdir(purge_dir)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return set()
+    paths = set()
+    for fname in names:
+        try:
+            paths.update(read_purge_file(dirname,
+                                         os.path.join(purge_dir, fname)))
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # finished by the reaper since the directory was read
+    return paths
+
+def _notify(event, dirname, msg):
+    _generations[dirname] = _generations.get(dirname, 0) + 1
+    for func in _listeners:
+        try:
+            func(event, dirname, msg)
+        except Exception:
+            log.exception('mailbox listener {} failed'.format(func))
+
+def _entry_order(msg):
+    return (msg.mtime, msg.basename)
+
+def configure(cfgdict):
+    """Set storage options from the "storage" configuration dictionary."""
+    global BACKEND, COMPRESSION, COMPRESS_LEVEL, DEDUP
+    global SHARD_LAYOUT, SHARD_WIDTH, SHARD_BUCKET
+
+    backend = cfgdict.get('backend', 'maildir')
+    if backend not in BACKENDS:
+        raise ValueError('Unknown storage backend {}'.format(backend))
+    codec = cfgdict.get('compression')
+    if codec is not None and codec not in CODECS:
+        raise ValueError('Unknown compression {}'.format(codec))
+    level = int(cfgdict.get('level', COMPRESS_LEVEL))
+    if level < 1 or level > 9:
+        raise ValueError('Compression level must be 1 to 9')
+    BACKEND = backend
+    COMPRESSION = codec
+    COMPRESS_LEVEL = level
+    DEDUP = bool(cfgdict.get('dedup', False))
+    SHARD_LAYOUT, SHARD_WIDTH, SHARD_BUCKET = shard_options(
+        cfgdict.get('shard', {}))
+
+def shard_options(cfgdict):
+    """Return (layout, width, bucket) from a "shard" dictionary."""
+    layout = cfgdict.get('layout')
+    if layout is not None and layout not in LAYOUTS:
+        raise ValueError('Unknown shard layout {}'.format(layout))
+    width = int(cfgdict.get('width', 2))
+    if width < 1 or width > 4:
+        raise ValueError('Shard width must be 1 to 4')
+    bucket = int(cfgdict.get('bucket', 86400))
+    if bucket < 1:
+        raise ValueError('Shard bucket must be at least 1 second')
+    return layout, width, bucket
+
+def shard_name(basename, mtime, layout, width, bucket):
+    """Return the shard directory name for a message, or None if flat.
+
+    Hash shards spread messages evenly by a hash of the file name.  Time
+    shards group messages delivered in the same bucket of seconds so old
+    shards can be archived or expired as a whole.
+    """
+    if layout == 'hash':
+        key = zlib.crc32(basename.split(',', 1)[0]) & 0xffffffff
+        return '{}{:08x}'.format(SHARD_PREFIX, key)[:len(SHARD_PREFIX) + width]
+    if layout == 'time':
+        return '{}{}'.format(SHARD_PREFIX, int(mtime) // bucket * bucket)
+    return None
+
+def message_dirs(dirname):
+    """Return maildir dirname and its shards, the directories holding its
+    messages.
+    """
+    dirs = [dirname]
+    try:
+        names = os.listdir(dirname)
+    except OSError:
+        return dirs
+    for fname in sorted(names):
+        if fname.startswith(SHARD_PREFIX):
+            dirs.append(os.path.join(dirname, fname))
+    return dirs
+
+def dir_stamp(dirs):
+    """Return the modification times of the directories in dirs.
+
+    A directory's time changes whenever a file is added to it or removed
+    from it, so the messages of a maildir are unchanged while the stamp of
+    its message_dirs() is.
+    """
+    stamp = []
+    for path in dirs:
+        try:
+            stamp.append(os.stat(path).st_mtime)
+        except OSError:
+            stamp.append(None)
+    return stamp
+
+def open_mailbox(dirname):
+    """Return the mailbox in dirname using the configured backend."""
+    if BACKEND == 'segment':
+        import bare_segment
+        return bare_segment.BareSegmentStore(dirname)
+    return BareMaildir(dirname)
+
+# Mailboxes shared by the SMTP sessions, by absolute path.
+_delivery = {}
+
+def delivery_mailbox(dirname):
+    """Return the mailbox in dirname that deliveries are added through.
+
+    The mailbox is opened once and shared.  It lists no messages, neither
+    those already stored nor those added, so opening it costs nothing
+    however large the mailbox and it does not grow with use.
+    """
+    key = os.path.abspath(dirname)
+    mbx = _delivery.get(key)
+    if mbx is None:
+        if BACKEND == 'segment':
+            import bare_segment
+            mbx = bare_segment.BareSegmentStore(dirname, listing=False)
+        else:
+            mbx = BareMaildir(dirname, scan=False, listing=False)
+        _delivery[key] = mbx
+    return mbx
+
+def _compressor(codec, level):
+    if codec == 'zlib':
+        return zlib.compressobj(level)
+    if codec == 'bz2':
+        return bz2.BZ2Compressor(level)
+    raise ValueError('Unknown compression {}'.format(codec))
+
+def _decompressor(codec):
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    if codec == 'bz2':
+        return bz2.BZ2Decompressor()
+    raise ValueError('Unknown compression {}'.format(codec))
+
+def _info_name(uniq, length, codec, digest=None, mtime=None):
+    """Build a message file name carrying its metadata.
+
+    The uncompressed size is kept in the name as ',S=<size>' in the manner
+    of Maildir++ so the mailbox can be indexed without opening any file.
+    Compressed messages also carry ',Z=<codec>' and messages linked to the
+    dedup store carry ',H=<digest>' and their delivery time as ',T=<time>',
+    since every copy shares the modification time of the stored one.
+    """
+    name = '{},S={}'.format(uniq, length)
+    if codec:
+        name = '{},Z={}'.format(name, codec)
+    if digest:
+        name = '{},H={}'.format(name, digest)
+    if mtime is not None:
+        name = '{},T={:.3f}'.format(name, mtime)
+    return name
+
+def _parse_info(basename):
+    """Return (length, codec, digest) from a message file name.
+
+    length is None for names that do not carry a size.
+    """
+    length = None
+    codec = None
+    digest = None
+    for field in basename.split(',')[1:]:
+        if field.startswith('S='):
+            try:
+                length = int(field[2:])
+            except ValueError:
+                length = None
+        elif field.startswith('Z='):
+            codec = field[2:]
+        elif field.startswith('H='):
+            digest = field[2:]
+    return length, codec, digest
+
+def _info_time(basename, mtime):
+    """Return the delivery time a message file name carries, or mtime,
+    the modification time of the file, if it carries none.
+    """
+    for field in basename.split(',')[1:]:
+        if field.startswith('T='):
+            try:
+                return float(field[2:])
+            except ValueError:
+                break
+    return mtime
+
+def _digest(msg_str):
+    """Return the content address of a message."""
+    return hashlib.sha1(msg_str).hexdigest()[:32]
+
+def _dedup_header(count):
+    return '{}: {}{}'.format(DEDUP_HEADER, count, '\r\n')
+
+def _dedup_store(dirname, digest, codec):
+    """Return the path of the stored copy of a message in maildir dirname."""
+    name = digest
+    if codec:
+        name = '{},Z={}'.format(name, codec)
+    return os.path.join(dirname, 'dedup', digest[:2], name)
+
+def _hits_path(store):
+    """Return the path of the hit counter of a stored copy.
+
+    The counter file grows by one byte for each delivery linked to the
+    copy, so its size is the count.  Appends from several processes do not
+    lose counts and need no lock.
+    """
+    return store + HITS_SUFFIX
+
+def _hit(store):
+    """Count a delivery of the stored copy and return the new count."""
+    fd = os.open(_hits_path(store), os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                 0o600)
+    try:
+        os.write(fd, '.')
+        return os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+
+def _hits(store, nlink):
+    """Return the hit count of a stored copy with nlink links.
+
+    Copies stored before counting began are counted by their links.
+    """
+    try:
+        return os.stat(_hits_path(store)).st_size
+    except OSError:
+        return nlink - 1
+
 def _sync_flush(f):
     """Ensure changes to file f are physically on disk."""
     f.flush()
@@ -17,6 +360,29 @@ def _sync_close(f):
     _sync_flush(f)
     f.close()
 
+def _sync_dir(dirname):
+    """Ensure the entries of directory dirname are physically on disk."""
+    if hasattr(os, 'fsync'):
+        fd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def _remove(path):
+    """Unlink path if it exists."""
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def _discard_tmp(tmp_files):
+    """Close and remove tmp files left by a failed write."""
+    for tmp_file in tmp_files:
+        tmp_file.close()
+        _remove(tmp_file.name)
+
 def _moveto(name, dest):
     try:
         os.rename(name, dest)
@@ -25,20 +391,68 @@ def _moveto(name, dest):
         os.remove(name)
         raise
 
+def _iter_file(f, codec, size):
+    """Yield the contents of open file f, decompressing as it is read."""
+    try:
+        if codec:
+            decomp = _decompressor(codec)
+        else:
+            decomp = None
+        while True:
+            block = f.read(size)
+            if not block:
+                break
+            if decomp is not None:
+                block = decomp.decompress(block)
+            if block:
+                yield block
+        if decomp is not None and hasattr(decomp, 'flush'):
+            block = decomp.flush()
+            if block:
+                yield block
+    finally:
+        f.close()
+
 class BareMessage():
-    def __init__(self, message):
+    def __init__(self, message, dirname=None):
+        """Describe a message from its text or its open file.
+
+        dirname is the maildir holding the file.  It locates the hit
+        counter of a message held in the dedup store.
+        """
         self.delete = False
+        self.codec = None
+        self.digest = None
+        self.header = ''
         if isinstance(message, str):
             log.debug('Create msg from string')
             self.path = None
             self.basename = None
             self.length = len(message)
+            self.mtime = time.time()
         elif isinstance(message, file):
             log.debug('Create msg from file - {}'.format(message.name))
             self.path = message.name
             self.basename = os.path.basename(message.name)
-            s = message.read()
-            self.length = len(s)
+            info = _parse_info(self.basename)
+            self.length, self.codec, self.digest = info
+            st = os.fstat(message.fileno())
+            self.mtime = _info_time(self.basename, st.st_mtime)
+            if self.length is None:
+                if self.codec:
+                    s = ''.join(_iter_file(message, self.codec, CHUNK_SIZE))
+                    self.length = len(s)
+                else:
+                    self.length = st.st_size
+            if self.digest:
+                if dirname is None:
+                    # Every maildir entry and the store copy share the inode.
+                    count = st.st_nlink - 1
+                else:
+                    count = _hits(_dedup_store(dirname, self.digest,
+                                               self.codec), st.st_nlink)
+                self.header = _dedup_header(count)
+                self.length += len(self.header)
         else:
             raise TypeError('Invalid message type: %s' % type(message))
 
@@ -47,52 +461,296 @@ class BareMaildir():
 
     colon = ':'
 
-    def __init__(self, dirname):
-        """Initialize a Maildir instance."""
+    def __init__(self, dirname, scan=True, listing=True):
+        """Initialize a Maildir instance.
+
+        Messages are listed oldest first by delivery time.  With scan
+        False the existing messages are not read, for callers that only
+        add messages.  With listing False the messages added are not
+        listed either.  dirs and stamp are the message_dirs() and their
+        dir_stamp() taken just before the scan, or None without one.
+        """
         self.entries = []
+        self.dirs = None
+        self.stamp = None
+        self.listing = listing
         self._path = dirname
+        self._key = os.path.abspath(dirname)
         self._tmp_dir = os.path.join(dirname, 'tmp')
+        self._shards = set()
+        self.generation = generation(self._key)
         if not os.path.exists(self._path):
             os.mkdir(self._path, 0o700)
             log.debug('creating directory {}'.format(self._path))
         if not os.path.exists(self._tmp_dir):
             os.mkdir(self._tmp_dir, 0o700)
             log.debug('creating directory {}'.format(self._tmp_dir))
+        if scan:
+            # taken before the scan, so changes made during it are seen later
+            self.dirs = message_dirs(dirname)
+            self.stamp = dir_stamp(self.dirs)
+            self._scan(dirname, True)
+            self.entries.sort(key=_entry_order)
+
+    def _scan(self, dirname, top):
+        """Add the messages in dirname and, at the top, in its shards."""
         for fname in os.listdir(dirname):
-            if fname != 'tmp':
-                log.debug('trying file {}'.format(fname))
-                path = os.path.join(dirname, fname)
-                try:
-                    msgfile = open(path, 'rb')
-                    log.debug('adding file {}'.format(path))
-                    msg = BareMessage(msgfile)
-                    self.entries.append(msg)
-                    msgfile.close()
-                except Exception:
+            path = os.path.join(dirname, fname)
+            if top:
+                if fname in RESERVED:
+                    continue
+                if fname.startswith(SHARD_PREFIX):
+                    log.debug('scanning shard {}'.format(path))
+                    self._scan(path, False)
+                    continue
+            if path in _purging:
+                continue
+            log.debug('trying file {}'.format(fname))
+            try:
+                msgfile = open(path, 'rb')
+                log.debug('adding file {}'.format(path))
+                msg = BareMessage(msgfile, self._path)
+                self.entries.append(msg)
+                msgfile.close()
+            except IOError as e:
+                if e.errno != errno.ENOENT:
                     log.exception('error adding file {}'.format(path))
+                # else unlinked since the directory was read
+            except Exception:
+                log.exception('error adding file {}'.format(path))
 
-    def add(self, msg_str):
-        """Add message string and return assigned key."""
+    def _dest(self, uniq, mtime):
+        """Return the path for new message uniq, creating its shard."""
+        shard = shard_name(uniq, mtime, SHARD_LAYOUT, SHARD_WIDTH,
+                           SHARD_BUCKET)
+        if shard is None:
+            return os.path.join(self._path, uniq)
+        shard_dir = os.path.join(self._path, shard)
+        if shard_dir not in self._shards and not os.path.isdir(shard_dir):
+            try:
+                os.mkdir(shard_dir, 0o700)
+                log.debug('creating directory {}'.format(shard_dir))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._shards.add(shard_dir)
+        return os.path.join(shard_dir, uniq)
+
+    def _dedup_path(self, digest, codec):
+        return _dedup_store(self._path, digest, codec)
+
+    def _write_tmp(self, msg_str, codec, sync=True):
+        """Write msg_str to a new file in tmp and return its name.
+
+        Unless sync is False the file is synced and closed.  Otherwise the
+        open file is returned for the caller to sync.
+        """
         tmp_file = tempfile.NamedTemporaryFile(dir=self._tmp_dir,
                                                prefix='bare',
                                                delete=False)
         log.debug('add message from string - {}'.format(tmp_file.name))
         try:
-            tmp_file.file.write(msg_str)
+            if codec:
+                comp = _compressor(codec, COMPRESS_LEVEL)
+                tmp_file.file.write(comp.compress(msg_str))
+                tmp_file.file.write(comp.flush())
+            else:
+                tmp_file.file.write(msg_str)
         except Exception:
             tmp_file.close()
             os.remove(tmp_file.name)
             raise
+        if not sync:
+            return tmp_file
         _sync_close(tmp_file)
-        uniq = os.path.basename(tmp_file.name)
-        dest = os.path.join(self._path, uniq)
-        _moveto(tmp_file.name, dest)
+        return tmp_file.name
+
+    def _add_dedup(self, msg, msg_str, codec):
+        """Link message msg to the stored copy of msg_str, storing it first
+        if it is new.  Returns msg.
+
+        Only the first copy of a message is written and synced.  Repeats
+        cost a hash, a hard link and a count.
+        """
+        digest = _digest(msg_str)
+        store = self._dedup_path(digest, codec)
+        try:
+            return self._link_dedup(msg, msg_str, digest, store, codec)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        log.debug('new dedup entry {}'.format(digest))
+        self._store_copy(self._write_tmp(msg_str, codec), store)
+        return self._link_dedup(msg, msg_str, digest, store, codec)
+
+    def _store_copy(self, tmp_name, store):
+        """Put synced tmp file tmp_name into the dedup store as store.
+
+        The file is linked rather than renamed, so a copy of the same
+        contents stored meanwhile by another thread or process is kept
+        and every entry links to the one inode.
+        """
+        store_dir = os.path.dirname(store)
+        try:
+            os.makedirs(store_dir, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            try:
+                os.link(tmp_name, store)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                log.debug('dedup entry {} stored meanwhile'.format(store))
+        finally:
+            os.remove(tmp_name)
+
+    def _link_dedup(self, msg, msg_str, digest, store, codec):
+        """Add a maildir entry for msg linked to stored copy store."""
+        uniq = _info_name('bare' + os.urandom(6).encode('hex'),
+                          len(msg_str), codec, digest, msg.mtime)
+        dest = self._dest(uniq, msg.mtime)
+        os.link(store, dest)
+        msg.header = _dedup_header(_hit(store))
+        msg.path = dest
+        msg.digest = digest
+        msg.basename = uniq
+        msg.length = len(msg.header) + len(msg_str)
+        msg.codec = codec
+        return msg
+
+    def add(self, msg_str):
+        """Add message string and return assigned key.
+
+        The message is compressed on the way to disk when a compression
+        codec is configured, and linked to a single stored copy when
+        dedup is enabled.
+        """
+        return self.added(self.write(msg_str))
+
+    def write(self, msg_str):
+        """Put message string on disk and return its BareMessage.
+
+        Only the filesystem is touched, so this may run on a disk I/O
+        thread.  The message is listed by passing it to added().
+        """
+        codec = COMPRESSION
         msg = BareMessage(msg_str)
+        if DEDUP:
+            return self._add_dedup(msg, msg_str, codec)
+        return self._place(self._write_tmp(msg_str, codec), msg, msg_str,
+                           codec)
+
+    def _place(self, tmp_name, msg, msg_str, codec):
+        """Move a synced tmp file into the maildir."""
+        uniq = _info_name(os.path.basename(tmp_name), len(msg_str), codec)
+        dest = self._dest(uniq, msg.mtime)
+        _moveto(tmp_name, dest)
         msg.path = dest
         msg.basename = uniq
         msg.length = len(msg_str)
-        self.entries.append(msg)
-        return uniq
+        msg.codec = codec
+        return msg
+
+    def added(self, msg):
+        """List message msg, written by write(), and announce it to the
+        listeners.  Returns its key.
+        """
+        if self.listing:
+            self.entries.append(msg)
+        _notify('add', self._key, msg)
+        return msg.basename
+
+    def add_many(self, msg_list, mtimes=None):
+        """Add a list of message strings and return their keys.
+
+        Messages are written SYNC_GROUP at a time.  Each group is written
+        before any of it is synced, so only one group of files is open at a
+        time however long the list.  The maildir directory is synced once
+        after all are moved in.  mtimes may give the delivery time of each
+        message, as when an archive is restored.
+        """
+        keys = []
+        for start in xrange(0, len(msg_list), SYNC_GROUP):
+            group = msg_list[start:start + SYNC_GROUP]
+            times = None
+            if mtimes is not None:
+                times = mtimes[start:start + SYNC_GROUP]
+            if DEDUP:
+                keys.extend(self._add_dedup_group(group, times))
+            else:
+                keys.extend(self._add_group(group, times))
+        _sync_dir(self._path)
+        for shard_dir in self._shards:
+            _sync_dir(shard_dir)
+        return keys
+
+    def _add_group(self, msg_list, mtimes):
+        """Write, sync and move in one group of add_many()."""
+        codec = COMPRESSION
+        written = []
+        try:
+            for i, msg_str in enumerate(msg_list):
+                tmp_file = self._write_tmp(msg_str, codec, False)
+                written.append(tmp_file)
+                if mtimes is not None:
+                    tmp_file.flush()
+                    os.utime(tmp_file.name, (mtimes[i], mtimes[i]))
+            for tmp_file in written:
+                _sync_close(tmp_file)
+        except Exception:
+            _discard_tmp(written)
+            raise
+        keys = []
+        for i, msg_str in enumerate(msg_list):
+            msg = BareMessage(msg_str)
+            if mtimes is not None:
+                msg.mtime = mtimes[i]
+            keys.append(self.added(self._place(written[i].name, msg,
+                                               msg_str, codec)))
+        return keys
+
+    def _add_dedup_group(self, msg_list, mtimes):
+        """Store one group of add_many() in the dedup store.
+
+        Contents not yet stored, each once however often it repeats in the
+        group, are written and synced together before every message is
+        linked.
+        """
+        codec = COMPRESSION
+        digests = []
+        stores = {}     # digest -> stored copy
+        written = []    # tmp files of new contents
+        new = []        # and the stored copies they become
+        try:
+            for msg_str in msg_list:
+                digest = _digest(msg_str)
+                digests.append(digest)
+                if stores.has_key(digest):
+                    continue
+                store = self._dedup_path(digest, codec)
+                stores[digest] = store
+                if not os.path.exists(store):
+                    written.append(self._write_tmp(msg_str, codec, False))
+                    new.append(store)
+            for tmp_file in written:
+                _sync_close(tmp_file)
+        except Exception:
+            _discard_tmp(written)
+            raise
+        for i, tmp_file in enumerate(written):
+            log.debug('new dedup entry {}'.format(new[i]))
+            self._store_copy(tmp_file.name, new[i])
+        keys = []
+        for i, msg_str in enumerate(msg_list):
+            digest = digests[i]
+            msg = BareMessage(msg_str)
+            if mtimes is not None:
+                msg.mtime = mtimes[i]
+            msg = self._link_dedup(msg, msg_str, digest, stores[digest], codec)
+            keys.append(self.added(msg))
+        return keys
 
     def items(self):
         """Return a list of (key, message) tuples. Memory intensive."""
@@ -101,18 +759,242 @@ class BareMaildir():
     def delete(self, msg_num):
         self.entries[msg_num].delete = True
 
+    def open_message(self, msg_num, size=CHUNK_SIZE):
+        """Return an iterator over the message text in blocks of up to size.
+
+        The file is opened here so a missing message raises at once.
+        Compressed messages are decompressed a block at a time.
+        """
+        return self.open_entry(self.entries[msg_num], size)
+
+    def open_entry(self, msg, size=CHUNK_SIZE):
+        """Return an iterator over the text of message msg."""
+        f = open(msg.path, 'rb')
+        blocks = _iter_file(f, msg.codec, size)
+        if msg.header:
+            return itertools.chain((msg.header,), blocks)
+        return blocks
+
+    def lookup(self, path):
+        """Return the message stored at path without listing the maildir."""
+        msgfile = open(path, 'rb')
+        try:
+            return BareMessage(msgfile, self._path)
+        finally:
+            msgfile.close()
+
+    def copy_in(self, name, data, mtime):
+        """Store a message file copied from another maildir and return its
+        BareMessage, or None if the file is already here.
+
+        name is the path of the file relative to the maildir and data its
+        content as stored, compressed or not.  The copy keeps modification
+        time mtime so it is listed in the same order.  Only the filesystem
+        is touched and the directory is not synced, so this may run on a
+        disk I/O thread and many copies may share one directory sync.
+        """
+        dest = os.path.join(self._path, name)
+        if os.path.exists(dest):
+            return None
+        shard_dir = os.path.dirname(dest)
+        if shard_dir != self._path and shard_dir not in self._shards:
+            if not os.path.isdir(shard_dir):
+                try:
+                    os.mkdir(shard_dir, 0o700)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            self._shards.add(shard_dir)
+        length, codec, digest = _parse_info(os.path.basename(name))
+        if digest:
+            store = self._dedup_path(digest, codec)
+            if not os.path.exists(store):
+                tmp_name = self._write_tmp(data, None)
+                os.utime(tmp_name, (mtime, mtime))
+                self._store_copy(tmp_name, store)
+            os.link(store, dest)
+            _hit(store)
+        else:
+            tmp_name = self._write_tmp(data, None)
+            os.utime(tmp_name, (mtime, mtime))
+            _moveto(tmp_name, dest)
+        return self.lookup(dest)
+
     def get_string(self, msg_num):
-        f = open(self.entries[msg_num].path, 'rb')
-        return f.read()
+        return ''.join(self.open_message(msg_num))
 
     def reset(self):
         for m in self.entries:
             m.delete = False
 
     def close(self):
+        self.removed(self.purge())
+
+    def purge(self):
+        """Unlink the files of the messages marked for deletion and return
+        the messages removed.
+
+        Only the filesystem is touched, so this may run on a disk I/O
+        thread.  The removals are announced by passing the result to
+        removed().
+        """
+        gone = []
         for m in self.entries:
-            if m.delete:
-                try:
-                    os.unlink(m.path)
-                except Exception:
-                    raise
+            if m.delete and self._unlink(m):
+                gone.append(m)
+        return gone
+
+    def condemn(self):
+        """List the messages marked for deletion in a new purge file and
+        return (purge file path, messages).
+
+        The purge file is synced before this returns, so the deletions
+        survive a crash, but the message files are left for a reaper to
+        unlink.  The messages no longer appear in listings.  Only the
+        filesystem is touched, so this may run on a disk I/O thread.
+        """
+        gone = []
+        lines = []
+        prefix = os.path.join(self._path, '')
+        for m in self.entries:
+            if m.delete and m.path not in _purging:
+                gone.append(m)
+                # os.path.relpath() is slow over a whole mailbox
+                if m.path.startswith(prefix):
+                    lines.append(m.path[len(prefix):] + '\n')
+                else:
+                    lines.append(os.path.relpath(m.path, self._path) + '\n')
+        if not gone:
+            return None, gone
+        purge_dir = os.path.join(self._path, PURGE_DIR)
+        if not os.path.isdir(purge_dir):
+            os.mkdir(purge_dir, 0o700)
+        tmp_name = self._write_tmp(''.join(lines), None)
+        dest = os.path.join(purge_dir, os.path.basename(tmp_name))
+        _moveto(tmp_name, dest)
+        _sync_dir(purge_dir)
+        for m in gone:
+            _purging.add(m.path)
+        return dest, gone
+
+    def removed(self, msg_list):
+        """Announce the removal of the messages in msg_list."""
+        for msg in msg_list:
+            _notify('remove', self._key, msg)
+
+    def discard(self, msg):
+        """Unlink the file of message msg.
+
+        A message already removed by another session or by expiry is
+        not an error.
+        """
+        if self._unlink(msg):
+            _notify('remove', self._key, msg)
+
+    def _unlink(self, msg):
+        """Unlink the file of message msg.  Returns False if it was
+        already gone.
+        """
+        try:
+            os.unlink(msg.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            log.debug('already removed {}'.format(msg.path))
+            return False
+        if msg.digest:
+            self._release(msg)
+        return True
+
+    def _release(self, msg):
+        """Remove the stored copy of msg once no maildir entry links to it."""
+        store = self._dedup_path(msg.digest, msg.codec)
+        try:
+            if os.stat(store).st_nlink == 1:
+                log.debug('releasing dedup entry {}'.format(msg.digest))
+                os.unlink(store)
+                _remove(_hits_path(store))
+        except OSError:
+            log.exception('error releasing {}'.format(store))
+
+def journal_append(dirname, paths):
+    """Record messages delivered to dirname by a process other than the server.
+
+    paths are the message files.  They are written in one append so a
+    running server sees the whole batch at once.
+    """
+    lines = []
+    prefix = os.path.join(dirname, '')
+    for path in paths:
+        # os.path.relpath() is slow over a large batch
+        if path.startswith(prefix):
+            lines.append(path[len(prefix):] + '\n')
+        else:
+            lines.append(os.path.relpath(path, dirname) + '\n')
+    fd = os.open(os.path.join(dirname, JOURNAL),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        os.write(fd, ''.join(lines))
+    finally:
+        os.close(fd)
+
+class BareJournal():
+    """Index messages that other processes deliver into a maildir.
+
+    The journal is read and emptied from the timer loop.  Each message
+    it lists is indexed from its file and announced to the mailbox
+    listeners, so the server follows outside deliveries without
+    scanning the maildir.
+    """
+
+    def __init__(self, dirname, interval=JOURNAL_INTERVAL):
+        self._path = dirname
+        self._key = os.path.abspath(dirname)
+        self._journal = os.path.join(dirname, JOURNAL)
+        self.interval = interval
+        self._timer = None
+        # Messages listed before startup are found by the first scans.
+        self._take()
+        self._timer = bare_sched.call_later(self.interval, self.poll)
+
+    def _take(self):
+        """Return the lines of the journal and empty it."""
+        try:
+            if os.path.getsize(self._journal) == 0:
+                return []
+        except OSError:
+            return []
+        fd = os.open(self._journal, os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = ''
+            while True:
+                block = os.read(fd, CHUNK_SIZE)
+                if not block:
+                    break
+                data += block
+            os.ftruncate(fd, 0)
+        finally:
+            os.close(fd)
+        return data.splitlines()
+
+    def poll(self):
+        """Index and announce the messages added to the journal."""
+        self._timer = bare_sched.call_later(self.interval, self.poll)
+        for name in self._take():
+            path = os.path.join(self._path, name)
+            try:
+                msgfile = open(path, 'rb')
+                msg = BareMessage(msgfile, self._path)
+                msgfile.close()
+            except Exception:
+                log.exception('error indexing delivered file {}'.format(path))
+                continue
+            log.debug('indexed delivered file {}'.format(path))
+            _notify('add', self._key, msg)
+
+    def close(self):
+        """Stop following the journal."""
+        if self._timer is not None:
+            self._timer.cancel()
@@ -0,0 +1,205 @@
+"""BareMail deferred deletion
+
+A POP3 client may delete tens of thousands of messages in one session.
+Unlinking them all before answering QUIT would hold up the client, and the
+disk, for as long as that takes.  Instead the deletions are committed by
+writing the list of files to a purge file in the maildir's ``purge``
+directory, and QUIT is answered as soon as that one file is synced.  The
+messages leave the mailbox listings at once.
+
+The reaper then unlinks the files in batches on the disk I/O threads, at a
+limited rate so a large purge never competes with deliveries.  A purge
+file is removed once all its messages are gone.  Purge files left by a
+crash are read when the reaper starts and their messages are unlinked as
+if the sessions had just ended.
+"""
+
+import bare_io
+import bare_maildir
+import bare_sched
+import collections
+import logging
+import os
+import time
+
+# create logger
+log = logging.getLogger('baremail.reaper')
+
+# The reaper of each maildir, by absolute path.
+_reapers = {}
+
+def commit(mbx, callback):
+    """Commit the deletions marked in mbx and call callback(None, error).
+
+    The messages are handed to the reaper of the maildir, if there is
+    one.  Otherwise they are removed before the callback runs.
+    """
+    reaper = _reapers.get(mbx._key)
+    if reaper is None or not isinstance(mbx, bare_maildir.BareMaildir):
+        bare_io.close(mbx, callback)
+    else:
+        reaper.commit(mbx, callback)
+
+def finish(dirname):
+    """Unlink the messages listed in the purge files of maildir dirname,
+    remove the purge files and return the count.  For tools that must not
+    run with deletions outstanding, while the server is stopped.
+    """
+    mbx = bare_maildir.BareMaildir(dirname, scan=False)
+    purge_dir = os.path.join(dirname, bare_maildir.PURGE_DIR)
+    if not os.path.isdir(purge_dir):
+        return 0
+    count = 0
+    for fname in sorted(os.listdir(purge_dir)):
+        purge_file = os.path.join(purge_dir, fname)
+        for path in bare_maildir.read_purge_file(mbx._path, purge_file):
+            if mbx._unlink(_purged(path)):
+                count += 1
+        os.unlink(purge_file)
+    bare_maildir._sync_dir(purge_dir)
+    return count
+
+class _purged():
+    """A message named in a purge file."""
+    def __init__(self, path):
+        self.path = path
+        self.basename = os.path.basename(path)
+        length, self.codec, self.digest = bare_maildir._parse_info(
+            self.basename)
+
+class _commit():
+    """Completion of BareReaper.commit()."""
+    def __init__(self, reaper, mbx, callback):
+        self.reaper = reaper
+        self.mbx = mbx
+        self.callback = callback
+
+    def done(self, result, error):
+        if error is None:
+            purge_file, msg_list = result
+            self.mbx.removed(msg_list)
+            if purge_file is not None:
+                paths = []
+                for msg in msg_list:
+                    paths.append(msg.path)
+                self.reaper.queue(purge_file, paths)
+        self.callback(None, error)
+
+class BareReaper():
+    """Unlink the messages deleted by POP3 clients from one maildir."""
+
+    def __init__(self, dirname, cfgdict):
+        """Recover purge files left by an earlier run and start reaping.
+
+        cfgdict may give "batch", the most files unlinked at a time, and
+        "rate", the most files unlinked per second.
+        """
+        self.batch = int(cfgdict.get('batch', 500))
+        self.rate = float(cfgdict.get('rate', 5000))
+        self.mbx = bare_maildir.BareMaildir(dirname, scan=False)
+        self._purge_dir = os.path.join(dirname, bare_maildir.PURGE_DIR)
+        # [purge file, paths not yet unlinked] for each purge file
+        self._files = collections.deque()
+        self._timer = None
+        # the batch on the disk I/O threads
+        self._busy = False
+        self._paths = []
+        self._started = 0.0
+
+        # reaper metrics
+        self.committed = 0
+        self.reaped = 0
+        self.batches = 0
+        self.last_batch = 0.0
+        self.max_batch = 0.0
+
+        self.recover()
+        _reapers[self.mbx._key] = self
+        log.info('Reaper on {}: {} messages left to unlink'.format(
+            dirname, self.pending()))
+
+    def recover(self):
+        """Queue the messages of the purge files already on disk."""
+        if not os.path.isdir(self._purge_dir):
+            return
+        for fname in sorted(os.listdir(self._purge_dir)):
+            purge_file = os.path.join(self._purge_dir, fname)
+            paths = bare_maildir.read_purge_file(self.mbx._path, purge_file)
+            log.info('Resuming purge of {} messages from {}'.format(
+                len(paths), purge_file))
+            for path in paths:
+                bare_maildir._purging.add(path)
+            self.queue(purge_file, paths)
+
+    def commit(self, mbx, callback):
+        bare_io.run(mbx.condemn, (), _commit(self, mbx, callback).done)
+
+    def queue(self, purge_file, paths):
+        self.committed += len(paths)
+        self._files.append([purge_file, collections.deque(paths)])
+        if not self._busy and self._timer is None:
+            self._timer = bare_sched.call_later(0, self.reap)
+
+    def pending(self):
+        count = 0
+        for purge_file, paths in self._files:
+            count += len(paths)
+        return count
+
+    def reap(self):
+        """Hand the next batch of files to the disk I/O threads."""
+        self._timer = None
+        paths = []
+        finished = []
+        while self._files and len(paths) < self.batch:
+            purge_file, queued = self._files[0]
+            while queued and len(paths) < self.batch:
+                paths.append(queued.popleft())
+            if not queued:
+                finished.append(purge_file)
+                self._files.popleft()
+        self._busy = True
+        self._started = time.time()
+        self._paths = paths
+        bare_io.run(self.unlink, (paths, finished), self.unlinked)
+
+    def unlink(self, paths, finished):
+        """Unlink paths, then the purge files whose messages are all gone.
+        Runs on a disk I/O thread.
+        """
+        for path in paths:
+            try:
+                self.mbx._unlink(_purged(path))
+            except OSError:
+                log.exception('error unlinking {}'.format(path))
+        for purge_file in finished:
+            os.unlink(purge_file)
+        return len(paths)
+
+    def unlinked(self, count, error):
+        """A batch is done.  Schedule the next at the configured rate."""
+        self._busy = False
+        for path in self._paths:
+            bare_maildir._purging.discard(path)
+        elapsed = time.time() - self._started
+        self.batches += 1
+        self.last_batch = elapsed
+        self.max_batch = max(self.max_batch, elapsed)
+        if error is None:
+            self.reaped += count
+        if self._files:
+            delay = max(0.0, len(self._paths) / self.rate - elapsed)
+            self._timer = bare_sched.call_later(delay, self.reap)
+        self._paths = []
+
+    def stats(self):
+        """Return the reaper metrics as a dictionary."""
+        return dict(pending=self.pending(), committed=self.committed,
+                    reaped=self.reaped, batches=self.batches,
+                    last_batch=self.last_batch, max_batch=self.max_batch)
+
+    def close(self):
+        """Stop reaping.  Unfinished purge files are resumed at startup."""
+        if self._timer is not None:
+            self._timer.cancel()
+        _reapers.pop(self.mbx._key, None)
@@ -0,0 +1,177 @@
+"""BareMail spool retention
+
+Messages normally leave the maildir only when a POP3 client deletes them.
+A BareSweeper enforces a retention policy on one maildir: a maximum message
+age, a maximum total size and a maximum message count.  The oldest messages
+are expired first.
+
+The sweeper reads the maildir once at startup and then follows deliveries
+and deletions through the mailbox listeners, so a sweep never walks the
+directory.  Expired files are unlinked in small batches on the disk I/O
+threads so a large backlog never holds up the protocol handlers.  Only one
+batch is in flight at a time.
+
+A message's age is its delivery time.  Copies linked to the dedup store
+share one file, so theirs is read from the file name rather than from the
+file's modification time.
+"""
+
+import bare_io
+import bare_maildir
+import bare_sched
+import collections
+import logging
+import os.path
+import time
+
+# create logger
+log = logging.getLogger('baremail.retention')
+
+class _swept():
+    """Completion of the unlinks of one sweep."""
+    def __init__(self, sweeper, start, removed, backlog):
+        self.sweeper = sweeper
+        self.start = start
+        self.removed = removed
+        self.backlog = backlog
+
+    def done(self, result, error):
+        if error is not None:
+            log.error('error expiring messages: {}'.format(error))
+        self.sweeper.mbx.entries = []
+        self.sweeper.swept(self.start, self.removed, self.backlog)
+
+class BareSweeper():
+    """Expire messages from a maildir according to a retention policy."""
+
+    def __init__(self, dirname, cfgdict):
+        """Load the maildir index and start sweeping.
+
+        cfgdict holds the policy: max_age (seconds), max_bytes and
+        max_count, any of which may be left out.  interval is the time
+        between sweeps, batch the most files unlinked at a time and rate
+        the most files unlinked per second while catching up.
+        """
+        self.max_age = cfgdict.get('max_age')
+        self.max_bytes = cfgdict.get('max_bytes')
+        self.max_count = cfgdict.get('max_count')
+        self.interval = float(cfgdict.get('interval', 60))
+        self.batch = int(cfgdict.get('batch', 100))
+        self.rate = float(cfgdict.get('rate', 1000))
+        self._key = os.path.abspath(dirname)
+        self._timer = None
+        self._closed = False
+
+        # sweep metrics
+        self.sweeps = 0
+        self.expired = 0
+        self.bytes_freed = 0
+        self.last_sweep = 0.0
+        self.max_sweep = 0.0
+        self.total_sweep = 0.0
+
+        self.mbx = bare_maildir.open_mailbox(dirname)
+        self._queue = collections.deque(self.mbx.items())
+        self._live = {}
+        self.total_bytes = 0
+        for msg in self._queue:
+            self._live[msg.path] = msg
+            self.total_bytes += msg.length
+        self.mbx.entries = []
+        bare_maildir.add_listener(self.update)
+        log.info('Retention on {}: {} messages {} bytes'.format(
+            dirname, len(self._live), self.total_bytes))
+        self._schedule(self.interval)
+
+    def update(self, event, dirname, msg):
+        """Follow deliveries and deletions made by the handlers."""
+        if dirname != self._key:
+            return
+        if event == 'add':
+            self._queue.append(msg)
+            self._live[msg.path] = msg
+            self.total_bytes += msg.length
+        elif event == 'remove':
+            self._forget(msg)
+
+    def _forget(self, msg):
+        if self._live.pop(msg.path, None) is not None:
+            self.total_bytes -= msg.length
+
+    def _expired(self, msg, now):
+        """Return True if the oldest message msg breaks the policy."""
+        if self.max_count is not None and len(self._live) > self.max_count:
+            return True
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            return True
+        if self.max_age is not None and now - msg.mtime > self.max_age:
+            return True
+        return False
+
+    def _schedule(self, delay):
+        self._timer = bare_sched.call_later(delay, self.sweep)
+
+    def sweep(self):
+        """Unlink up to one batch of expired messages, oldest first."""
+        if self._timer is not None:
+            # when called other than by the timer
+            self._timer.cancel()
+            self._timer = None
+        start = time.time()
+        batch = []
+        backlog = False
+        while self._queue:
+            msg = self._queue[0]
+            if msg.path not in self._live:
+                # deleted by a client since it was queued
+                self._queue.popleft()
+                continue
+            if not self._expired(msg, start):
+                break
+            if len(batch) >= self.batch:
+                backlog = True
+                break
+            self._queue.popleft()
+            msg.delete = True
+            batch.append(msg)
+            self._forget(msg)
+            self.expired += 1
+            self.bytes_freed += msg.length
+        if not batch:
+            self.swept(start, 0, backlog)
+            return
+        # the mailbox lists only the batch, which close() unlinks
+        self.mbx.entries = batch
+        bare_io.close(self.mbx, _swept(self, start, len(batch), backlog).done)
+
+    def swept(self, start, removed, backlog):
+        """Account for a finished sweep and schedule the next."""
+        elapsed = time.time() - start
+        self.sweeps += 1
+        self.last_sweep = elapsed
+        self.total_sweep += elapsed
+        if elapsed > self.max_sweep:
+            self.max_sweep = elapsed
+        if removed:
+            log.info('Expired {} messages in {:.3f}s'.format(removed, elapsed))
+        if self._closed:
+            return
+        if backlog:
+            self._schedule(self.batch / self.rate)
+        else:
+            self._schedule(self.interval)
+
+    def stats(self):
+        """Return the sweeper metrics as a dictionary."""
+        return dict(messages=len(self._live), bytes=self.total_bytes,
+                    sweeps=self.sweeps, expired=self.expired,
+                    bytes_freed=self.bytes_freed,
+                    last_sweep=self.last_sweep, max_sweep=self.max_sweep,
+                    total_sweep=self.total_sweep)
+
+    def close(self):
+        """Stop sweeping."""
+        self._closed = True
+        if self._timer is not None:
+            self._timer.cancel()
+        bare_maildir.remove_listener(self.update)
@@ -0,0 +1,219 @@
+"""BareMail timers
+
+asyncore has no notion of time.  This module keeps a heap of timed
+callbacks and runs them between passes of the asyncore loop so background
+work such as spool expiry can share the single server thread with the
+protocol handlers.
+
+Worker threads hand results back to the loop with call_soon_threadsafe(),
+which wakes the loop through a pipe.
+
+Session timeouts, which are many and mostly pushed back before they are
+due, are kept in a timer wheel rather than the heap.  See watch().
+"""
+
+import asyncore
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import time
+
+# create logger
+log = logging.getLogger('baremail.sched')
+
+# Longest time the loop waits in select() when no timer is due sooner.
+MAX_WAIT = 1.0
+
+_timers = []
+_seq = itertools.count()
+
+# Calls queued by other threads and the pipe that wakes the loop for them.
+_ready = collections.deque()
+_waker = None
+
+class timer:
+    """A pending call created by call_later()."""
+    def __init__(self, when, func, args):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Prevent the call from running.  The entry is dropped when due."""
+        self.cancelled = True
+
+def call_later(delay, func, *args):
+    """Arrange for func(*args) to be called after delay seconds."""
+    t = timer(time.time() + delay, func, args)
+    heapq.heappush(_timers, (t.when, next(_seq), t))
+    return t
+
+class timer_wheel:
+    """Coarse deadlines for many objects.
+
+    An object with a "deadline" attribute, a time or None, and a
+    timed_out() method is kept in the slot of the wheel for its deadline,
+    tick seconds wide.  A single heap timer turns the wheel once per tick
+    and checks only the slot that has come due, so neither watching an
+    object nor moving its deadline costs more than a constant.  Deadlines
+    are usually moved later by setting the attribute alone.  The object is
+    then moved to its new slot when the old one comes due.
+    """
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = []
+        for i in range(slots):
+            self.slots.append(set())
+        self.current = int(time.time() / tick)
+        self.timer = call_later(tick, self.turn)
+
+    def _slot(self, deadline):
+        # never behind the slot being checked, so nothing is skipped
+        n = max(int(deadline / self.tick), self.current + 1)
+        return self.slots[n % len(self.slots)]
+
+    def watch(self, obj):
+        obj.wheel_slot = self._slot(obj.deadline)
+        obj.wheel_slot.add(obj)
+
+    def unwatch(self, obj):
+        slot = getattr(obj, 'wheel_slot', None)
+        if slot is not None:
+            slot.discard(obj)
+            obj.wheel_slot = None
+
+    def turn(self):
+        """Check the slots due since the last turn."""
+        now = time.time()
+        self.timer = call_later(self.tick, self.turn)
+        due = int(now / self.tick)
+        # after a long stall one pass over the wheel checks every slot
+        self.current = max(self.current, due - len(self.slots))
+        while self.current < due:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            for obj in list(slot):
+                if obj.deadline is None:
+                    self.unwatch(obj)
+                elif obj.deadline > now:
+                    slot.discard(obj)
+                    self.watch(obj)
+                else:
+                    self.unwatch(obj)
+                    try:
+                        obj.timed_out()
+                    except Exception:
+                        log.exception('timeout of {} failed'.format(obj))
+
+    def __len__(self):
+        count = 0
+        for slot in self.slots:
+            count += len(slot)
+        return count
+
+# The wheel shared by every session.  Created by watch().
+_wheel = None
+
+def watch(obj):
+    """Call obj.timed_out() once time passes obj.deadline.
+
+    The deadline may be moved by setting it, or cleared with None, at any
+    time without calling watch() again.  The call comes up to a second
+    late.  timed_out() may set a new deadline and call watch() again.
+    """
+    global _wheel
+    if _wheel is None:
+        _wheel = timer_wheel()
+    _wheel.watch(obj)
+
+def unwatch(obj):
+    """Stop watching obj."""
+    if _wheel is not None:
+        _wheel.unwatch(obj)
+
+class waker(asyncore.file_dispatcher):
+    """Read end of the pipe written by call_soon_threadsafe()."""
+    def __init__(self):
+        rfd, self.wfd = os.pipe()
+        for fd in (rfd, self.wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, rfd)
+        os.close(rfd)
+
+    def writable(self):
+        return False
+
+    def wake(self):
+        try:
+            os.write(self.wfd, 'x')
+        except OSError as e:
+            # a full pipe already has a wakeup pending
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except (OSError, IOError):
+            pass
+        run_ready()
+
+def enable_wakeup():
+    """Create the wakeup pipe.  Call from the loop thread before starting
+    threads that use call_soon_threadsafe().
+    """
+    global _waker
+    if _waker is None:
+        _waker = waker()
+
+def call_soon_threadsafe(func, *args):
+    """Arrange for func(*args) to be called from the loop thread.  May be
+    called from any thread once enable_wakeup() has run.
+    """
+    _ready.append((func, args))
+    _waker.wake()
+
+def run_ready():
+    """Run the calls queued by other threads."""
+    while _ready:
+        func, args = _ready.popleft()
+        try:
+            func(*args)
+        except Exception:
+            log.exception('callback {} failed'.format(func))
+
+def next_wait():
+    """Return the time to wait before the next timer is due."""
+    if not _timers:
+        return MAX_WAIT
+    return max(0.0, min(MAX_WAIT, _timers[0][0] - time.time()))
+
+def run_timers():
+    """Run every timer that is due."""
+    now = time.time()
+    while _timers and _timers[0][0] <= now:
+        t = heapq.heappop(_timers)[2]
+        if t.cancelled:
+            continue
+        try:
+            t.func(*t.args)
+        except Exception:
+            log.exception('timer callback {} failed'.format(t.func))
+
+def loop():
+    """Run the asyncore loop and the timers until neither has work left."""
+    # timers set up during configuration run before any client is served
+    run_timers()
+    while asyncore.socket_map or _timers:
+        wait = next_wait()
+        if asyncore.socket_map:
+            asyncore.loop(timeout=wait, count=1)
+        else:
+            time.sleep(wait)
+        run_timers()
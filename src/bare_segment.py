@@ -0,0 +1,472 @@
+"""BareMail segment store
+
+An alternative to the one-file-per-message maildir for small, high rate
+messages.  Messages are appended to large segment files and located through
+an append-only index file, so a delivery costs two appends and no new inode,
+and the index is read once when the store is opened.
+
+Directory layout::
+
+    <dirname>/index          A and D records, one per line
+    <dirname>/seg.000001     message data, appended in delivery order
+
+An index record 'A <uid> <seg> <offset> <stored> <length> <mtime> <codec>'
+adds a message or moves it during compaction.  'D <uid>' is a tombstone
+written when a client deletes a message.  Segments and index are synced
+together in groups: after sync_batch appends or sync_delay seconds,
+whichever comes first.  A delivery is acknowledged once its group is
+synced: add_synced() calls back from the sync.  Sealed segments whose data is mostly deleted are
+compacted from the timer loop.
+
+Every session sharing a store in this process sees the same segment state.
+Each session keeps its own deletion marks, as with BareMaildir.
+
+A message being sent holds the memory map it is read from.  Maps are never
+closed while in use: a segment that grows or is compacted gets a new map,
+and the old one is released when its last reader finishes.  Compaction
+gives moved messages new records, so a record never changes under a
+reader.
+"""
+
+import bare_maildir
+import bare_sched
+import collections
+import errno
+import logging
+import mmap
+import os
+import os.path
+import time
+
+# create logger
+log = logging.getLogger('baremail.segment')
+
+# Segment settings.  These are replaced by configure() from the "segment"
+# object of the "storage" section of the configuration file.
+SEGMENT_SIZE = 64 * 1024 * 1024     # start a new segment beyond this size
+SYNC_BATCH = 64                     # appends per fsync group
+SYNC_DELAY = 0.05                   # longest wait before a group is synced
+COMPACT_INTERVAL = 60.0             # seconds between compaction passes
+COMPACT_RATIO = 0.5                 # dead fraction that triggers compaction
+
+# Open stores by absolute path.  Shared by every session of the process.
+_stores = {}
+
+def configure(cfgdict):
+    """Set segment options from the "segment" configuration dictionary."""
+    global SEGMENT_SIZE, SYNC_BATCH, SYNC_DELAY
+    global COMPACT_INTERVAL, COMPACT_RATIO
+
+    SEGMENT_SIZE = int(cfgdict.get('segment_size', SEGMENT_SIZE))
+    SYNC_BATCH = max(1, int(cfgdict.get('sync_batch', SYNC_BATCH)))
+    SYNC_DELAY = float(cfgdict.get('sync_delay', SYNC_DELAY))
+    COMPACT_INTERVAL = float(cfgdict.get('compact_interval', COMPACT_INTERVAL))
+    COMPACT_RATIO = float(cfgdict.get('compact_ratio', COMPACT_RATIO))
+
+def _seg_name(seg):
+    return 'seg.{:06d}'.format(seg)
+
+class _record():
+    """Location and size of one stored message."""
+    def __init__(self, uid, seg, offset, stored, length, mtime, codec):
+        self.uid = uid
+        self.seg = seg
+        self.offset = offset
+        self.stored = stored
+        self.length = length
+        self.mtime = mtime
+        self.codec = codec
+
+    def line(self):
+        return 'A {} {} {} {} {} {!r} {}\n'.format(
+            self.uid, self.seg, self.offset, self.stored, self.length,
+            self.mtime, self.codec or '-')
+
+class _store():
+    """Segment files, index and group commit state for one directory."""
+
+    def __init__(self, dirname):
+        self.path = dirname
+        self.records = collections.OrderedDict()
+        self.seg_live = {}          # segment number -> live stored bytes
+        self.seg_size = {}          # segment number -> bytes written
+        self.maps = {}              # segment number -> (mmap, mapped size)
+                                    # for new readers
+        self.index_lines = 0
+        self.pending = 0
+        self.sync_timer = None
+        self.waiters = []           # called once the pending group is synced
+        self.seq = 0
+        if not os.path.exists(dirname):
+            os.mkdir(dirname, 0o700)
+            log.debug('creating directory {}'.format(dirname))
+        self._load()
+        self.index = open(os.path.join(dirname, 'index'), 'ab')
+        self.seg = max(self.seg_size.keys() or [1])
+        self.writer = None
+        self._open_writer()
+        bare_sched.call_later(COMPACT_INTERVAL, self.compact)
+
+    def _load(self):
+        """Read the index and the segment sizes."""
+        for fname in os.listdir(self.path):
+            if fname.startswith('seg.'):
+                seg = int(fname[4:])
+                self.seg_size[seg] = os.path.getsize(
+                    os.path.join(self.path, fname))
+                self.seg_live[seg] = 0
+        try:
+            f = open(os.path.join(self.path, 'index'), 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        complete = 0
+        for line in f:
+            self.index_lines += 1
+            fields = line.split()
+            if not line.endswith('\n'):
+                log.warning('dropping torn index record {!r}'.format(line))
+                self.index_lines -= 1
+                break
+            complete += len(line)
+            if not fields:
+                continue
+            if fields[0] == 'A' and len(fields) == 8:
+                codec = fields[7]
+                if codec == '-':
+                    codec = None
+                rec = _record(fields[1], int(fields[2]), int(fields[3]),
+                              int(fields[4]), int(fields[5]),
+                              float(fields[6]), codec)
+                if rec.seg not in self.seg_size or \
+                   rec.offset + rec.stored > self.seg_size[rec.seg]:
+                    log.warning('ignoring unsynced message {}'.format(rec.uid))
+                    continue
+                self._drop(rec.uid)
+                self.records[rec.uid] = rec
+                self.seg_live[rec.seg] += rec.stored
+            elif fields[0] == 'D' and len(fields) == 2:
+                self._drop(fields[1])
+        f.close()
+        if complete < os.path.getsize(os.path.join(self.path, 'index')):
+            # the next record must not be appended to the torn fragment
+            f = open(os.path.join(self.path, 'index'), 'r+b')
+            f.truncate(complete)
+            bare_maildir._sync_close(f)
+
+    def _drop(self, uid):
+        rec = self.records.pop(uid, None)
+        if rec is not None:
+            self.seg_live[rec.seg] -= rec.stored
+        return rec
+
+    def _open_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = open(os.path.join(self.path, _seg_name(self.seg)), 'ab')
+        self.seg_size.setdefault(self.seg, 0)
+        self.seg_live.setdefault(self.seg, 0)
+
+    def _append(self, data):
+        """Append data to the current segment and return (seg, offset)."""
+        if self.seg_size[self.seg] and \
+           self.seg_size[self.seg] + len(data) > SEGMENT_SIZE:
+            self.sync()
+            self.seg += 1
+            self._open_writer()
+        offset = self.seg_size[self.seg]
+        self.writer.write(data)
+        self.writer.flush()
+        self.seg_size[self.seg] += len(data)
+        return self.seg, offset
+
+    def _log(self, line):
+        self.index.write(line)
+        self.index.flush()
+        self.index_lines += 1
+        self.pending += 1
+        if self.pending >= SYNC_BATCH:
+            self.sync()
+        elif self.sync_timer is None:
+            self.sync_timer = bare_sched.call_later(SYNC_DELAY, self.sync)
+
+    def add(self, msg_str, codec, level):
+        """Store msg_str and return its record."""
+        if codec:
+            comp = bare_maildir._compressor(codec, level)
+            data = comp.compress(msg_str) + comp.flush()
+        else:
+            data = msg_str
+        self.seq += 1
+        uid = '{}.{}'.format(int(time.time() * 1000), self.seq)
+        seg, offset = self._append(data)
+        rec = _record(uid, seg, offset, len(data), len(msg_str),
+                      time.time(), codec)
+        self.records[uid] = rec
+        self.seg_live[seg] += rec.stored
+        self._log(rec.line())
+        return rec
+
+    def remove(self, uid):
+        """Write a tombstone for uid.  Returns the dropped record or None."""
+        rec = self._drop(uid)
+        if rec is not None:
+            self._log('D {}\n'.format(uid))
+        return rec
+
+    def when_synced(self, waiter):
+        """Call waiter(error) once every append so far is durable."""
+        if not self.pending:
+            waiter(None)
+        else:
+            self.waiters.append(waiter)
+
+    def sync(self):
+        """Make every append so far durable, then call the waiters."""
+        if self.sync_timer is not None:
+            self.sync_timer.cancel()
+            self.sync_timer = None
+        if not self.pending:
+            return
+        waiters = self.waiters
+        self.waiters = []
+        try:
+            bare_maildir._sync_flush(self.writer)
+            bare_maildir._sync_flush(self.index)
+        except Exception as e:
+            for waiter in waiters:
+                waiter(e)
+            raise
+        log.debug('synced {} records'.format(self.pending))
+        self.pending = 0
+        for waiter in waiters:
+            waiter(None)
+
+    def view(self, rec, size):
+        """Return an iterator over slices of the stored data of rec."""
+        end = rec.offset + rec.stored
+        if not rec.stored:
+            return iter(())
+        entry = self.maps.get(rec.seg)
+        if entry is None or entry[1] < end:
+            # readers of the old map keep it until they finish
+            f = open(os.path.join(self.path, _seg_name(rec.seg)), 'rb')
+            mapped = os.fstat(f.fileno()).st_size
+            entry = (mmap.mmap(f.fileno(), mapped, access=mmap.ACCESS_READ),
+                     mapped)
+            f.close()
+            self.maps[rec.seg] = entry
+        return _slices(entry[0], rec.offset, end, size)
+
+    def _unmap(self, seg):
+        """Stop handing out the map of seg.  It is closed when the last
+        reader drops it, and stays readable after the file is unlinked.
+        """
+        self.maps.pop(seg, None)
+
+    def compact(self):
+        """Rewrite sparse sealed segments and the index.
+
+        Live messages of a sealed segment whose dead fraction passes
+        COMPACT_RATIO are appended to the current segment, the new
+        locations are synced and then the old segment is removed.
+        """
+        bare_sched.call_later(COMPACT_INTERVAL, self.compact)
+        start = time.time()
+        for seg in sorted(self.seg_size.keys()):
+            if seg == self.seg:
+                continue
+            size = self.seg_size[seg]
+            if size and self.seg_live[seg] > size * (1 - COMPACT_RATIO):
+                continue
+            moved = 0
+            for old in self.records.values():
+                if old.seg != seg:
+                    continue
+                data = ''.join(self.view(old, bare_maildir.CHUNK_SIZE))
+                new_seg, offset = self._append(data)
+                rec = _record(old.uid, new_seg, offset, old.stored,
+                              old.length, old.mtime, old.codec)
+                self.records[rec.uid] = rec
+                self.seg_live[rec.seg] += rec.stored
+                self.index.write(rec.line())
+                self.index_lines += 1
+                self.pending += 1
+                moved += 1
+            # the new locations must be on disk before the old segment goes
+            self.sync()
+            self._unmap(seg)
+            os.unlink(os.path.join(self.path, _seg_name(seg)))
+            del self.seg_size[seg]
+            del self.seg_live[seg]
+            log.info('Compacted {}: moved {} messages in {:.3f}s'.format(
+                _seg_name(seg), moved, time.time() - start))
+        if self.index_lines > 2 * len(self.records) + 1000:
+            self._rewrite_index()
+
+    def _rewrite_index(self):
+        """Replace the index with one holding only the live records."""
+        self.sync()
+        name = os.path.join(self.path, 'index')
+        f = open(name + '.new', 'wb')
+        for rec in self.records.values():
+            f.write(rec.line())
+        bare_maildir._sync_close(f)
+        os.rename(name + '.new', name)
+        self.index.close()
+        self.index = open(name, 'ab')
+        self.index_lines = len(self.records)
+        log.info('Rewrote index with {} records'.format(self.index_lines))
+
+def _slices(buf, start, end, size):
+    for pos in xrange(start, end, size):
+        yield buf[pos:min(pos + size, end)]
+
+def _open_store(dirname):
+    key = os.path.abspath(dirname)
+    store = _stores.get(key)
+    if store is None:
+        store = _store(dirname)
+        _stores[key] = store
+    return store
+
+class SegmentMessage():
+    """A session's view of one stored message."""
+    def __init__(self, store, rec):
+        self.delete = False
+        self.rec = rec
+        self.basename = rec.uid
+        self.path = os.path.join(store.path, rec.uid)
+        self.length = rec.length
+        self.mtime = rec.mtime
+
+class _synced():
+    """Completion of BareSegmentStore.add_synced()."""
+    def __init__(self, key, callback):
+        self.key = key
+        self.callback = callback
+
+    def done(self, error):
+        if error is not None:
+            self.callback(None, error)
+        else:
+            self.callback(self.key, None)
+
+class BareSegmentStore():
+    """A mailbox kept in append-only segment files.
+
+    Offers the same methods as BareMaildir so the handlers can use
+    either backend.
+    """
+
+    def __init__(self, dirname, listing=True):
+        """Open the store and list its messages, oldest first.
+
+        With listing False no messages are listed, not even those added,
+        for callers that only add messages.
+        """
+        self._store = _open_store(dirname)
+        self._key = os.path.abspath(dirname)
+        self.generation = bare_maildir.generation(self._key)
+        self.entries = []
+        self.listing = listing
+        # only the server changes a store, which the generation follows
+        self.stamp = None
+        if listing:
+            for rec in self._store.records.values():
+                self.entries.append(SegmentMessage(self._store, rec))
+
+    def add(self, msg_str):
+        """Add message string and return assigned key."""
+        rec = self._store.add(msg_str, bare_maildir.COMPRESSION,
+                              bare_maildir.COMPRESS_LEVEL)
+        msg = SegmentMessage(self._store, rec)
+        if self.listing:
+            self.entries.append(msg)
+        bare_maildir._notify('add', self._key, msg)
+        return rec.uid
+
+    def add_synced(self, msg_str, callback, now=False):
+        """Add message string and call callback(key, error) once it is
+        synced with its group, or at once if now is true.
+        """
+        try:
+            key = self.add(msg_str)
+        except Exception as e:
+            log.exception('error adding message to {}'.format(self._key))
+            callback(None, e)
+            return
+        self._store.when_synced(_synced(key, callback).done)
+        if now:
+            self._store.sync()
+
+    def add_many(self, msg_list):
+        """Add a list of message strings and sync them as one group."""
+        keys = []
+        for msg_str in msg_list:
+            keys.append(self.add(msg_str))
+        self._store.sync()
+        return keys
+
+    def items(self):
+        return self.entries
+
+    def delete(self, msg_num):
+        self.entries[msg_num].delete = True
+
+    def open_message(self, msg_num, size=bare_maildir.CHUNK_SIZE):
+        """Return an iterator over the message text in blocks of up to size.
+
+        The blocks are slices of a memory map of the segment.
+        """
+        return self.open_entry(self.entries[msg_num], size)
+
+    def open_entry(self, msg, size=bare_maildir.CHUNK_SIZE):
+        """Return an iterator over the text of message msg.
+
+        The message is read from where it is now, which compaction may
+        have changed since it was listed.
+        """
+        rec = self._store.records.get(msg.rec.uid)
+        if rec is None:
+            raise KeyError('message {} was removed'.format(msg.rec.uid))
+        blocks = self._store.view(rec, size)
+        if rec.codec:
+            return _decompress(blocks, rec.codec)
+        return blocks
+
+    def lookup(self, path):
+        """Return the message stored at path without listing the store."""
+        rec = self._store.records.get(os.path.basename(path))
+        if rec is None:
+            raise KeyError('message {} was removed'.format(path))
+        return SegmentMessage(self._store, rec)
+
+    def get_string(self, msg_num):
+        return ''.join(self.open_message(msg_num))
+
+    def reset(self):
+        for m in self.entries:
+            m.delete = False
+
+    def close(self):
+        for m in self.entries:
+            if m.delete:
+                self.discard(m)
+
+    def discard(self, msg):
+        """Write a tombstone for message msg."""
+        if self._store.remove(msg.basename) is not None:
+            bare_maildir._notify('remove', self._key, msg)
+
+def _decompress(blocks, codec):
+    decomp = bare_maildir._decompressor(codec)
+    for block in blocks:
+        block = decomp.decompress(block)
+        if block:
+            yield block
+    if hasattr(decomp, 'flush'):
+        block = decomp.flush()
+        if block:
+            yield block
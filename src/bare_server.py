@@ -0,0 +1,73 @@
+"""BareMail protocol server helpers
+
+Code shared by the SMTP, POP3, IMAP and HTTP servers: the parsing of
+command lines and the opening and closing of listening sockets.
+"""
+
+import asyncore
+import errno
+import logging
+import os
+import socket
+import stat
+
+# create logger
+log = logging.getLogger('baremail.server')
+
+def parse_command(line, commands):
+    """Split a command line into (command, arguments).
+
+    Clients send the command in capitals followed by a single space,
+    which is tried before the general split.
+    """
+    pos = line.find(' ')
+    if pos < 0:
+        cmd = line
+        args = ''
+    else:
+        cmd = line[:pos]
+        args = line[pos + 1:]
+    if cmd in commands and not args[:1].isspace():
+        return cmd, args
+    command = line.split(None, 1)
+    if not command:
+        return '', ''
+    if len(command) > 1:
+        return command[0].upper(), command[1]
+    return command[0].upper(), ''
+
+def listen_on(server, address, protocol):
+    """Open the listening socket of asyncore dispatcher server.
+
+    address is a (host, port) pair or the path of a Unix domain socket.
+    A socket file left at the path by an earlier run is replaced.  The
+    server's close() should call unlisten() to remove it again.
+    """
+    server.socket_path = None
+    if isinstance(address, basestring):
+        log.info('Serving {} on {}'.format(protocol, address))
+        if os.path.exists(address) and \
+           stat.S_ISSOCK(os.stat(address).st_mode):
+            os.unlink(address)
+        server.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(address)
+        server.socket_path = address
+    else:
+        log.info('Serving {} on {}:{}'.format(protocol, *address))
+        server.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.set_reuse_addr()
+        server.bind(address)
+    server.listen(5)
+
+def unlisten(server):
+    """Close a server opened by listen_on() and remove its socket file."""
+    asyncore.dispatcher.close(server)
+    path = server.socket_path
+    server.socket_path = None
+    if path is None:
+        return
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            log.warning('Unable to remove socket {} - {}'.format(path, e))
@@ -0,0 +1,55 @@
+"""BareMail metrics
+
+The disk I/O pool, the reaper, the retention sweeper, the header index,
+the filters, the digest stage, the relay, replication, the watchdog and
+the POP3 listing cache each keep metrics, returned as a dictionary by
+their stats() method.  A BareStats gathers them under one name each.  The
+HTTP server answers GET /stats with them, and with an interval they are
+also logged as one line of JSON per interval.
+"""
+
+import bare_sched
+import json
+import logging
+import time
+
+# create logger
+log = logging.getLogger('baremail.stats')
+
+class BareStats():
+    """Collect the metrics of the parts of the server."""
+
+    def __init__(self, cfgdict):
+        """cfgdict may give "interval", the seconds between metrics logged.
+        Without it the metrics are only served over HTTP.
+        """
+        self.interval = cfgdict.get('interval')
+        self.sources = {}
+        self.started = time.time()
+        self._timer = None
+        if self.interval is not None:
+            self.interval = float(self.interval)
+            self._timer = bare_sched.call_later(self.interval, self.log)
+
+    def add(self, name, source):
+        """Report the stats() of source under name."""
+        self.sources[name] = source
+
+    def report(self):
+        """Return the metrics of every source, by name."""
+        result = {'uptime': time.time() - self.started}
+        for name, source in self.sources.items():
+            try:
+                result[name] = source.stats()
+            except Exception:
+                log.exception('error reading the {} metrics'.format(name))
+        return result
+
+    def log(self):
+        self._timer = bare_sched.call_later(self.interval, self.log)
+        log.info(json.dumps(self.report(), sort_keys=True))
+
+    def close(self):
+        """Stop logging the metrics."""
+        if self._timer is not None:
+            self._timer.cancel()
@@ -0,0 +1,234 @@
+"""BareMail loop watchdog and profiler
+
+Every session shares the one server thread, so a handler that runs too
+long holds up every client.  The watchdog thread measures how long the
+loop takes to run a call handed to it with call_soon_threadsafe().  That
+lag is near zero while the loop is idle or only waiting on sockets.  When
+it passes the threshold, the watchdog takes a sample of the loop thread's
+stack and logs it with the handler that was running: its class, the
+address of its client and the command being served.
+
+Sending the server SIGUSR1 profiles the loop thread for a number of
+seconds.  The report, written to the reports directory, lists the
+functions by cumulative and by own time, followed by a census of the
+objects the garbage collector tracks, by type, with the change in each
+count over the profile.  The raw profile is written alongside it for
+pstats.
+"""
+
+import asyncore
+import bare_sched
+import cProfile
+import gc
+import logging
+import os
+import pstats
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import types
+
+# create logger
+log = logging.getLogger('baremail.watchdog')
+
+def census():
+    """Return {type name: [count, bytes]} for the objects gc tracks.
+
+    Only containers are tracked, so strings are left out.  Instances of
+    old style classes are counted by their class.  Sizes are shallow.
+    """
+    counts = {}
+    for obj in gc.get_objects():
+        cls = type(obj)
+        if cls is types.InstanceType:
+            cls = obj.__class__
+        name = '{}.{}'.format(cls.__module__, cls.__name__)
+        entry = counts.get(name)
+        if entry is None:
+            entry = [0, 0]
+            counts[name] = entry
+        entry[0] += 1
+        entry[1] += sys.getsizeof(obj, 0)
+    return counts
+
+def _by_count(item):
+    return item[1][0]
+
+def _describe(frame):
+    """Name what the loop thread is running in frame and its callers.
+
+    The innermost asyncore dispatcher on the stack is the session or
+    server, and a local called cmd the command it is serving.  Outside of
+    any dispatcher, the timer or threaded callback is named.
+    """
+    handler = None
+    cmd = None
+    callback = None
+    inner = None
+    f = frame
+    while f is not None:
+        local = f.f_locals
+        obj = local.get('self')
+        if handler is None and isinstance(obj, asyncore.dispatcher):
+            handler = obj
+        if cmd is None and isinstance(local.get('cmd'), basestring):
+            cmd = local['cmd']
+        if callback is None and inner is not None and \
+           f.f_globals.get('__name__') == 'bare_sched' and \
+           f.f_code.co_name in ('run_timers', 'run_ready'):
+            callback = inner.f_code.co_name
+            obj = inner.f_locals.get('self')
+            if obj is not None:
+                callback = '{}.{}'.format(obj.__class__.__name__, callback)
+        inner = f
+        f = f.f_back
+    if handler is not None:
+        return '{} {} {}'.format(handler.__class__.__name__,
+                                 getattr(handler, 'addr', None), cmd or '-')
+    if callback is not None:
+        return 'callback {}'.format(callback)
+    return 'loop'
+
+class BareWatchdog():
+    """Watch the loop thread for stalls and profile it on SIGUSR1."""
+
+    def __init__(self, cfgdict):
+        """cfgdict may give "interval", seconds between lag checks,
+        "threshold", the lag in seconds logged as a stall, "profile", the
+        seconds a profile runs, "reports", the directory reports are
+        written to, and "top", the lines of each report section.
+        """
+        self.interval = float(cfgdict.get('interval', 1.0))
+        self.threshold = float(cfgdict.get('threshold', 0.5))
+        self.profile_time = float(cfgdict.get('profile', 30))
+        self.reports = cfgdict.get('reports', tempfile.gettempdir())
+        self.top = int(cfgdict.get('top', 40))
+        self.thread = None
+        self.ident = None
+        self.answered = threading.Event()
+        self.stopped = False
+        self.profiler = None
+        self.before = None
+        bare_sched.enable_wakeup()
+        signal.signal(signal.SIGUSR1, self.signalled)
+        # the loop is not running yet, so checks start with it
+        bare_sched.call_later(0, self.start)
+
+        # watchdog metrics
+        self.checks = 0
+        self.lag = 0.0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.profiles = 0
+        log.info('Loop watchdog: stalls over {}s logged'.format(
+            self.threshold))
+
+    def start(self):
+        """Start the watchdog thread.  Runs in the loop thread."""
+        self.ident = threading.current_thread().ident
+        self.thread = threading.Thread(target=self.run,
+                                       name='baremail-watchdog')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """Check the loop once per interval.  Runs in the watchdog thread."""
+        while not self.stopped:
+            self.answered.clear()
+            bare_sched.call_soon_threadsafe(self.answer, time.time())
+            if not self.answered.wait(self.threshold):
+                self.stalled()
+                while not self.stopped and not self.answered.wait(1.0):
+                    pass
+            time.sleep(self.interval)
+
+    def stalled(self):
+        """Log what the loop thread is stuck in."""
+        frame = sys._current_frames().get(self.ident)
+        if frame is None:
+            return
+        log.warning('Loop stalled over {}s in {}\n{}'.format(
+            self.threshold, _describe(frame),
+            ''.join(traceback.format_stack(frame))))
+
+    def answer(self, sent):
+        """The loop reached a check.  Runs in the loop thread."""
+        lag = time.time() - sent
+        self.checks += 1
+        self.lag = lag
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+        if lag >= self.threshold:
+            self.stalls += 1
+            log.warning('Loop stalled for {:.3f}s'.format(lag))
+        self.answered.set()
+
+    def signalled(self, signum, frame):
+        bare_sched.call_soon_threadsafe(self.profile)
+
+    def profile(self):
+        """Profile the loop thread for the configured time."""
+        if self.profiler is not None:
+            log.info('Profile already running')
+            return
+        log.info('Profiling the loop for {}s'.format(self.profile_time))
+        self.before = census()
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        bare_sched.call_later(self.profile_time, self.report)
+
+    def report(self):
+        """Stop the profile and write the report."""
+        self.profiler.disable()
+        name = os.path.join(self.reports, 'baremail-{}-{}'.format(
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        try:
+            self.profiler.dump_stats(name + '.prof')
+            f = open(name + '.txt', 'w')
+            try:
+                self.write_report(f)
+            finally:
+                f.close()
+            log.info('Profile written to {}.txt'.format(name))
+        except (IOError, OSError):
+            log.exception('Error writing profile {}'.format(name))
+        self.profiles += 1
+        self.profiler = None
+        self.before = None
+
+    def write_report(self, f):
+        stats = pstats.Stats(self.profiler, stream=f)
+        f.write('Loop profile of {}s\n\n'.format(self.profile_time))
+        stats.sort_stats('cumulative').print_stats(self.top)
+        stats.sort_stats('time').print_stats(self.top)
+        after = census()
+        f.write('Objects tracked by gc, by type\n\n')
+        f.write('{:>10} {:>10} {:>12}  {}\n'.format('count', 'change',
+                                                    'bytes', 'type'))
+        items = sorted(after.items(), key=_by_count, reverse=True)
+        for name, (count, size) in items[:self.top]:
+            change = count - self.before.get(name, (0, 0))[0]
+            f.write('{:>10} {:>+10} {:>12}  {}\n'.format(count, change,
+                                                         size, name))
+
+    def stats(self):
+        """Return the watchdog metrics as a dictionary.
+
+        lag is the time the loop took to reach the latest check.
+        """
+        mean = 0.0
+        if self.checks:
+            mean = self.total_lag / self.checks
+        return dict(checks=self.checks, lag=self.lag, mean_lag=mean,
+                    max_lag=self.max_lag, stalls=self.stalls,
+                    profiles=self.profiles)
+
+    def close(self):
+        self.stopped = True
+        if self.profiler is not None:
+            self.profiler.disable()
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
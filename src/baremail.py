@@ -12,7 +12,18 @@ accepting any user name and password as valid.
    should never be opened on an interface attached to any untrusted network.
 """
 
-import asyncore
+import bare_digest
+import bare_filter
+import bare_index
+import bare_io
+import bare_maildir
+import bare_reaper
+import bare_sched
+import bare_segment
+import bare_stats
+import bare_watchdog
+import baremail_relay
+import baremail_replica
 import json
 import logging
 import logging.config
@@ -20,6 +31,9 @@ import os
 import pwd
 import sys
 
+from bare_retention import BareSweeper
+from baremail_http import http_server
+from baremail_imap import imap_server
 from baremail_pop3 import pop3_server
 from baremail_smtp import smtp_server
 
@@ -41,23 +55,149 @@ def config_logging(cfgdict):
         return 1
     return 0
 
+def config_storage(cfgdict):
+    """Configure the mailbox storage options.
+
+    The optional "storage" object of the configuration file selects
+    the storage backend and compression of messages at rest.
+    """
+    try:
+        bare_maildir.configure(cfgdict)
+        bare_segment.configure(cfgdict.get('segment', {}))
+    except Exception as msg:
+        log.exception('storage configuration error - {}'.format(msg))
+        return 1
+    return 0
+
+def listen_address(cfgdict):
+    """Return the address a server listens on.
+
+    A server entry names either a "host" and "port" or the "path" of a
+    Unix domain socket.
+    """
+    if cfgdict.has_key('path'):
+        return cfgdict['path']
+    return (cfgdict['host'], cfgdict['port'])
+
+def config_socket(cfgdict):
+    """Apply the optional "mode" and "owner" of a Unix socket entry.
+
+    This runs before privileges are dropped so the socket can be given
+    to the user of the client daemons.
+    """
+    if not cfgdict.has_key('path'):
+        return
+    if cfgdict.has_key('mode'):
+        os.chmod(cfgdict['path'], int(str(cfgdict['mode']), 8))
+    if cfgdict.has_key('owner'):
+        pw_info = pwd.getpwnam(cfgdict['owner'])
+        os.chown(cfgdict['path'], pw_info[2], pw_info[3])
+
 def config_servers(cfgdict):
-    global server_list
+    """Open the sockets the servers listen on.
+
+    This runs before privileges are dropped so the servers may listen on
+    privileged ports.  Nothing here touches the maildir.  The parts that
+    create or read files under it are set up by config_services() as the
+    user the server runs as.
+    """
+    global server_list, stats, disk_io, http
 
     try: # instantiate servers
         server_list = []
-        server_list.append(pop3_server(cfgdict['POP3']['host'],
-                                       cfgdict['POP3']['port'],
-                                       cfgdict['maildir']))
-        for server in cfgdict['SMTP']:
-            server_list.append(smtp_server(server['host'],
-                                           server['port'],
+        http = None
+        stats = bare_stats.BareStats(cfgdict.get('stats', {}))
+        disk_io = bare_io.configure(cfgdict.get('disk_io', {}))
+        stats.add('disk_io', disk_io)
+        # a follower only takes the changes its leader sends
+        standby = baremail_replica.standby(cfgdict)
+        if not standby:
+            pop3 = pop3_server(listen_address(cfgdict['POP3']),
+                               cfgdict['maildir'],
+                               cfgdict['POP3'].get('timeouts'),
+                               cfgdict['POP3'].get('mailboxes'),
+                               cfgdict['POP3'].get('cache'))
+            server_list.append(pop3)
+            stats.add('pop3_cache', pop3.cache)
+            config_socket(cfgdict['POP3'])
+            for server in cfgdict['SMTP']:
+                server_list.append(smtp_server(listen_address(server),
+                                               cfgdict['maildir'],
+                                               server.get('timeouts')))
+                config_socket(server)
+        if cfgdict.has_key('IMAP') and not standby:
+            server_list.append(imap_server(listen_address(cfgdict['IMAP']),
                                            cfgdict['maildir']))
+            config_socket(cfgdict['IMAP'])
+        if cfgdict.has_key('HTTP'):
+            # given its index by config_services()
+            http = http_server(listen_address(cfgdict['HTTP']), None, stats)
+            server_list.append(http)
+            config_socket(cfgdict['HTTP'])
     except Exception as msg:
         log.exception('server initialization error - {}'.format(msg))
         return 1
     return 0
 
+def config_services(cfgdict):
+    """Start the parts of the server that keep files under the maildir.
+
+    This runs once privileges are dropped, and before the loop, so the
+    files they create belong to the user the server runs as and no client
+    is served before they are ready.
+    """
+    try:
+        standby = baremail_replica.standby(cfgdict)
+        if bare_maildir.BACKEND == 'maildir' and not standby:
+            # before anything lists the maildir, so messages left in purge
+            # files by a crash stay hidden
+            reaper = bare_reaper.BareReaper(cfgdict['maildir'],
+                                            cfgdict.get('purge', {}))
+            server_list.append(reaper)
+            stats.add('reaper', reaper)
+        if cfgdict.has_key('index') or cfgdict.has_key('HTTP'):
+            index = bare_index.BareIndex(cfgdict['maildir'],
+                                         cfgdict.get('index', {}))
+            server_list.append(index)
+            stats.add('index', index)
+            if http is not None:
+                http.index = index
+        if bare_maildir.BACKEND == 'maildir' and not standby:
+            server_list.append(bare_maildir.BareJournal(cfgdict['maildir']))
+        if cfgdict.has_key('retention') and not standby:
+            sweeper = BareSweeper(cfgdict['maildir'], cfgdict['retention'])
+            server_list.append(sweeper)
+            stats.add('retention', sweeper)
+        if cfgdict.has_key('filters'):
+            filters = bare_filter.configure(cfgdict['filters'],
+                                            cfgdict.get('filter_pool'))
+            server_list.append(filters)
+            stats.add('filters', filters)
+        if cfgdict.has_key('digest'):
+            digest = bare_digest.configure(cfgdict['digest'])
+            server_list.append(digest)
+            stats.add('digest', digest)
+        if cfgdict.has_key('relay') and not standby:
+            relay = baremail_relay.configure(cfgdict['relay'])
+            server_list.append(relay)
+            stats.add('relay', relay)
+        if cfgdict.has_key('replication'):
+            replica = baremail_replica.configure(cfgdict['replication'],
+                                                 cfgdict['maildir'])
+            server_list.append(replica)
+            stats.add('replication', replica)
+        if cfgdict.has_key('watchdog'):
+            watchdog = bare_watchdog.BareWatchdog(cfgdict['watchdog'])
+            server_list.append(watchdog)
+            stats.add('watchdog', watchdog)
+        server_list.append(stats)
+        # closed last so messages flushed at shutdown reach the disk
+        server_list.append(disk_io)
+    except Exception as msg:
+        log.exception('service initialization error - {}'.format(msg))
+        return 1
+    return 0
+
 
 def set_user(user):
     if os.getuid() == 0: # running as root, see if priv can be dropped
@@ -89,7 +229,7 @@ def run_server():
     """Run service loop"""
     try:
         log.info('starting loop')
-        asyncore.loop()
+        bare_sched.loop()
         log.info('exited loop!!')
     except KeyboardInterrupt:
         log.info('cleaning up')
@@ -135,6 +275,10 @@ if __name__ == '__main__':
     except Exception:
         log.exception('Error writing PID file')
 
+    if cfgdict.has_key('storage'):
+        if config_storage(cfgdict['storage']) != 0:
+            sys.exit(1)
+        log.info('storage configuration done')
     if cfgdict.has_key('servers'):
         if config_servers(cfgdict['servers']) != 0:
             sys.exit(1)
@@ -149,6 +293,11 @@ if __name__ == '__main__':
         if set_user(login_name) != 0:
             log.error('Error setting user')
             sys.exit(1)
-    log.info('user set, running server')
+    log.info('user set')
+    if cfgdict.has_key('servers'):
+        if config_services(cfgdict['servers']) != 0:
+            sys.exit(1)
+        log.info('service configuration done')
+    log.info('running server')
     sys.exit(run_server())
 
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""Export a BareMail mailbox as an mbox or NDJSON stream
+
+Every message of the mailbox is written, oldest first, to standard output
+or to a file.  Only the names and delivery times of the messages are held
+in memory.  Each message is streamed from disk as it is written.
+
+mbox output is in mboxrd form: each message follows a 'From ' line with
+its delivery time, a '>' is added to lines starting with '>'s and 'From ',
+and lines end in LF.  NDJSON output holds one JSON object per message with
+its "uid", its delivery "mtime" and its "message" text, or "base64" for a
+message that is not valid UTF-8.  With --gzip, or an output file name
+ending in .gz, the stream is gzip compressed.
+
+Compressed and deduplicated messages are written as they were delivered.
+Messages listed in a purge file, deleted by a client but not yet
+unlinked, are left out.
+The storage settings, and the maildir unless --maildir is given, are read
+from the configuration file given with -C or the BAREMAIL_CONFIG
+environment variable.
+
+Usage: baremail_export.py [-C config] [--maildir DIR] [--format mbox|ndjson]
+                          [--gzip] [-o FILE]
+"""
+
+import argparse
+import bare_maildir
+import baremail_sendmail
+import base64
+import errno
+import gzip
+import json
+import logging
+import os
+import os.path
+import re
+import sys
+import time
+
+# create logger
+log = logging.getLogger('baremail.export')
+
+FORMATS = ('mbox', 'ndjson')
+
+FROM_LINE = re.compile(r'^>*From ')
+
+def list_messages(dirname):
+    """Return (mtime, uid, path) for the messages of maildir dirname,
+    oldest first.  Messages deleted by clients but still awaiting the
+    reaper in a purge file are left out.
+    """
+    entries = []
+    purging = bare_maildir.purge_listed(dirname)
+    for path in bare_maildir.message_dirs(dirname):
+        top = path == dirname
+        for fname in os.listdir(path):
+            if top and (fname in bare_maildir.RESERVED or
+                        fname.startswith(bare_maildir.SHARD_PREFIX)):
+                continue
+            full = os.path.join(path, fname)
+            if full in purging:
+                continue
+            try:
+                mtime = bare_maildir._info_time(fname, os.stat(full).st_mtime)
+                entries.append((mtime, fname, full))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # removed since the directory was read
+    entries.sort()
+    return entries
+
+def messages(dirname):
+    """Yield (uid, mtime, blocks) for the messages of the mailbox in
+    dirname, oldest first.
+    """
+    if bare_maildir.BACKEND == 'segment':
+        mbx = bare_maildir.open_mailbox(dirname)
+        entries = []
+        for msg in mbx.items():
+            entries.append((msg.mtime, msg.basename, msg))
+        entries.sort()
+        for mtime, uid, msg in entries:
+            yield uid, mtime, mbx.open_entry(msg)
+        return
+    for mtime, uid, path in list_messages(dirname):
+        try:
+            f = open(path, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        length, codec, digest = bare_maildir._parse_info(uid)
+        yield uid, mtime, bare_maildir._iter_file(f, codec,
+                                                  bare_maildir.CHUNK_SIZE)
+
+def mbox_blocks(mtime, blocks):
+    """Yield a message as mboxrd text, a block at a time."""
+    yield 'From MAILER-DAEMON {}\n'.format(time.asctime(time.gmtime(mtime)))
+    rest = ''
+    for block in blocks:
+        lines = (rest + block).split('\n')
+        rest = lines.pop()
+        out = []
+        for line in lines:
+            line = line.rstrip('\r')
+            if FROM_LINE.match(line):
+                line = '>' + line
+            out.append(line + '\n')
+        yield ''.join(out)
+    rest = rest.rstrip('\r')
+    if FROM_LINE.match(rest):
+        rest = '>' + rest
+    if rest:
+        rest += '\n'
+    yield rest + '\n'
+
+def ndjson_record(uid, mtime, blocks):
+    """Return a message as one line of JSON."""
+    text = ''.join(blocks)
+    record = {'uid': uid, 'mtime': mtime}
+    try:
+        record['message'] = text.decode('utf-8')
+    except UnicodeDecodeError:
+        record['base64'] = base64.b64encode(text)
+    return json.dumps(record) + '\n'
+
+def export(dirname, out, fmt):
+    """Write the messages of dirname to out and return (count, bytes)."""
+    count = 0
+    size = 0
+    for uid, mtime, blocks in messages(dirname):
+        if fmt == 'ndjson':
+            data = ndjson_record(uid, mtime, blocks)
+            out.write(data)
+            size += len(data)
+        else:
+            for data in mbox_blocks(mtime, blocks):
+                out.write(data)
+                size += len(data)
+        count += 1
+    return count, size
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Export a BareMail mailbox as mbox or NDJSON')
+    parser.add_argument('-C', dest='config',
+                        default=os.environ.get('BAREMAIL_CONFIG'),
+                        help='BareMail configuration file')
+    parser.add_argument('--maildir', help='mailbox to export')
+    parser.add_argument('--format', choices=FORMATS, default='mbox')
+    parser.add_argument('--gzip', action='store_true',
+                        help='gzip the output')
+    parser.add_argument('-o', dest='output', default='-',
+                        help='output file (default standard output)')
+    opts = parser.parse_args()
+
+    maildir = opts.maildir
+    try:
+        if opts.config:
+            cfile = open(opts.config, 'r')
+            cfgdict = json.load(cfile)
+            cfile.close()
+            bare_maildir.configure(cfgdict.get('storage', {}))
+            if maildir is None:
+                maildir = baremail_sendmail.maildir_path(cfgdict)
+    except Exception as msg:
+        log.error('Configuration file error - {}'.format(msg))
+        sys.exit(2)
+    if maildir is None:
+        parser.error('give a configuration file or --maildir')
+
+    if opts.output == '-':
+        out = sys.stdout
+    else:
+        out = open(opts.output, 'wb')
+    raw = out
+    if opts.gzip or opts.output.endswith('.gz'):
+        out = gzip.GzipFile(fileobj=raw, mode='wb')
+    start = time.time()
+    try:
+        try:
+            count, size = export(maildir, out, opts.format)
+        finally:
+            if out is not raw:
+                out.close()
+            if raw is not sys.stdout:
+                raw.close()
+    except Exception as msg:
+        log.exception('Export failed - {}'.format(msg))
+        sys.exit(1)
+    elapsed = max(time.time() - start, 0.001)
+    log.info('Exported {} messages, {} bytes in {:.1f}s, {:.0f} msg/s'.format(
+        count, size, elapsed, count / elapsed))
+    sys.exit(0)
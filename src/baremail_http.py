@@ -0,0 +1,206 @@
+"""BareMail HTTP query server
+
+A read-only HTTP/JSON interface to the header index, for tools that need
+to find messages without downloading the whole mailbox over POP3.
+
+GET /messages
+    Messages matching the query parameters, newest first.  ``from`` and
+    ``subject`` match words of those headers (a word ending in '*' matches
+    as a prefix), ``q`` is a full text query on both, ``message_id``
+    matches exactly, ``since`` and ``until`` bound the delivery time in
+    seconds since the epoch and ``h.<Header>`` matches an extra indexed
+    header.  ``limit`` sets the page size.  The reply holds the
+    ``messages`` and a ``next`` cursor to pass as ``before`` for the
+    next page, or null on the last page.
+GET /messages/<uid>
+    The index entry of one message, with its extra headers.
+GET /messages/<uid>/raw
+    The message itself.
+GET /stats
+    The metrics of the server, as gathered by bare_stats.BareStats.
+
+The uid is the name POP3 UIDL reports for the message.
+"""
+
+import asynchat
+import asyncore
+import bare_server
+import json
+import logging
+import urllib
+import urlparse
+
+# create logger
+log = logging.getLogger('baremail.http')
+
+CRLF = '\r\n'
+
+# Longest request header accepted.
+MAX_REQUEST = 8192
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Request Entity Too Large',
+           500: 'Internal Server Error'}
+
+QUERY_PARAMS = {'from': 'sender', 'subject': 'subject', 'q': 'text',
+                'message_id': 'message_id', 'since': 'since',
+                'until': 'until', 'before': 'before', 'limit': 'limit'}
+
+class body_producer:
+    """Feed the blocks of a message to asynchat."""
+    def __init__(self, blocks):
+        self.blocks = blocks
+
+    def more(self):
+        if self.blocks is None:
+            return ''
+        for block in self.blocks:
+            return block
+        self.blocks = None
+        return ''
+
+class http_handler(asynchat.async_chat):
+    """Answer one HTTP request, then close."""
+
+    def __init__(self, sock, index, stats=None):
+        asynchat.async_chat.__init__(self, sock=sock)
+        self.index = index
+        self.stats = stats
+        self.set_terminator(CRLF + CRLF)
+        self.buffer = []
+        self.size = 0
+        self.answered = False
+
+    def collect_incoming_data(self, data):
+        if self.answered:
+            return
+        self.size += len(data)
+        if self.size > MAX_REQUEST:
+            self.respond(413, {'error': 'request too large'})
+            return
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        """Handle the request once its header is complete"""
+        if self.answered:
+            return
+        request = ''.join(self.buffer)
+        self.buffer = []
+        self.set_terminator(None)
+        line = request.split(CRLF, 1)[0]
+        log.debug('C: {}'.format(line))
+        try:
+            method, target, version = line.split()
+        except ValueError:
+            self.respond(400, {'error': 'bad request line'})
+            return
+        if method != 'GET':
+            self.respond(405, {'error': 'only GET is supported'})
+            return
+        try:
+            self.route(target)
+        except Exception as e:
+            log.exception('Error answering {}'.format(target))
+            self.respond(500, {'error': str(e)})
+
+    def route(self, target):
+        url = urlparse.urlsplit(target)
+        parts = url.path.strip('/').split('/')
+        if parts == ['stats'] and self.stats is not None:
+            self.respond(200, self.stats.report())
+        elif parts[0] != 'messages' or len(parts) > 3:
+            self.respond(404, {'error': 'not found'})
+        elif len(parts) == 1:
+            self.handleQuery(urlparse.parse_qsl(url.query))
+        elif len(parts) == 2:
+            self.handleEntry(urllib.unquote(parts[1]))
+        elif parts[2] == 'raw':
+            self.handleRaw(urllib.unquote(parts[1]))
+        else:
+            self.respond(404, {'error': 'not found'})
+
+    def handleQuery(self, params):
+        """Search the index"""
+        args = {}
+        headers = {}
+        for name, value in params:
+            if name.startswith('h.'):
+                headers[name[2:]] = value.decode('utf-8', 'replace')
+            elif name in QUERY_PARAMS:
+                args[QUERY_PARAMS[name]] = value.decode('utf-8', 'replace')
+            else:
+                self.respond(400, {'error': 'unknown parameter ' + name})
+                return
+        if headers:
+            args['headers'] = headers
+        try:
+            messages, next_cursor = self.index.query(**args)
+        except ValueError as e:
+            self.respond(400, {'error': str(e)})
+            return
+        self.respond(200, {'messages': messages, 'next': next_cursor})
+
+    def handleEntry(self, uid):
+        """Return the index entry of one message"""
+        entry = self.index.get(uid)
+        if entry is None:
+            self.respond(404, {'error': 'no message ' + uid})
+        else:
+            self.respond(200, entry)
+
+    def handleRaw(self, uid):
+        """Send the text of one message"""
+        try:
+            length, blocks = self.index.open(uid)
+        except (KeyError, IOError, OSError):
+            self.respond(404, {'error': 'no message ' + uid})
+            return
+        self.answered = True
+        self.push(self.header(200, 'message/rfc822', length))
+        self.push_with_producer(body_producer(blocks))
+        self.close_when_done()
+
+    def header(self, code, content_type, length):
+        return ('HTTP/1.0 {} {}' + CRLF +
+                'Content-Type: {}' + CRLF +
+                'Content-Length: {}' + CRLF +
+                'Connection: close' + CRLF + CRLF).format(
+                    code, REASONS[code], content_type, length)
+
+    def respond(self, code, result):
+        """Send result as JSON and close"""
+        self.answered = True
+        body = json.dumps(result)
+        log.debug('S: {} {} bytes'.format(code, len(body)))
+        self.push(self.header(code, 'application/json', len(body)) + body)
+        self.close_when_done()
+
+    def handle_close(self):
+        self.close()
+
+class http_server(asyncore.dispatcher):
+    """Listens on the HTTP port and launch HTTP handler on connection.
+    """
+    def __init__(self, address, index, stats=None):
+        """Listen on address, a (host, port) pair or a Unix socket path.
+
+        index is the bare_index.BareIndex the queries run against and
+        stats the bare_stats.BareStats served at /stats.
+        """
+        self.index = index
+        self.stats = stats
+        asyncore.dispatcher.__init__(self)
+        bare_server.listen_on(self, address, 'HTTP')
+
+    def handle_accept(self):
+        """Creates handler for each HTTP connection.
+        """
+        pair = self.accept()
+        if pair is not None:
+            sock, addr = pair
+            log.debug('Incoming HTTP connection from %s' % repr(addr))
+            http_handler(sock, self.index, self.stats)
+
+    def close(self):
+        """Stop listening and remove the socket file, if any."""
+        bare_server.unlisten(self)
@@ -0,0 +1,852 @@
+"""BareMail IMAP4 server
+
+Implements a minimal IMAP4rev1 server with IDLE (RFC 2177) over the same
+mailbox as the POP3 server.  As with POP3, any user name and password is
+accepted and the only mailbox is INBOX.
+
+Clients that IDLE are told about new messages as soon as they are
+committed to the mailbox, and about messages removed by other sessions or
+by expiry, so they do not need to poll.  Flags other than \\Deleted are kept
+for the length of the session only.
+
+SELECT, EXAMINE and STATUS list the mailbox on the disk I/O threads.
+Commands that arrive meanwhile are held and served once the listing is in.
+
+Supported commands: CAPABILITY, NOOP, LOGIN, LOGOUT, SELECT, EXAMINE, LIST,
+LSUB, STATUS, CHECK, FETCH, STORE, SEARCH, EXPUNGE, CLOSE, UID and IDLE.
+Literals sent by the client are not supported.
+"""
+
+import asynchat
+import asyncore
+import bare_io
+import bare_maildir
+import bare_server
+import email.parser
+import email.utils
+import logging
+import os
+import os.path
+import time
+
+# create logger
+log = logging.getLogger('baremail.imap')
+
+CRLF = '\r\n'
+
+CAPABILITIES = 'IMAP4rev1 IDLE'
+SYSTEM_FLAGS = {'\\SEEN': '\\Seen', '\\DELETED': '\\Deleted'}
+
+class _uid_map():
+    """The UIDs of the messages of one maildir.
+
+    UIDs are assigned per process.  UIDVALIDITY starts from the time of
+    the first SELECT, so clients discard UIDs from an earlier run.
+    """
+    def __init__(self):
+        self.validity = int(time.time())
+        self.next_uid = 1
+        self.uids = {}      # basename -> uid
+
+    def uid(self, basename):
+        """Return the UID of a message, assigning the next if it has none."""
+        uid = self.uids.get(basename)
+        if uid is None:
+            uid = self.next_uid
+            self.next_uid += 1
+            self.uids[basename] = uid
+        return uid
+
+    def number(self, entries):
+        """Return the UIDs of a listing, ascending in its order.
+
+        Messages not seen before get new UIDs in listing order.  One may
+        sort before messages that already have UIDs, as when a copy keeps
+        an older delivery time.  The listing is then renumbered under a new
+        UIDVALIDITY.  New numbers start above every UID given out, so they
+        never clash with those of sessions still selected.
+        """
+        last = 0
+        new = False
+        for entry in entries:
+            uid = self.uids.get(entry.basename)
+            if uid is None:
+                new = True
+            elif new or uid < last:
+                self.validity = max(self.validity + 1, int(time.time()))
+                self.uids = {}
+                log.info('UIDs out of order, new UIDVALIDITY {}'.format(
+                    self.validity))
+                break
+            else:
+                last = uid
+        uids = []
+        for entry in entries:
+            uids.append(self.uid(entry.basename))
+        return uids
+
+    def forget(self, basename):
+        self.uids.pop(basename, None)
+
+# _uid_map of each maildir, by absolute path
+_uid_maps = {}
+
+def _uid_map_for(key):
+    uid_map = _uid_maps.get(key)
+    if uid_map is None:
+        uid_map = _uid_map()
+        _uid_maps[key] = uid_map
+    return uid_map
+
+def _tokenize(text):
+    """Split an IMAP argument string into atoms, strings and lists.
+
+    Parenthesized lists become Python lists.  Bracketed sections such as
+    BODY[HEADER.FIELDS (SUBJECT)] are kept whole with the preceding atom.
+    """
+    stack = [[]]
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c == ' ':
+            i += 1
+        elif c == '(':
+            stack.append([])
+            i += 1
+        elif c == ')':
+            if len(stack) == 1:
+                raise ValueError('unbalanced )')
+            inner = stack.pop()
+            stack[-1].append(inner)
+            i += 1
+        elif c == '"':
+            j = i + 1
+            chars = []
+            while j < n and text[j] != '"':
+                if text[j] == '\\' and j + 1 < n:
+                    j += 1
+                chars.append(text[j])
+                j += 1
+            if j >= n:
+                raise ValueError('unterminated string')
+            stack[-1].append(''.join(chars))
+            i = j + 1
+        else:
+            j = i
+            depth = 0
+            while j < n:
+                if text[j] == '[':
+                    depth += 1
+                elif text[j] == ']':
+                    depth -= 1
+                elif depth == 0 and text[j] in ' ()':
+                    break
+                j += 1
+            stack[-1].append(text[i:j])
+            i = j
+    if len(stack) != 1:
+        raise ValueError('unbalanced (')
+    return stack[0]
+
+def _parse_set(text):
+    """Return a list of (low, high) ranges from an IMAP sequence set.
+
+    '*' is returned as None and stands for the largest number in use.
+    """
+    ranges = []
+    for part in text.split(','):
+        if ':' in part:
+            lo, hi = part.split(':', 1)
+        else:
+            lo = hi = part
+        if lo == '*':
+            lo = None
+        else:
+            lo = int(lo)
+        if hi == '*':
+            hi = None
+        else:
+            hi = int(hi)
+        ranges.append((lo, hi))
+    return ranges
+
+def _in_set(num, ranges, largest):
+    for lo, hi in ranges:
+        if lo is None:
+            lo = largest
+        if hi is None:
+            hi = largest
+        if lo > hi:
+            lo, hi = hi, lo
+        if lo <= num <= hi:
+            return True
+    return False
+
+def _quote(s):
+    """Return s as an IMAP string: NIL, a quoted string or a literal."""
+    if s is None:
+        return 'NIL'
+    if '\r' in s or '\n' in s or '"' in s or '\\' in s:
+        return '{{{}}}{}{}'.format(len(s), CRLF, s)
+    return '"{}"'.format(s)
+
+def _addresses(value):
+    if not value:
+        return 'NIL'
+    parts = []
+    for name, addr in email.utils.getaddresses([value]):
+        if '@' in addr:
+            mailbox, host = addr.split('@', 1)
+        else:
+            mailbox, host = addr, None
+        parts.append('({} NIL {} {})'.format(_quote(name or None),
+                                             _quote(mailbox or None),
+                                             _quote(host)))
+    return '({})'.format(''.join(parts))
+
+def _envelope(headers):
+    sender = headers.get('Sender') or headers.get('From')
+    reply_to = headers.get('Reply-To') or headers.get('From')
+    return '({} {} {} {} {} {} {} {} {} {})'.format(
+        _quote(headers.get('Date')), _quote(headers.get('Subject')),
+        _addresses(headers.get('From')), _addresses(sender),
+        _addresses(reply_to), _addresses(headers.get('To')),
+        _addresses(headers.get('Cc')), _addresses(headers.get('Bcc')),
+        _quote(headers.get('In-Reply-To')), _quote(headers.get('Message-ID')))
+
+def _split_message(text):
+    """Return (header, body) of a message, the header with its blank line."""
+    pos = text.find(CRLF + CRLF)
+    if pos < 0:
+        return text, ''
+    return text[:pos + 4], text[pos + 4:]
+
+def _header_fields(header, names, exclude):
+    """Return the header lines named in names, or all others if exclude."""
+    wanted = set()
+    for name in names:
+        wanted.add(name.upper())
+    lines = []
+    keep = False
+    for line in header.split(CRLF):
+        if not line:
+            continue
+        if line[0] in ' \t':
+            if keep:
+                lines.append(line)
+            continue
+        name = line.split(':', 1)[0].strip().upper()
+        keep = (name in wanted) != exclude
+        if keep:
+            lines.append(line)
+    lines.append('')
+    return CRLF.join(lines) + CRLF
+
+def _canonical_flags(flags):
+    result = []
+    for flag in flags:
+        result.append(SYSTEM_FLAGS.get(flag.upper(), flag))
+    return result
+
+class imap_message():
+    """A message as seen by one IMAP session."""
+    def __init__(self, entry, uid):
+        self.entry = entry
+        self.uid = uid
+        self.flags = set()
+
+class _listed():
+    """Completion of the mailbox listing for a command."""
+    def __init__(self, handler, func, tag, cmd, args):
+        self.handler = handler
+        self.func = func
+        self.tag = tag
+        self.cmd = cmd
+        self.args = args
+
+    def done(self, mbx, error):
+        self.handler.listed(self, mbx, error)
+
+class imap_handler(asynchat.async_chat):
+    """Service an individual IMAP4 connection.
+
+    A selected session follows the mailbox through the mailbox listeners.
+    Changes are reported at once while the client is in IDLE and with the
+    response to its next command otherwise.
+    """
+    STATE_AUTH = 0
+    STATE_SELECTED = 1
+    STATE_IDLE = 2
+
+    def __init__(self, sock, mb_name):
+        asynchat.async_chat.__init__(self, sock=sock)
+        self.dispatch = dict(CAPABILITY=self.handleCapability,
+                             NOOP=self.handleNoop, CHECK=self.handleNoop,
+                             LOGIN=self.handleLogin,
+                             AUTHENTICATE=self.handleNo,
+                             LOGOUT=self.handleLogout,
+                             SELECT=self.handleSelect,
+                             EXAMINE=self.handleSelect,
+                             LIST=self.handleList, LSUB=self.handleList,
+                             STATUS=self.handleStatus,
+                             FETCH=self.handleFetch, STORE=self.handleStore,
+                             SEARCH=self.handleSearch,
+                             EXPUNGE=self.handleExpunge,
+                             CLOSE=self.handleClose, UID=self.handleUid,
+                             IDLE=self.handleIdle)
+        self.set_terminator(CRLF)
+        self.buffer = []
+        self.mb_name = mb_name
+        self.key = os.path.abspath(mb_name)
+        self.uid_map = _uid_map_for(self.key)
+        self.state = self.STATE_AUTH
+        self.mbx = None
+        self.msgs = []
+        self.by_name = {}
+        self.readonly = False
+        self.pending = []
+        # command lines received while the mailbox is listed
+        self.opening = False
+        self.held = []
+        # following the mailbox, and the changes made while it is listed
+        self.listening = False
+        self.early = []
+        self.idle_tag = None
+        self.push('* OK [CAPABILITY {}] BareMail IMAP4 ready'.format(
+            CAPABILITIES))
+
+    def collect_incoming_data(self, data):
+        """Marshal data chunks into buffer
+        """
+        self.buffer.append(data)
+
+    def push(self, msg):
+        """Overrides base class for convenience
+
+        Every response to client ends in CRLF.  Adding it here
+        ensures consistency.
+        """
+        asynchat.async_chat.push(self, msg + CRLF)
+
+    def found_terminator(self):
+        """Process a client command
+
+        Each command line starts with a tag that is repeated in the
+        completion response.  While idling, only DONE is accepted.
+        """
+        line = ''.join(self.buffer)
+        self.buffer = []
+        if self.opening:
+            self.held.append(line)
+            return
+        log.debug('C: {}'.format(line))
+        if self.state == self.STATE_IDLE:
+            if line.strip().upper() == 'DONE':
+                self.state = self.STATE_SELECTED
+                self.push('{} OK IDLE terminated'.format(self.idle_tag))
+                self.idle_tag = None
+            else:
+                self.push('* BAD expected DONE')
+            return
+        parts = line.split(None, 2)
+        if len(parts) < 2:
+            self.push('* BAD missing command')
+            return
+        tag = parts[0]
+        cmd = parts[1].upper()
+        if len(parts) > 2:
+            args = parts[2]
+        else:
+            args = ''
+        try:
+            imap_cmd = self.dispatch[cmd]
+        except KeyError:
+            self.push('{} BAD unknown command {}'.format(tag, cmd))
+            return
+        self.run(imap_cmd, tag, cmd, args)
+
+    def run(self, func, tag, cmd, *args):
+        """Call func(tag, cmd, *args) and send its completion response"""
+        try:
+            ret_str = func(tag, cmd, *args)
+        except Exception as exmsg:
+            log.exception('IMAP {} error - {}'.format(cmd, exmsg))
+            ret_str = '{} BAD {} failed'.format(tag, cmd)
+        if ret_str is not None:
+            if cmd not in ('FETCH', 'STORE', 'SEARCH'):
+                self.flush_updates()
+            log.debug('S: {}'.format(ret_str))
+            self.push(ret_str)
+        if func == self.handleLogout:
+            self.close_when_done()
+
+    def list_mailbox(self, func, tag, cmd, args):
+        """List the mailbox on the disk I/O threads, then answer the
+        command with func(tag, cmd, args, mbx)
+        """
+        self.opening = True
+        bare_io.open_mailbox(self.mb_name,
+                             _listed(self, func, tag, cmd, args).done)
+
+    def listed(self, call, mbx, error):
+        """Answer the command once the mailbox has been listed, then serve
+        the commands that arrived meanwhile
+        """
+        self.opening = False
+        if not self.connected:
+            return
+        if error is not None:
+            log.error('IMAP {} could not list the mailbox'.format(call.cmd))
+            self.push('{} NO {} failed, cannot read mailbox'.format(
+                call.tag, call.cmd))
+        else:
+            self.run(call.func, call.tag, call.cmd, call.args, mbx)
+        while self.held and not self.opening:
+            self.buffer = [self.held.pop(0)]
+            self.found_terminator()
+
+    def readable(self):
+        """Wait for the mailbox to be listed before reading more commands
+        """
+        if self.opening:
+            return False
+        return asynchat.async_chat.readable(self)
+
+    def handle_close(self):
+        """Stop following the mailbox before closing."""
+        log.info('IMAP Connection closed')
+        self.deselect()
+        asynchat.async_chat.handle_close(self)
+
+    def select(self, mbx, readonly):
+        """Take mbx, just listed, as the selected mailbox and apply the
+        changes made while it was listed
+        """
+        self.mbx = mbx
+        self.msgs = []
+        self.by_name = {}
+        entries = self.mbx.items()
+        uids = self.uid_map.number(entries)
+        for i, entry in enumerate(entries):
+            self.append(entry, uids[i])
+        self.mbx.entries = []
+        for event, entry in self.early:
+            if event == 'add':
+                if entry.basename not in self.by_name:
+                    self.append(entry)
+            else:
+                msg = self.by_name.pop(entry.basename, None)
+                if msg is not None:
+                    self.msgs.remove(msg)
+        self.early = []
+        self.readonly = readonly
+        self.pending = []
+        self.state = self.STATE_SELECTED
+
+    def deselect(self):
+        if self.listening:
+            bare_maildir.remove_listener(self.mailbox_changed)
+            self.listening = False
+        self.mbx = None
+        self.early = []
+        self.msgs = []
+        self.by_name = {}
+        self.state = self.STATE_AUTH
+
+    def append(self, entry, uid=None):
+        if uid is None:
+            uid = self.uid_map.uid(entry.basename)
+        msg = imap_message(entry, uid)
+        self.msgs.append(msg)
+        self.by_name[entry.basename] = msg
+        return msg
+
+    def mailbox_changed(self, event, dirname, entry):
+        """Mailbox listener.  Report or queue changes made elsewhere."""
+        if dirname != self.key:
+            return
+        if self.mbx is None:
+            # the mailbox is being listed
+            self.early.append((event, entry))
+            return
+        if event == 'add':
+            if entry.basename in self.by_name:
+                return
+            self.append(entry)
+            self.pending.append('EXISTS')
+        elif event == 'remove':
+            msg = self.by_name.pop(entry.basename, None)
+            if msg is None:
+                return
+            self.pending.append(msg)
+        if self.state == self.STATE_IDLE:
+            self.flush_updates()
+
+    def flush_updates(self):
+        """Send the EXISTS and EXPUNGE responses queued by the listener."""
+        exists = False
+        for update in self.pending:
+            if update == 'EXISTS':
+                exists = True
+                continue
+            num = self.msgs.index(update) + 1
+            del self.msgs[num - 1]
+            self.uid_map.forget(update.entry.basename)
+            self.push('* {} EXPUNGE'.format(num))
+            exists = True
+        self.pending = []
+        if exists:
+            self.push('* {} EXISTS'.format(len(self.msgs)))
+
+    def selected(self, tag):
+        if self.state != self.STATE_SELECTED:
+            return '{} BAD no mailbox selected'.format(tag)
+        return None
+
+    def handleCapability(self, tag, cmd, args):
+        self.push('* CAPABILITY {}'.format(CAPABILITIES))
+        return '{} OK CAPABILITY completed'.format(tag)
+
+    def handleNoop(self, tag, cmd, args):
+        return '{} OK {} completed'.format(tag, cmd)
+
+    def handleNo(self, tag, cmd, args):
+        return '{} NO {} not supported, use LOGIN'.format(tag, cmd)
+
+    def handleLogin(self, tag, cmd, args):
+        """Accept any user name and password"""
+        return '{} OK LOGIN completed'.format(tag)
+
+    def handleLogout(self, tag, cmd, args):
+        self.push('* BYE BareMail IMAP4 server signing off')
+        self.deselect()
+        return '{} OK LOGOUT completed'.format(tag)
+
+    def handleSelect(self, tag, cmd, args):
+        """Open INBOX for the session and report its state"""
+        name = _tokenize(args)
+        self.deselect()
+        if len(name) != 1 or str(name[0]).upper() != 'INBOX':
+            return '{} NO no such mailbox'.format(tag)
+        bare_maildir.add_listener(self.mailbox_changed)
+        self.listening = True
+        self.list_mailbox(self.select_listed, tag, cmd, args)
+        return None
+
+    def select_listed(self, tag, cmd, args, mbx):
+        self.select(mbx, cmd == 'EXAMINE')
+        self.push('* FLAGS (\\Seen \\Deleted)')
+        self.push('* OK [PERMANENTFLAGS (\\Deleted \\Seen)] flags allowed')
+        self.push('* {} EXISTS'.format(len(self.msgs)))
+        self.push('* 0 RECENT')
+        self.push('* OK [UIDVALIDITY {}] UIDs valid'.format(
+            self.uid_map.validity))
+        self.push('* OK [UIDNEXT {}] next UID'.format(self.uid_map.next_uid))
+        if self.readonly:
+            return '{} OK [READ-ONLY] {} completed'.format(tag, cmd)
+        return '{} OK [READ-WRITE] {} completed'.format(tag, cmd)
+
+    def handleList(self, tag, cmd, args):
+        """Report INBOX as the only mailbox"""
+        parts = _tokenize(args)
+        if len(parts) != 2:
+            return '{} BAD {} needs reference and mailbox'.format(tag, cmd)
+        if parts[1] == '':
+            self.push('* {} (\\Noselect) "/" ""'.format(cmd))
+        elif parts[1] in ('*', '%') or parts[1].upper() == 'INBOX':
+            self.push('* {} (\\HasNoChildren) "/" INBOX'.format(cmd))
+        return '{} OK {} completed'.format(tag, cmd)
+
+    def handleStatus(self, tag, cmd, args):
+        parts = _tokenize(args)
+        if len(parts) != 2 or str(parts[0]).upper() != 'INBOX':
+            return '{} NO no such mailbox'.format(tag)
+        if self.mbx is None:
+            self.list_mailbox(self.status_listed, tag, cmd, args)
+            return None
+        count = len(self.msgs)
+        unseen = 0
+        for msg in self.msgs:
+            if '\\Seen' not in msg.flags:
+                unseen += 1
+        return self.status(tag, parts[1], count, unseen)
+
+    def status_listed(self, tag, cmd, args, mbx):
+        count = len(mbx.items())
+        return self.status(tag, _tokenize(args)[1], count, count)
+
+    def status(self, tag, names, count, unseen):
+        values = dict(MESSAGES=count, RECENT=0, UNSEEN=unseen,
+                      UIDVALIDITY=self.uid_map.validity,
+                      UIDNEXT=self.uid_map.next_uid)
+        items = []
+        for item in names:
+            item = item.upper()
+            if item in values:
+                items.append('{} {}'.format(item, values[item]))
+        self.push('* STATUS INBOX ({})'.format(' '.join(items)))
+        return '{} OK STATUS completed'.format(tag)
+
+    def matching(self, set_text, by_uid):
+        """Return (sequence number, message) pairs selected by a set."""
+        ranges = _parse_set(set_text)
+        result = []
+        if not self.msgs:
+            return result
+        if by_uid:
+            largest = self.msgs[-1].uid
+        else:
+            largest = len(self.msgs)
+        num = 0
+        for msg in self.msgs:
+            num += 1
+            if by_uid:
+                value = msg.uid
+            else:
+                value = num
+            if _in_set(value, ranges, largest):
+                result.append((num, msg))
+        return result
+
+    def handleFetch(self, tag, cmd, args, by_uid=False):
+        """Return message data items for a set of messages"""
+        error = self.selected(tag)
+        if error:
+            return error
+        parts = _tokenize(args)
+        if len(parts) != 2:
+            return '{} BAD FETCH needs a set and items'.format(tag)
+        items = parts[1]
+        if not isinstance(items, list):
+            items = [items]
+        names = []
+        for item in items:
+            item = item.upper()
+            if item == 'ALL':
+                names.extend(['FLAGS', 'INTERNALDATE', 'RFC822.SIZE',
+                              'ENVELOPE'])
+            elif item == 'FAST':
+                names.extend(['FLAGS', 'INTERNALDATE', 'RFC822.SIZE'])
+            elif item == 'FULL':
+                names.extend(['FLAGS', 'INTERNALDATE', 'RFC822.SIZE',
+                              'ENVELOPE'])
+            else:
+                names.append(item)
+        if by_uid and 'UID' not in names:
+            names.insert(0, 'UID')
+        for num, msg in self.matching(parts[0], by_uid):
+            self.push('* {} FETCH ({})'.format(num, self.fetch_items(msg,
+                                                                     names)))
+        return '{} OK {} completed'.format(tag, cmd)
+
+    def fetch_items(self, msg, names):
+        out = []
+        text = None
+        for name in names:
+            if name == 'UID':
+                out.append('UID {}'.format(msg.uid))
+            elif name == 'FLAGS':
+                out.append('FLAGS ({})'.format(' '.join(sorted(msg.flags))))
+            elif name == 'RFC822.SIZE':
+                out.append('RFC822.SIZE {}'.format(msg.entry.length))
+            elif name == 'INTERNALDATE':
+                out.append('INTERNALDATE "{}"'.format(time.strftime(
+                    '%d-%b-%Y %H:%M:%S +0000', time.gmtime(msg.entry.mtime))))
+            else:
+                if text is None:
+                    text = self.message_text(msg)
+                out.append(self.fetch_section(msg, name, text))
+        return ' '.join(out)
+
+    def message_text(self, msg):
+        return ''.join(self.mbx.open_entry(msg.entry))
+
+    def fetch_section(self, msg, name, text):
+        peek = False
+        if name.startswith('BODY.PEEK['):
+            peek = True
+            name = 'BODY[' + name[len('BODY.PEEK['):]
+        header, body = _split_message(text)
+        if name in ('RFC822', 'BODY[]'):
+            data = text
+        elif name in ('RFC822.HEADER', 'BODY[HEADER]'):
+            data = header
+            peek = True
+        elif name in ('RFC822.TEXT', 'BODY[TEXT]'):
+            data = body
+        elif name == 'ENVELOPE':
+            parsed = email.parser.HeaderParser().parsestr(header)
+            return 'ENVELOPE {}'.format(_envelope(parsed))
+        elif name.startswith('BODY[HEADER.FIELDS'):
+            exclude = name.startswith('BODY[HEADER.FIELDS.NOT')
+            inner = name[name.index('(') + 1:name.rindex(')')]
+            data = _header_fields(header, inner.split(), exclude)
+            name = 'BODY[HEADER.FIELDS{} ({})]'.format(
+                exclude and '.NOT' or '', inner)
+        else:
+            raise ValueError('unsupported fetch item {}'.format(name))
+        if not peek and not self.readonly:
+            msg.flags.add('\\Seen')
+        return '{} {{{}}}{}{}'.format(name, len(data), CRLF, data)
+
+    def handleStore(self, tag, cmd, args, by_uid=False):
+        """Set or clear \\Seen and \\Deleted"""
+        error = self.selected(tag)
+        if error:
+            return error
+        if self.readonly:
+            return '{} NO mailbox is read-only'.format(tag)
+        parts = _tokenize(args)
+        if len(parts) != 3:
+            return '{} BAD STORE needs a set, an item and flags'.format(tag)
+        item = parts[1].upper()
+        flags = parts[2]
+        if not isinstance(flags, list):
+            flags = [flags]
+        flags = _canonical_flags(flags)
+        for num, msg in self.matching(parts[0], by_uid):
+            if item.startswith('+FLAGS'):
+                msg.flags.update(flags)
+            elif item.startswith('-FLAGS'):
+                msg.flags.difference_update(flags)
+            elif item.startswith('FLAGS'):
+                msg.flags = set(flags)
+            else:
+                return '{} BAD unknown STORE item'.format(tag)
+            if not item.endswith('.SILENT'):
+                fetch = 'FLAGS ({})'.format(' '.join(sorted(msg.flags)))
+                if by_uid:
+                    fetch = 'UID {} {}'.format(msg.uid, fetch)
+                self.push('* {} FETCH ({})'.format(num, fetch))
+        return '{} OK {} completed'.format(tag, cmd)
+
+    def handleSearch(self, tag, cmd, args, by_uid=False):
+        """Search by ALL, SEEN, UNSEEN, DELETED, UNDELETED or UID set"""
+        error = self.selected(tag)
+        if error:
+            return error
+        keys = _tokenize(args)
+        if keys and str(keys[0]).upper() == 'CHARSET':
+            keys = keys[2:]
+        found = []
+        num = 0
+        for msg in self.msgs:
+            num += 1
+            if self.search_match(msg, num, keys):
+                if by_uid:
+                    found.append(str(msg.uid))
+                else:
+                    found.append(str(num))
+        self.push(' '.join(['* SEARCH'] + found))
+        return '{} OK {} completed'.format(tag, cmd)
+
+    def search_match(self, msg, num, keys):
+        i = 0
+        while i < len(keys):
+            key = str(keys[i]).upper()
+            if key == 'ALL':
+                pass
+            elif key == 'SEEN' and '\\Seen' not in msg.flags:
+                return False
+            elif key == 'UNSEEN' and '\\Seen' in msg.flags:
+                return False
+            elif key == 'DELETED' and '\\Deleted' not in msg.flags:
+                return False
+            elif key == 'UNDELETED' and '\\Deleted' in msg.flags:
+                return False
+            elif key == 'UID':
+                i += 1
+                largest = self.msgs[-1].uid
+                if not _in_set(msg.uid, _parse_set(keys[i]), largest):
+                    return False
+            elif key[0].isdigit() or key[0] == '*':
+                if not _in_set(num, _parse_set(key), len(self.msgs)):
+                    return False
+            elif key not in ('SEEN', 'UNSEEN', 'DELETED', 'UNDELETED'):
+                raise ValueError('unsupported search key {}'.format(key))
+            i += 1
+        return True
+
+    def expunge(self, report):
+        """Remove the messages flagged \\Deleted from the mailbox."""
+        num = 1
+        for msg in list(self.msgs):
+            if '\\Deleted' in msg.flags:
+                del self.msgs[num - 1]
+                self.by_name.pop(msg.entry.basename, None)
+                self.uid_map.forget(msg.entry.basename)
+                self.mbx.discard(msg.entry)
+                if report:
+                    self.push('* {} EXPUNGE'.format(num))
+            else:
+                num += 1
+
+    def handleExpunge(self, tag, cmd, args):
+        error = self.selected(tag)
+        if error:
+            return error
+        if self.readonly:
+            return '{} NO mailbox is read-only'.format(tag)
+        self.expunge(True)
+        return '{} OK EXPUNGE completed'.format(tag)
+
+    def handleClose(self, tag, cmd, args):
+        error = self.selected(tag)
+        if error:
+            return error
+        if not self.readonly:
+            self.expunge(False)
+        self.deselect()
+        return '{} OK CLOSE completed'.format(tag)
+
+    def handleUid(self, tag, cmd, args):
+        """Run FETCH, STORE or SEARCH with UIDs in place of numbers"""
+        parts = args.split(None, 1)
+        if not parts:
+            return '{} BAD UID needs a command'.format(tag)
+        sub = parts[0].upper()
+        if len(parts) > 1:
+            rest = parts[1]
+        else:
+            rest = ''
+        if sub == 'FETCH':
+            return self.handleFetch(tag, 'UID FETCH', rest, True)
+        if sub == 'STORE':
+            return self.handleStore(tag, 'UID STORE', rest, True)
+        if sub == 'SEARCH':
+            return self.handleSearch(tag, 'UID SEARCH', rest, True)
+        return '{} BAD unknown UID command {}'.format(tag, sub)
+
+    def handleIdle(self, tag, cmd, args):
+        """Enter IDLE.  Mailbox changes are pushed until the client sends DONE"""
+        error = self.selected(tag)
+        if error:
+            return error
+        self.push('+ idling')
+        self.idle_tag = tag
+        self.state = self.STATE_IDLE
+        self.flush_updates()
+        return None
+
+class imap_server(asyncore.dispatcher):
+    """Listens on IMAP port and launch IMAP handler on connection.
+    """
+    def __init__(self, address, mb_name):
+        """Listen on address, a (host, port) pair or a Unix socket path."""
+        self.mb_name = mb_name
+        asyncore.dispatcher.__init__(self)
+        bare_server.listen_on(self, address, 'IMAP4')
+
+    def handle_accept(self):
+        """Creates handler for each IMAP connection.
+        """
+        pair = self.accept()
+        if pair is not None:
+            sock, addr = pair
+            log.info('Incoming IMAP connection from %s' % repr(addr))
+            imap_handler(sock, self.mb_name)
+
+    def close(self):
+        """Stop listening and remove the socket file, if any."""
+        bare_server.unlisten(self)
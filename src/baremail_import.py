@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""Import an mbox or NDJSON archive into a BareMail maildir
+
+Reads archives written by baremail_export.py, or any mbox, from files or
+standard input, gzip compressed or not, and stores every message in the
+maildir.  Messages are stored in batches, each written with one group of
+disk syncs, so only one batch is held in memory however large the archive.
+Each message keeps the delivery time given in the archive, from the mbox
+'From ' line or the NDJSON "mtime", so the mailbox keeps its order.
+
+Each batch is listed in the maildir journal, so a running server indexes
+the messages as they arrive.  With --no-journal, for a server that is
+stopped, the index catches up when the server starts.  mbox line ends are
+stored as CRLF.  NDJSON archives restore each message exactly.
+
+The storage settings, and the maildir unless --maildir is given, are read
+from the configuration file given with -C or the BAREMAIL_CONFIG
+environment variable.  Import needs the maildir storage backend.
+
+Usage: baremail_import.py [-C config] [--maildir DIR] [--format mbox|ndjson]
+                          [--batch N] [--no-journal] [FILE ...]
+"""
+
+import argparse
+import bare_maildir
+import baremail_sendmail
+import base64
+import json
+import logging
+import os
+import sys
+import time
+import zlib
+
+# create logger
+log = logging.getLogger('baremail.import')
+
+FORMATS = ('mbox', 'ndjson')
+
+GZIP_MAGIC = '\x1f\x8b'
+
+def read_lines(f):
+    """Yield the lines of file f, decompressing it if it is gzipped."""
+    decomp = None
+    rest = ''
+    first = True
+    while True:
+        block = f.read(bare_maildir.CHUNK_SIZE)
+        if first:
+            first = False
+            if block.startswith(GZIP_MAGIC):
+                decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if not block:
+            break
+        if decomp is not None:
+            data = decomp.decompress(block)
+            # concatenated gzip members
+            while decomp.unused_data:
+                unused = decomp.unused_data
+                decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data += decomp.decompress(unused)
+            block = data
+        lines = (rest + block).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
+
+def read_ndjson(lines):
+    """Yield (mtime, message) for the records of an NDJSON archive."""
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if record.has_key('base64'):
+            msg_str = base64.b64decode(record['base64'])
+        else:
+            msg_str = record['message'].encode('utf-8')
+        yield record.get('mtime'), msg_str
+
+class importer():
+    """Store messages in a maildir a batch at a time."""
+
+    def __init__(self, maildir, batch, batch_bytes, journal):
+        self.maildir = maildir
+        self.batch = batch
+        self.batch_bytes = batch_bytes
+        self.journal = journal
+        self.mbx = bare_maildir.BareMaildir(maildir, scan=False)
+        self.messages = []
+        self.mtimes = []
+        self.size = 0
+        # totals
+        self.count = 0
+        self.bytes = 0
+
+    def add(self, mtime, msg_str):
+        if mtime is None:
+            mtime = time.time()
+        self.messages.append(msg_str)
+        self.mtimes.append(mtime)
+        self.size += len(msg_str)
+        if len(self.messages) >= self.batch or self.size >= self.batch_bytes:
+            self.flush()
+
+    def flush(self):
+        """Store the batch with one group of syncs and journal it."""
+        if not self.messages:
+            return
+        self.mbx.add_many(self.messages, self.mtimes)
+        if self.journal:
+            paths = []
+            for msg in self.mbx.items():
+                paths.append(msg.path)
+            bare_maildir.journal_append(self.maildir, paths)
+        self.mbx.entries = []
+        self.count += len(self.messages)
+        self.bytes += self.size
+        self.messages = []
+        self.mtimes = []
+        self.size = 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Import an mbox or NDJSON archive into a BareMail maildir')
+    parser.add_argument('files', nargs='*', default=['-'],
+                        help='archives to import (default standard input)')
+    parser.add_argument('-C', dest='config',
+                        default=os.environ.get('BAREMAIL_CONFIG'),
+                        help='BareMail configuration file')
+    parser.add_argument('--maildir', help='maildir to import into')
+    parser.add_argument('--format', choices=FORMATS,
+                        help='archive format (default from the file name, '
+                        'else mbox)')
+    parser.add_argument('--batch', type=int, default=500,
+                        help='messages synced together (default 500)')
+    parser.add_argument('--batch-bytes', type=int, default=64 << 20,
+                        help='most message bytes in a batch')
+    parser.add_argument('--no-journal', dest='journal',
+                        action='store_false',
+                        help='do not list the messages for a running server')
+    opts = parser.parse_args()
+
+    maildir = opts.maildir
+    try:
+        if opts.config:
+            cfile = open(opts.config, 'r')
+            cfgdict = json.load(cfile)
+            cfile.close()
+            bare_maildir.configure(cfgdict.get('storage', {}))
+            if maildir is None:
+                maildir = baremail_sendmail.maildir_path(cfgdict)
+    except Exception as msg:
+        log.error('Configuration file error - {}'.format(msg))
+        sys.exit(2)
+    if maildir is None:
+        parser.error('give a configuration file or --maildir')
+    if bare_maildir.BACKEND != 'maildir':
+        log.error('Import needs the maildir storage backend')
+        sys.exit(2)
+
+    start = time.time()
+    imp = importer(maildir, opts.batch, opts.batch_bytes, opts.journal)
+    try:
+        for name in opts.files:
+            fmt = opts.format
+            if fmt is None:
+                fmt = 'mbox'
+                base = name
+                if base.endswith('.gz'):
+                    base = base[:-3]
+                if base.endswith('.ndjson') or base.endswith('.jsonl'):
+                    fmt = 'ndjson'
+            if name == '-':
+                f = sys.stdin
+            else:
+                f = open(name, 'rb')
+            try:
+                if fmt == 'ndjson':
+                    records = read_ndjson(read_lines(f))
+                else:
+                    records = baremail_sendmail.read_mbox(read_lines(f))
+                for mtime, msg_str in records:
+                    imp.add(mtime, msg_str)
+            finally:
+                if f is not sys.stdin:
+                    f.close()
+        imp.flush()
+    except Exception as msg:
+        log.exception('Import failed after {} messages - {}'.format(
+            imp.count, msg))
+        sys.exit(1)
+    elapsed = max(time.time() - start, 0.001)
+    log.info('Imported {} messages, {} bytes in {:.1f}s, {:.0f} msg/s'.format(
+        imp.count, imp.bytes, elapsed, imp.count / elapsed))
+    sys.exit(0)
@@ -1,8 +1,9 @@
 """BareMail POP3 server
 
-Implements a simple POP3 server.  Commands implementing login or security
-features return positive responses to the client regardless of the
-state of the connection.
+Implements a simple POP3 server.  The user name given with USER picks the
+mailbox from the "mailboxes" of the POP3 server entry, or the default
+maildir, and any password is accepted.  A client that does not log in is
+served the default maildir.  One client at a time may use a mailbox.
 
 Very little internal state is maintained during each session.  Only the state
 needed to identify messages for retreival or deletion is kept.
@@ -10,22 +11,253 @@ needed to identify messages for retreival or deletion is kept.
 
 import asynchat
 import asyncore
+import bare_io
 import bare_maildir
+import bare_reaper
+import bare_sched
+import bare_server
+import collections
 import logging
-import mutex
-import socket
+import os
+import time
 
 # create logger
 log = logging.getLogger('baremail.pop3')
 
 CRLF = '\r\n'
 
-pop3_mutex = mutex.mutex()
+# Mailboxes in use by a session, by absolute path.
+_busy = set()
+
+# Largest buffer a multi-line response is pushed in.
+LISTING_CHUNK = 65536
+
+# Largest LIST or UIDL body kept in the listing cache.  Bigger ones are
+# streamed from the mailbox index at every poll.
+LISTING_CACHE_MAX = 16 * 1024 * 1024
+
+CAPABILITIES = ('USER', 'PASS', 'UIDL', 'PIPELINING')
+
+# Commands served before a mailbox is open.  Any other command opens the
+# default mailbox first.
+LOGIN_COMMANDS = ('USER', 'PASS', 'APOP', 'QUIT', 'CAPA', 'NOOP')
+
+# Seconds a client may take before its first command, to finish a command
+# line it has started and to send its next command.  RFC 1939 asks for at
+# least ten minutes of idle time.  Replaced by the "timeouts" of the
+# POP3 server entry.
+TIMEOUTS = dict(greeting=60, command=60, idle=600)
+
+# Seconds a timed out client is given to read the error.
+LINGER = 10
+
+# Pre-encoded STAT, LIST and UIDL answers for each maildir.  See listing().
+_listings = {}
+
+def _encode(lines):
+    """Join lines with CRLF, yielding buffers of about LISTING_CHUNK bytes.
+
+    Only one buffer is built at a time, so a listing of any length is
+    produced as fast as the client takes it.
+    """
+    part = []
+    size = 0
+    for line in lines:
+        part.append(line)
+        size += len(line) + 2
+        if size >= LISTING_CHUNK:
+            part.append('')
+            yield CRLF.join(part)
+            part = []
+            size = 0
+    if part:
+        part.append('')
+        yield CRLF.join(part)
+
+def _scan_lines(msg_list):
+    yield '+OK {} messages'.format(len(msg_list))
+    n = 0
+    for msg in msg_list:
+        yield '{} {}'.format(n, msg.length)
+        n += 1
+    yield '.'
+
+def _uidl_lines(msg_list):
+    yield '+OK {} messages'.format(len(msg_list))
+    n = 0
+    for msg in msg_list:
+        yield '{} {}'.format(n, msg.basename)
+        n += 1
+    yield '.'
+
+def _saving(chunks, cached, name):
+    """Pass chunks through, keeping them as attribute name of cached once
+    they have all been sent, unless they add up to more than
+    LISTING_CACHE_MAX.
+    """
+    saved = []
+    size = 0
+    for chunk in chunks:
+        if saved is not None:
+            size += len(chunk)
+            if size > LISTING_CACHE_MAX:
+                saved = None
+            else:
+                saved.append(chunk)
+        yield chunk
+    if saved is not None:
+        setattr(cached, name, saved)
+
+class mailbox_listing:
+    """The STAT, LIST and UIDL answers for one generation of a maildir.
+
+    Each answer is filled in by the first session that asks for it.
+    """
+    def __init__(self, generation, stamp, count):
+        self.generation = generation
+        self.stamp = stamp
+        self.count = count
+        self.stat = None
+        self.scan = None
+        self.uidl = None
+
+def listing(mbx):
+    """Return the listing of mailbox mbx for its generation.
+
+    A poller that finds the maildir unchanged is answered from buffers
+    encoded at the first poll.  The modification times of the maildir's
+    directories when mbx was listed catch changes made behind the server's
+    back, and the message count catches messages deleted in the session.
+    """
+    cached = _listings.get(mbx._key)
+    count = len(mbx.items())
+    if cached is None or cached.generation != mbx.generation or \
+       cached.stamp != mbx.stamp or cached.count != count:
+        cached = mailbox_listing(mbx.generation, mbx.stamp, count)
+        _listings[mbx._key] = cached
+    return cached
+
+class lines_producer:
+    """Feed buffers from an iterator to asynchat."""
+    def __init__(self, buffers):
+        self.buffers = iter(buffers)
+
+    def more(self):
+        if self.buffers is None:
+            return ''
+        for data in self.buffers:
+            return data
+        self.buffers = None
+        return ''
+
+class retr_producer:
+    """Feed a message to asynchat a block at a time.
+
+    The response header, the message blocks from the mailbox and the
+    closing '.' line are handed out in turn so a large or compressed
+    message is never assembled in memory as a whole.
+    """
+    def __init__(self, header, blocks):
+        self.header = header
+        self.blocks = blocks
+
+    def more(self):
+        if self.header is not None:
+            data = self.header
+            self.header = None
+            return data
+        if self.blocks is None:
+            return ''
+        for block in self.blocks:
+            return block
+        self.blocks = None
+        return CRLF + '.' + CRLF
+
+def _load_mailbox(dirname, cached):
+    """Return cached, the listed mailbox of dirname or None, if the maildir
+    has not changed since it was listed, or a newly listed mailbox.  Runs
+    on a disk I/O thread.
+    """
+    if cached is not None and \
+       cached.generation == bare_maildir.generation(cached._key) and \
+       bare_maildir.dir_stamp(cached.dirs) == cached.stamp:
+        cached.reset()
+        return cached
+    return bare_maildir.BareMaildir(dirname)
+
+class _load:
+    """Completion of mailbox_cache.open()."""
+    def __init__(self, cache, dirname, cached, callback):
+        self.cache = cache
+        self.dirname = dirname
+        self.cached = cached
+        self.callback = callback
+
+    def done(self, mbx, error):
+        self.cache.loaded(self, mbx, error)
+
+class mailbox_cache:
+    """Maildir listings kept from one POP3 session to the next.
+
+    Listing a large maildir opens every message file, so the listing made
+    for a session is kept and handed to the next session on the same
+    maildir.  It is used only if the generation of the maildir and the
+    modification times of its directories are those it was taken at, so
+    changes made by the server and by other processes are both seen.  The
+    least recently used listings are dropped to keep within "mailboxes"
+    maildirs and "messages" messages in all.
+    """
+    def __init__(self, cfgdict):
+        self.max_mailboxes = int(cfgdict.get('mailboxes', 8))
+        self.max_messages = int(cfgdict.get('messages', 100000))
+        # listed mailboxes by absolute path, least recently used first
+        self.listings = collections.OrderedDict()
+        self.messages = 0
+        # cache metrics
+        self.hits = 0
+        self.misses = 0
+
+    def open(self, dirname, callback):
+        """Call callback(mbx, error) with the mailbox in dirname."""
+        if bare_maildir.BACKEND != 'maildir':
+            bare_io.open_mailbox(dirname, callback)
+            return
+        cached = self.listings.pop(os.path.abspath(dirname), None)
+        if cached is not None:
+            self.messages -= len(cached.entries)
+        bare_io.run(_load_mailbox, (dirname, cached),
+                    _load(self, dirname, cached, callback).done)
+
+    def loaded(self, load, mbx, error):
+        if error is not None:
+            load.callback(None, error)
+            return
+        if mbx.generation != bare_maildir.generation(mbx._key):
+            # changed by the server while it was checked or listed
+            self.open(load.dirname, load.callback)
+            return
+        if mbx is load.cached:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if len(mbx.entries) <= self.max_messages:
+            self.listings[mbx._key] = mbx
+            self.messages += len(mbx.entries)
+            while len(self.listings) > self.max_mailboxes or \
+                  self.messages > self.max_messages:
+                key, dropped = self.listings.popitem(last=False)
+                self.messages -= len(dropped.entries)
+        load.callback(mbx, None)
+
+    def stats(self):
+        """Return the cache metrics as a dictionary."""
+        return dict(mailboxes=len(self.listings), messages=self.messages,
+                    hits=self.hits, misses=self.misses)
 
 class pop3_handler(asynchat.async_chat):
     """Service an individual POP3 connection.
 
-    Enforces a limit of one connected client at a time.  Supports
+    Enforces a limit of one connected client per mailbox.  Supports
     leaving messages in the mailbox until deleted by client.  This
     allows multiple clients to retrieve copies of the messages.
 
@@ -35,40 +267,196 @@ class pop3_handler(asynchat.async_chat):
     each client connection.  Messages received after that point will not be visible
     to the client until the next connection occurs.
     """
-    def __init__(self, sock, mb_name):
+    # send multi-line responses a whole buffer at a time
+    ac_out_buffer_size = LISTING_CHUNK
+
+    # the method serving each command
+    commands = dict(QUIT='handleQuit', STAT='handleStat', LIST='handleList',
+                    RETR='handleRetr', DELE='handleDele', NOOP='handleOK',
+                    RSET='handleRset', USER='handleUser', PASS='handlePass',
+                    APOP='handleApop', UIDL='handleUidl', CAPA='handleCapa')
+
+    def __init__(self, sock, mb_name, timeouts=TIMEOUTS, mailboxes=None,
+                 cache=None):
+        """Greet the client.  The mailbox is opened at login.
+
+        mailboxes maps user names to maildirs, mb_name being the default.
+        cache is the mailbox_cache listings are taken from, if any.
+        """
         asynchat.async_chat.__init__(self, sock=sock)
-        self.dispatch = dict(QUIT=self.handleQuit, STAT=self.handleStat,
-                             LIST=self.handleList, RETR=self.handleRetr,
-                             DELE=self.handleDele, NOOP=self.handleOK,
-                             RSET=self.handleRset, USER=self.handleOK,
-                             PASS=self.handleOK, APOP=self.handleOK,
-                             UIDL=self.handleUidl, CAPA=self.handleCapa)
         self.set_terminator(CRLF)
         self.buffer = []
-
-        self.mbx_lock = pop3_mutex.testandset()
-        if not self.mbx_lock:
+        # responses are queued, not sent, while a read is being handled
+        self.reading = False
+        self.mb_name = mb_name
+        self.mailboxes = mailboxes or {}
+        self.cache = cache
+        self.user = None
+        # set once the mailbox has been listed by the disk I/O threads
+        self.mbx = None
+        # absolute path of the mailbox this session holds
+        self.mb_key = None
+        # command lines received while the mailbox is listed
+        self.opening = False
+        self.held = []
+        self.reply = None
+        self.quitting = False
+        self.committing = False
+        # session timeout, checked by the timer wheel
+        self.timeouts = timeouts
+        self.greeted = False
+        self.expired = False
+        self.touch()
+        bare_sched.watch(self)
+        self.push('+OK POP3 server ready')
+
+    def open(self, mb_name, reply):
+        """Take the mailbox in mb_name for this session and list it
+
+        reply is sent once the mailbox is open.
+        """
+        key = os.path.abspath(mb_name)
+        if key in _busy:
             log.info('S: -ERR Mailbox busy.  Try again later.')
             self.push('-ERR Mailbox busy. Try again later.')
             self.close_when_done()
             return
+        _busy.add(key)
+        self.mb_key = key
+        self.opening = True
+        self.reply = reply
+        if self.cache is None:
+            bare_io.open_mailbox(mb_name, self.opened)
+        else:
+            self.cache.open(mb_name, self.opened)
 
-        try:
-            self.mbx = bare_maildir.BareMaildir(mb_name)
-            log.debug('S: +OK POP3 server ready')
-            self.push('+OK POP3 server ready')
-        except Exception:
-            log.exception('S: -ERR Error reading mailbox')
+    def opened(self, mbx, error):
+        """Answer the client once the mailbox has been listed, then serve
+        the commands that arrived meanwhile
+        """
+        self.opening = False
+        if not self.connected:
+            return
+        if error is not None:
+            log.error('S: -ERR Error reading mailbox')
             self.push('-ERR Error reading mailbox')
             self.close_when_done()
-        except Exception as msg:
-            log.exception('Unknown mailbox access error - {}'.format(msg))
+            return
+        self.mbx = mbx
+        self.reading = True
+        try:
+            if self.reply is not None:
+                self.push(self.reply)
+            while self.held and not self.opening and not self.quitting:
+                self.buffer = [self.held.pop(0)]
+                self.found_terminator()
+        finally:
+            self.reading = False
+        self.initiate_send()
+
+    def release(self):
+        """Let the next client have the mailbox
+        """
+        if self.mb_key is not None:
+            _busy.discard(self.mb_key)
+            self.mb_key = None
+
+    def readable(self):
+        """Wait for the mailbox to be listed before reading more commands
+        """
+        if self.opening:
+            return False
+        return asynchat.async_chat.readable(self)
 
     def collect_incoming_data(self, data):
         """Marshal data chunks into buffer
         """
         self.buffer.append(data)
 
+    def handle_read(self):
+        """Process every command in the data received
+
+        A pipelining client sends many commands at once.  They are all
+        answered before anything is sent, and the answers then go out
+        together in as few writes as the socket allows.
+        """
+        self.reading = True
+        try:
+            asynchat.async_chat.handle_read(self)
+        finally:
+            self.reading = False
+        self.touch()
+        self.initiate_send()
+
+    def handle_write(self):
+        self.touch()
+        asynchat.async_chat.handle_write(self)
+
+    def touch(self):
+        """Set the deadline for the client's next move
+        """
+        if self.expired:
+            return
+        if not self.greeted:
+            timeout = self.timeouts['greeting']
+        elif self.buffer:
+            timeout = self.timeouts['command']
+        else:
+            timeout = self.timeouts['idle']
+        self.deadline = time.time() + timeout
+
+    def timed_out(self):
+        """Close a session whose client has gone quiet
+
+        Called by the timer wheel.  The deletions of the session are
+        not committed, as RFC 1939 requires.  A client that does not
+        read the error is dropped LINGER seconds later.
+        """
+        if self.expired:
+            log.info('Dropping POP3 client that did not read timeout')
+            self.handle_close()
+            return
+        if self.opening and self.connected:
+            # still listing the mailbox
+            self.touch()
+            bare_sched.watch(self)
+            return
+        log.info('POP3 session timed out')
+        self.expired = True
+        self.quitting = True
+        self.set_terminator(None)
+        self.push('-ERR Timeout, closing connection')
+        self.close_when_done()
+        self.deadline = time.time() + LINGER
+        bare_sched.watch(self)
+
+    def initiate_send(self):
+        """Send queued responses, joining the ones at the head of the
+        queue into a single buffer of up to ac_out_buffer_size bytes.
+        """
+        if self.reading:
+            return
+        fifo = self.producer_fifo
+        parts = []
+        size = 0
+        while fifo and size < self.ac_out_buffer_size:
+            first = fifo[0]
+            if first is None:
+                break
+            if isinstance(first, str):
+                fifo.popleft()
+                data = first
+            else:
+                data = first.more()
+                if not data:
+                    fifo.popleft()
+                    continue
+            parts.append(data)
+            size += len(data)
+        if parts:
+            fifo.appendleft(''.join(parts))
+        asynchat.async_chat.initiate_send(self)
+
     def found_terminator(self):
         """Process client command
 
@@ -78,46 +466,60 @@ class pop3_handler(asynchat.async_chat):
         generate an error response.
 
         The QUIT command causes this handler to close after issuing the
-        response to the client.
+        response to the client.  Commands pipelined after QUIT are
+        ignored.
         """
         msg = ''.join(self.buffer)
-        args = ''
-        if msg:
-            command = msg.split(None, 1)
-            cmd = command[0].upper()
-            if len(command) > 1:
-                args = command[1]
-        else:
-            cmd = ''
-        log.debug('C: {} {}'.format(cmd, args))
-        try:
-            pop_cmd = self.dispatch[cmd]
-        except KeyError:
+        self.greeted = True
+        if self.opening:
+            self.held.append(msg)
+            self.buffer = []
+            return
+        cmd, args = bare_server.parse_command(msg, self.commands)
+        debug = log.isEnabledFor(logging.DEBUG)
+        if debug:
+            log.debug('C: {} {}'.format(cmd, args))
+        name = self.commands.get(cmd)
+        if name is None:
             log.info('S: -ERR unknown command "{}"'.format(cmd))
             self.push('-ERR unknown command "{}"'.format(cmd))
+        elif self.mbx is None and cmd not in LOGIN_COMMANDS:
+            # a client that has not logged in gets the default mailbox
+            self.held.append(msg)
+            self.open(self.mb_name, None)
         else:
-            ret_str = pop_cmd(cmd, args)
-            log.debug('S: {}'.format(ret_str))
-            self.push(ret_str)
-            if pop_cmd == self.handleQuit:
-                self.close_when_done()
+            ret_str = getattr(self, name)(cmd, args)
+            if ret_str is None:
+                # answered when the command completes
+                pass
+            elif isinstance(ret_str, str):
+                if debug:
+                    log.debug('S: {}'.format(ret_str))
+                self.push(ret_str)
+            else:
+                if debug:
+                    log.debug('S: <multi-line response>')
+                self.push_with_producer(ret_str)
+            if cmd == 'QUIT':
+                self.set_terminator(None)
         self.buffer = []
 
     def handle_close(self):
         """Perform cleanup before closing this handler.
 
         This method is called when the handler is closing for any
-        reason.  The single handler lock is released here to ensure
-        that it is available to the next client connection.
+        reason.  The mailbox is released here, or once the deletions are
+        committed, so that it is available to the next client connection.
         """
         log.info('POP3 Connection closed')
+        bare_sched.unwatch(self)
         asynchat.async_chat.handle_close(self)
-        if self.mbx_lock:
-            pop3_mutex.unlock()
-        try:
-            self.mbx.close()
-        except Exception:
-            pass
+        if self.mbx is not None and not self.quitting:
+            self.quitting = True
+            self.committing = True
+            bare_reaper.commit(self.mbx, self.closed)
+        if not self.committing:
+            self.release()
 
     def push(self, msg):
         """Overrides base class for convenience
@@ -132,30 +534,79 @@ class pop3_handler(asynchat.async_chat):
 
         The RFC states that deletion of messages occurs only at the controlled
         termination of a client session.  The messages marked for deletion by
-        the client are removed from the mail directory here before the response
-        is issued to the client.
+        the client are committed for removal by the disk I/O threads and
+        the response is issued to the client from closed().  The files are
+        unlinked later by the reaper.
         """
-        self.mbx.close()
+        self.quitting = True
+        if self.mbx is None:
+            self.closed(None, None)
+        else:
+            self.committing = True
+            bare_reaper.commit(self.mbx, self.closed)
+        return None
 
-        return '+OK POP3 server signing off'
+    def closed(self, result, error):
+        """Sign off once the deletions are committed
+        """
+        self.committing = False
+        if error is not None:
+            ret_str = '-ERR some deleted messages not removed'
+        else:
+            ret_str = '+OK POP3 server signing off'
+        if self.connected:
+            log.debug('S: {}'.format(ret_str))
+            self.push(ret_str)
+            self.close_when_done()
+        else:
+            self.release()
+
+    def handleUser(self, cmd, args):
+        """Remember the user whose mailbox PASS opens
+        """
+        if self.mbx is not None:
+            return '-ERR already logged in'
+        self.user = args.strip()
+        return '+OK'
+
+    def handlePass(self, cmd, args):
+        """Open the mailbox of the user named by USER
+
+        Any password is accepted.  The client is answered from opened().
+        """
+        if self.mbx is not None:
+            return '-ERR already logged in'
+        self.open(self.mailboxes.get(self.user, self.mb_name),
+                  '+OK mailbox ready')
+        return None
+
+    def handleApop(self, cmd, args):
+        """Open the mailbox of the named user, accepting any digest
+        """
+        if self.mbx is not None:
+            return '-ERR already logged in'
+        name = args.split()
+        if name:
+            self.user = name[0]
+        return self.handlePass(cmd, args)
 
     def handleStat(self, cmd, args):
         """Return mailbox statistics to client
 
         Returns the number of messages and a total messages sizes in octets
         """
-        num_msgs = 0;
-        mb_size = 0;
         try:
-            messages = self.mbx.items()
-            num_msgs = len(messages)
-            for msg in messages:
-                mb_size += msg.length
+            cached = listing(self.mbx)
+            if cached.stat is None:
+                mb_size = 0
+                for msg in self.mbx.items():
+                    mb_size += msg.length
+                cached.stat = '+OK {} {}'.format(cached.count, mb_size)
         except Exception as exmsg:
             log.exception('Unhandled exception {}'.format(exmsg))
             return '-ERR Internal Error'
         else:
-            return '+OK {} {}'.format(num_msgs, mb_size)
+            return cached.stat
 
     def getScanListing(self, msg_num, msg_list):
         """Return a message index and size for a single message
@@ -174,11 +625,12 @@ class pop3_handler(asynchat.async_chat):
                 ret_msg = '-ERR invalid index {}'.format(args)
         else:
             try:
-                ret_msg_array = ['+OK {} messages'.format(len(msg_list))]
-                for n in range(len(msg_list)):
-                    ret_msg_array.append(self.getScanListing(n, msg_list))
-                ret_msg_array.append('.')
-                ret_msg = CRLF.join(ret_msg_array)
+                cached = listing(self.mbx)
+                if cached.scan is not None:
+                    ret_msg = lines_producer(cached.scan)
+                else:
+                    ret_msg = lines_producer(_saving(
+                        _encode(_scan_lines(msg_list)), cached, 'scan'))
             except Exception as exmsg:
                 log.exception('handleList error - {}'.format(exmsg))
                 ret_msg = '-ERR Interal server error'
@@ -186,19 +638,19 @@ class pop3_handler(asynchat.async_chat):
 
     def handleRetr(self, cmd, args):
         """Return the contents of a message
+
+        The message is streamed to the client by a producer.  The size
+        reported is the uncompressed size held in the mailbox index.
         """
+        msg_num = args
         try:
             msg_num = int(args.split()[0])
-            msg_string = self.mbx.get_string(msg_num)
+            length = self.mbx.items()[msg_num].length
+            blocks = self.mbx.open_message(msg_num)
         except Exception as exmsg:
             log.exception('handleRetr error - {}'.format(exmsg))
-            ret_msg = '-ERR invalid index {}'.format(msg_num)
-        else:
-            ret_msg_array = ['+OK {} octets'.format(len(msg_string))]
-            ret_msg_array.append(msg_string)
-            ret_msg_array.append('.')
-            ret_msg = CRLF.join(ret_msg_array)
-        return ret_msg
+            return '-ERR invalid index {}'.format(msg_num)
+        return retr_producer('+OK {} octets'.format(length) + CRLF, blocks)
 
     def handleDele(self, cmd, args):
         """Mark a message for deletion
@@ -242,16 +694,18 @@ class pop3_handler(asynchat.async_chat):
         if args:
             try:
                 msg_num = int(args.split()[0])
-                ret_msg = '+OK {}'.format(self.getUidlListing(msg_num))
+                ret_msg = '+OK {}'.format(self.getUidlListing(msg_num,
+                                                              msg_list))
             except:
                 ret_msg = '-ERR invalid index {}'.format(args)
         else:
             try:
-                ret_msg_array = ['+OK {} messages'.format(len(msg_list))]
-                for n in range(len(msg_list)):
-                    ret_msg_array.append(self.getUidlListing(n, msg_list))
-                ret_msg_array.append('.')
-                ret_msg = CRLF.join(ret_msg_array)
+                cached = listing(self.mbx)
+                if cached.uidl is not None:
+                    ret_msg = lines_producer(cached.uidl)
+                else:
+                    ret_msg = lines_producer(_saving(
+                        _encode(_uidl_lines(msg_list)), cached, 'uidl'))
             except Exception as exmsg:
                 log.exception('handleList error - {}'.format(exmsg))
                 ret_msg = '-ERR Interal server error'
@@ -261,23 +715,29 @@ class pop3_handler(asynchat.async_chat):
         """Return a capabilities list to the client
         """
         caps_list = ['+OK List follows']
-        caps_list.append('USER')
-        caps_list.append('PASS')
-        caps_list.append('UIDL')
+        caps_list.extend(CAPABILITIES)
         caps_list.append('.')
-        return CRLF.join(caps_list)
+        return lines_producer(_encode(caps_list))
 
 class pop3_server(asyncore.dispatcher):
     """Listens on POP3 port and launch pop3 handler on connection.
     """
-    def __init__(self, host, port, mb_name):
-        log.info('Serving POP3 on {}:{}'.format(host, port))
+    def __init__(self, address, mb_name, timeouts=None, mailboxes=None,
+                 cache=None):
+        """Listen on address, a (host, port) pair or a Unix socket path.
+
+        timeouts may replace any of the TIMEOUTS.  mailboxes maps user
+        names to maildirs, mb_name being the maildir of any other user.
+        cache holds the "mailboxes" and "messages" limits of the
+        mailbox_cache.
+        """
         self.mb_name = mb_name
+        self.timeouts = dict(TIMEOUTS)
+        self.timeouts.update(timeouts or {})
+        self.mailboxes = mailboxes or {}
+        self.cache = mailbox_cache(cache or {})
         asyncore.dispatcher.__init__(self)
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.set_reuse_addr()
-        self.bind((host, port))
-        self.listen(5)
+        bare_server.listen_on(self, address, 'POP3')
 
     def handle_accept(self):
         """Creates handler for each POP3 connection.
@@ -287,5 +747,9 @@ class pop3_server(asyncore.dispatcher):
             sock, addr = pair
             log.info('Incoming POP3 connection from %s' % repr(addr))
             #handler = pop3_handler(sock, self.mb_name)
-            pop3_handler(sock, self.mb_name)
+            pop3_handler(sock, self.mb_name, self.timeouts, self.mailboxes,
+                         self.cache)
 
+    def close(self):
+        """Stop listening and remove the socket file, if any."""
+        bare_server.unlisten(self)
@@ -0,0 +1,568 @@
+"""BareMail outbound relay
+
+Forwards copies of selected messages to a smarthost.  When the SMTP server
+has stored a message locally, the recipients that match a configured rule
+are placed with the message in a persistent on-disk queue.  The queue is
+drained by a small pool of SMTP client connections to the smarthost.  The
+connections are kept open between messages and use PIPELINING when the
+smarthost offers it.
+
+Temporary failures and lost connections are retried with exponential
+backoff.  Messages rejected with a permanent error are moved to the
+queue's 'failed' directory.
+
+Configured by a "relay" object in the "servers" section::
+
+    "relay": {
+        "smarthost": {"host": "mail.example.com", "port": 25},
+        "rules": ["@example\\\\.com$"],
+        "queue_dir": "RelayQueue",
+        "connections": 2
+    }
+"""
+
+import asynchat
+import bare_io
+import bare_maildir
+import bare_sched
+import collections
+import json
+import logging
+import os
+import os.path
+import re
+import socket
+import sys
+import tempfile
+import time
+
+# create logger
+log = logging.getLogger('baremail.relay')
+
+CRLF = '\r\n'
+
+# The relay in use, if any.  Set by configure().
+relay = None
+
+def configure(cfgdict):
+    """Start the relay described by the "relay" configuration object."""
+    global relay
+    relay = relay_pool(cfgdict)
+    return relay
+
+def enqueue(sender, recipients, msg_str, callback=None):
+    """Queue msg_str for the recipients that match the relay rules, then
+    call callback(error) once it is on disk.
+    """
+    if relay is not None:
+        relay.enqueue(sender, recipients, msg_str, callback)
+    elif callback is not None:
+        callback(None)
+
+def _dot_stuff(msg_str):
+    """Return msg_str as DATA content including the terminating dot."""
+    lines = msg_str.split(CRLF)
+    out = []
+    for line in lines:
+        if line.startswith('.'):
+            line = '.' + line
+        out.append(line)
+    if out[-1] == '':
+        # msg_str already ends with a line break
+        out.pop()
+    return CRLF.join(out) + CRLF + '.' + CRLF
+
+class _queued():
+    """Completion of relay_pool.enqueue()."""
+    def __init__(self, pool, callback):
+        self.pool = pool
+        self.callback = callback
+
+    def done(self, job, error):
+        if error is None:
+            self.pool.queued(job)
+        if self.callback is not None:
+            self.callback(error)
+
+class relay_job():
+    """One queued message and the recipients it is relayed to."""
+    def __init__(self, path, sender, recipients):
+        self.path = path
+        self.sender = sender
+        self.recipients = recipients
+        self.attempts = 0
+
+    def load(self):
+        """Return the message text of the job."""
+        f = open(self.path, 'rb')
+        try:
+            f.readline()
+            return f.read()
+        finally:
+            f.close()
+
+class relay_queue():
+    """Durable queue directory.  Each file holds a JSON envelope line
+    followed by the message.
+    """
+    def __init__(self, dirname):
+        self.path = dirname
+        self.tmp_dir = os.path.join(dirname, 'tmp')
+        self.failed_dir = os.path.join(dirname, 'failed')
+        for d in (self.path, self.tmp_dir, self.failed_dir):
+            if not os.path.exists(d):
+                os.mkdir(d, 0o700)
+
+    def put(self, sender, recipients, msg_str):
+        envelope = json.dumps(dict(sender=sender, recipients=recipients))
+        tmp_file = tempfile.NamedTemporaryFile(dir=self.tmp_dir,
+                                               prefix='relay', delete=False)
+        try:
+            tmp_file.file.write(envelope + '\n')
+            tmp_file.file.write(msg_str)
+        except Exception:
+            tmp_file.close()
+            os.remove(tmp_file.name)
+            raise
+        bare_maildir._sync_close(tmp_file)
+        dest = os.path.join(self.path, os.path.basename(tmp_file.name))
+        bare_maildir._moveto(tmp_file.name, dest)
+        return relay_job(dest, sender, recipients)
+
+    def load(self):
+        """Return the jobs left in the queue, oldest first."""
+        jobs = []
+        names = []
+        for fname in os.listdir(self.path):
+            path = os.path.join(self.path, fname)
+            if fname in ('tmp', 'failed'):
+                continue
+            names.append((os.path.getmtime(path), path))
+        names.sort()
+        for mtime, path in names:
+            try:
+                f = open(path, 'rb')
+                envelope = json.loads(f.readline())
+                f.close()
+                jobs.append(relay_job(path, envelope['sender'],
+                                      envelope['recipients']))
+            except Exception:
+                log.exception('unreadable relay queue file {}'.format(path))
+        return jobs
+
+    def done(self, job):
+        os.unlink(job.path)
+
+    def fail(self, job):
+        bare_maildir._moveto(job.path, os.path.join(
+            self.failed_dir, os.path.basename(job.path)))
+
+class relay_client(asynchat.async_chat):
+    """A pooled SMTP client connection to the smarthost."""
+
+    STATE_CONNECT = 0
+    STATE_EHLO = 1
+    STATE_READY = 2
+    STATE_SEND = 3
+    STATE_QUIT = 4
+
+    def __init__(self, pool, name):
+        asynchat.async_chat.__init__(self)
+        self.pool = pool
+        self.name = name
+        self.set_terminator(CRLF)
+        self.buffer = []
+        self.reply = []
+        self.state = self.STATE_CONNECT
+        self.pipelining = False
+        self.job = None
+        self.expect = collections.deque()
+        self.accepted = []
+        self.deferred = []
+        self.mail_refused = False
+        self.refusal = (550, [])
+        self.data = None
+        self.idle_timer = None
+        self.closed = False
+        # throughput of this connection
+        self.sent = 0
+        self.sent_bytes = 0
+        self.busy = 0.0
+        self.job_start = 0.0
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(pool.smarthost)
+
+    def handle_connect(self):
+        log.info('Relay connection {} open to {}:{}'.format(
+            self.name, self.pool.smarthost[0], self.pool.smarthost[1]))
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        """Collect a possibly multi-line reply and act on it when complete"""
+        line = ''.join(self.buffer)
+        self.buffer = []
+        log.debug('R: {}'.format(line))
+        self.reply.append(line[4:])
+        if len(line) > 3 and line[3] == '-':
+            return
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = 500
+        lines = self.reply
+        self.reply = []
+        self.handle_reply(code, lines)
+
+    def send_cmd(self, cmd, kind):
+        log.debug('S: {}'.format(cmd))
+        self.push(cmd + CRLF)
+        self.expect.append(kind)
+
+    def handle_reply(self, code, lines):
+        if self.state == self.STATE_CONNECT:
+            if code != 220:
+                return self.broken('greeting {}'.format(code))
+            self.state = self.STATE_EHLO
+            self.send_cmd('EHLO {}'.format(self.pool.helo), 'EHLO')
+            return
+        if self.state == self.STATE_QUIT:
+            self.close()
+            return
+        if not self.expect:
+            return self.broken('unexpected reply {}'.format(code))
+        kind = self.expect.popleft()
+        if kind == 'EHLO':
+            if code != 250:
+                return self.broken('EHLO refused {}'.format(code))
+            for line in lines:
+                if line.upper().startswith('PIPELINING'):
+                    self.pipelining = True
+            self.idle()
+        elif kind == 'MAIL':
+            if code != 250:
+                self.mail_refused = True
+                self.refusal = (code, lines)
+                if not self.pipelining:
+                    self.outcome()
+            elif not self.pipelining:
+                self.send_rcpt(0)
+        elif kind.startswith('RCPT'):
+            # the kind carries the position, as a recipient may repeat
+            num = int(kind[5:])
+            rcpt = self.job.recipients[num]
+            if self.mail_refused:
+                # replies to pipelined commands after a refused MAIL
+                pass
+            elif code in (250, 251):
+                self.accepted.append(rcpt)
+            elif code >= 500:
+                log.warning('Relay recipient {} refused: {} {}'.format(
+                    rcpt, code, ' '.join(lines)))
+                self.refusal = (code, lines)
+            else:
+                self.deferred.append(rcpt)
+                self.refusal = (code, lines)
+            if not self.pipelining:
+                num += 1
+                if num < len(self.job.recipients):
+                    self.send_rcpt(num)
+                elif self.accepted:
+                    self.send_cmd('DATA', 'DATA')
+                else:
+                    self.outcome()
+        elif kind == 'DATA':
+            if code == 354 and self.accepted:
+                self.push(_dot_stuff(self.data))
+                self.expect.append('DOT')
+            elif code == 354:
+                # no recipient left, end the transaction empty
+                self.push('.' + CRLF)
+                self.expect.append('ABORT')
+            else:
+                if not self.mail_refused and self.accepted:
+                    # the whole transaction failed, not the recipients
+                    self.refusal = (code, lines)
+                    self.deferred = []
+                    self.accepted = []
+                self.outcome()
+        elif kind == 'DOT':
+            if code != 250:
+                self.refusal = (code, lines)
+                self.accepted = []
+                self.deferred = []
+            self.outcome()
+        elif kind == 'ABORT':
+            self.outcome()
+        elif kind == 'RSET':
+            self.idle()
+
+    def start(self, job):
+        """Send job on this connection."""
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        self.job = job
+        self.state = self.STATE_SEND
+        self.accepted = []
+        self.deferred = []
+        self.mail_refused = False
+        self.refusal = (550, [])
+        self.job_start = time.time()
+        try:
+            self.data = job.load()
+        except Exception:
+            log.exception('Relay queue file {} unreadable'.format(job.path))
+            self.job = None
+            self.idle()
+            return
+        if not self.pipelining:
+            self.send_cmd('MAIL FROM:<{}>'.format(job.sender), 'MAIL')
+            return
+        # the whole envelope goes out in one write
+        cmds = ['MAIL FROM:<{}>'.format(job.sender)]
+        self.expect.append('MAIL')
+        for num, rcpt in enumerate(job.recipients):
+            cmds.append('RCPT TO:<{}>'.format(rcpt))
+            self.expect.append('RCPT {}'.format(num))
+        cmds.append('DATA')
+        self.expect.append('DATA')
+        log.debug('S: {}'.format(' | '.join(cmds)))
+        self.push(CRLF.join(cmds) + CRLF)
+
+    def send_rcpt(self, num):
+        rcpt = self.job.recipients[num]
+        self.send_cmd('RCPT TO:<{}>'.format(rcpt), 'RCPT {}'.format(num))
+
+    def outcome(self):
+        """Report the end of the transaction and get ready for the next.
+
+        Recipients that got the message are done, recipients refused with
+        a temporary error are retried, and a message nobody accepted or
+        that was refused as a whole goes to the pool as refused.
+        """
+        job = self.job
+        self.job = None
+        code, lines = self.refusal
+        if self.accepted:
+            self.sent += 1
+            self.sent_bytes += len(self.data)
+            self.busy += time.time() - self.job_start
+            self.pool.job_done(job, self.deferred)
+        elif self.deferred:
+            self.pool.job_refused(job, min(code, 451), ' '.join(lines))
+        else:
+            self.pool.job_refused(job, code, ' '.join(lines))
+        self.data = None
+        if self.accepted:
+            self.idle()
+        else:
+            self.send_cmd('RSET', 'RSET')
+
+    def idle(self):
+        self.state = self.STATE_READY
+        if self.idle_timer is None:
+            self.idle_timer = bare_sched.call_later(self.pool.idle_timeout,
+                                                    self.quit)
+        self.pool.connection_ready(self)
+
+    def quit(self):
+        """Close an idle connection politely."""
+        self.idle_timer = None
+        if self.state == self.STATE_READY:
+            self.state = self.STATE_QUIT
+            self.pool.connection_gone(self)
+            self.push('QUIT' + CRLF)
+            self.close_when_done()
+
+    def broken(self, reason):
+        log.warning('Relay connection {} failed - {}'.format(self.name,
+                                                             reason))
+        self.close()
+
+    def handle_error(self):
+        err = sys.exc_info()[1]
+        if isinstance(err, socket.error):
+            self.broken(err)
+            return
+        log.exception('Relay connection {} error'.format(self.name))
+        self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        asynchat.async_chat.close(self)
+        log.info('Relay connection {} closed: {}'.format(self.name,
+                                                         self.throughput()))
+        job = self.job
+        self.job = None
+        self.pool.connection_gone(self, job)
+
+    def throughput(self):
+        rate = 0.0
+        if self.busy:
+            rate = self.sent / self.busy
+        return '{} messages {} bytes {:.1f} msg/s'.format(
+            self.sent, self.sent_bytes, rate)
+
+class relay_pool():
+    """Queue and connection pool for the smarthost."""
+
+    def __init__(self, cfgdict):
+        host = cfgdict['smarthost']
+        self.smarthost = (host['host'], int(host.get('port', 25)))
+        self.rules = []
+        for rule in cfgdict.get('rules', []):
+            self.rules.append(re.compile(rule, re.IGNORECASE))
+        self.max_connections = int(cfgdict.get('connections', 2))
+        self.retry_min = float(cfgdict.get('retry_min', 30))
+        self.retry_max = float(cfgdict.get('retry_max', 3600))
+        self.idle_timeout = float(cfgdict.get('idle_timeout', 60))
+        self.helo = cfgdict.get('helo') or socket.getfqdn()
+        self.queue = relay_queue(cfgdict.get('queue_dir', 'RelayQueue'))
+        self.ready = collections.deque(self.queue.load())
+        self.connections = []
+        self.idle_connections = []
+        self.connection_seq = 0
+        self.failures = 0
+        self.retry_timer = None
+        # totals
+        self.relayed = 0
+        self.refused = 0
+        log.info('Relaying to {}:{} with {} queued'.format(
+            self.smarthost[0], self.smarthost[1], len(self.ready)))
+        self.dispatch()
+
+    def matching(self, recipients):
+        """Return the recipients that match a rule, each once."""
+        found = []
+        for rcpt in recipients:
+            if rcpt in found:
+                continue
+            for rule in self.rules:
+                if rule.search(rcpt):
+                    found.append(rcpt)
+                    break
+        return found
+
+    def enqueue(self, sender, recipients, msg_str, callback=None):
+        """Write msg_str to the queue on the disk I/O threads for the
+        recipients that match, then call callback(error), if given.
+        """
+        found = self.matching(recipients)
+        if not found:
+            if callback is not None:
+                callback(None)
+            return
+        bare_io.run(self.queue.put, (sender, found, msg_str),
+                    _queued(self, callback).done)
+
+    def queued(self, job):
+        log.debug('queued {} for {}'.format(job.path,
+                                            ', '.join(job.recipients)))
+        self.ready.append(job)
+        self.dispatch()
+
+    def dispatch(self):
+        """Hand ready jobs to idle connections and open more if needed."""
+        while self.ready and self.idle_connections:
+            conn = self.idle_connections.pop()
+            conn.start(self.ready.popleft())
+        if self.retry_timer is not None:
+            return
+        wanted = min(len(self.ready), self.max_connections)
+        while len(self.connections) < wanted:
+            self.connection_seq += 1
+            try:
+                conn = relay_client(self, self.connection_seq)
+            except Exception:
+                log.exception('Relay connect to {} failed'.format(
+                    self.smarthost))
+                self.backoff()
+                return
+            self.connections.append(conn)
+
+    def connection_ready(self, conn):
+        if conn not in self.idle_connections:
+            self.idle_connections.append(conn)
+        self.failures = 0
+        self.dispatch()
+
+    def connection_gone(self, conn, job=None):
+        if conn in self.idle_connections:
+            self.idle_connections.remove(conn)
+        if conn in self.connections:
+            self.connections.remove(conn)
+        if job is not None:
+            job.attempts += 1
+            self.ready.appendleft(job)
+            self.backoff()
+        elif self.ready and conn.sent == 0 and conn.state != conn.STATE_QUIT:
+            # never got ready, the smarthost is unreachable
+            self.backoff()
+        else:
+            self.dispatch()
+
+    def backoff(self):
+        """Wait before reconnecting, doubling the wait on each failure."""
+        if self.retry_timer is not None:
+            return
+        delay = min(self.retry_max, self.retry_min * (2 ** self.failures))
+        self.failures += 1
+        log.info('Relay retry in {:.0f}s'.format(delay))
+        self.retry_timer = bare_sched.call_later(delay, self.retry)
+
+    def retry(self):
+        self.retry_timer = None
+        self.dispatch()
+
+    def job_done(self, job, deferred):
+        """The message went to the smarthost, except for the deferred
+        recipients which are queued again on their own.
+        """
+        self.relayed += 1
+        try:
+            if deferred:
+                retry = self.queue.put(job.sender, deferred, job.load())
+                retry.attempts = job.attempts
+                self.job_refused(retry, 450, 'recipients deferred')
+            self.queue.done(job)
+        except Exception:
+            log.exception('error removing {}'.format(job.path))
+
+    def job_refused(self, job, code, text):
+        if code >= 500:
+            self.refused += 1
+            log.error('Relay of {} refused: {} {}'.format(job.path, code, text))
+            self.queue.fail(job)
+        else:
+            job.attempts += 1
+            delay = min(self.retry_max,
+                        self.retry_min * (2 ** (job.attempts - 1)))
+            log.info('Relay of {} deferred {:.0f}s: {} {}'.format(
+                job.path, delay, code, text))
+            bare_sched.call_later(delay, self.requeue, job)
+
+    def requeue(self, job):
+        self.ready.append(job)
+        self.dispatch()
+
+    def stats(self):
+        """Return totals and per-connection throughput."""
+        conns = {}
+        for conn in self.connections:
+            conns[conn.name] = conn.throughput()
+        return dict(queued=len(self.ready), relayed=self.relayed,
+                    refused=self.refused, connections=conns)
+
+    def close(self):
+        for conn in list(self.connections):
+            conn.close()
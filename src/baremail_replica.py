@@ -0,0 +1,987 @@
+"""BareMail replication
+
+A warm standby for the maildir.  The leader appends every delivery and
+removal committed to its maildir to a change log and streams the log over
+TCP to its followers.  A follower is a second BareMail started with a
+"follower" replication entry.  It copies each delivered file into its own
+maildir under the leader's name and delivery time, unlinks the removed
+ones and acknowledges the log position it has applied and synced.  Its
+index and HTTP server follow the copies as they follow local deliveries.
+Its SMTP, POP3 and IMAP servers are not started, so nothing but the
+leader changes the copy until the follower is promoted by configuring it
+as a leader.
+
+With "ack" set to "sync", the SMTP server answers 250 only once a
+follower has acknowledged the delivery, so every accepted message is on
+both disks.  A follower that has not answered after "sync_timeout"
+seconds is no longer waited for until it has caught up.  While no
+follower is streaming, deliveries are answered at once.  With the default, "async", the 250 is
+sent as soon as the message is on the leader's disk.
+
+The log holds the names of the changed files, not their contents, which
+are read from the maildir as they are sent.  A follower that reconnects
+resumes from the last position it applied.  One that has fallen behind
+the oldest segment kept, or that follows the log of an earlier run of the
+leader, catches up from a snapshot: the leader sends the names of its
+messages, the follower unlinks the files the leader no longer has and
+fetches the ones it lacks, then follows the log from where the snapshot
+was taken.
+
+Only the names of message files are exchanged: a file at the top of the
+maildir or in one of its shards.  A follower asking for any other path is
+disconnected and records from the leader naming one are skipped, so
+neither side reads or writes outside the maildir or its reserved files.
+
+Configured by a "replication" object in the "servers" section of the
+leader::
+
+    "replication": {"role": "leader", "host": "0.0.0.0", "port": 2625,
+                    "ack": "sync"}
+
+and of the follower::
+
+    "replication": {"role": "follower", "host": "mail1.example.com",
+                    "port": 2625}
+"""
+
+import asynchat
+import asyncore
+import bare_io
+import bare_maildir
+import bare_sched
+import bisect
+import collections
+import errno
+import json
+import logging
+import os
+import os.path
+import socket
+import stat
+import sys
+import time
+
+# create logger
+log = logging.getLogger('baremail.replica')
+
+CRLF = '\r\n'
+
+# Longest command line accepted from a follower.
+MAX_LINE = 4096
+
+# Change records sent to a follower at a time.
+FEED_RECORDS = 128
+
+# The leader in use, if any.  Set by configure().
+leader = None
+
+def configure(cfgdict, dirname):
+    """Start the leader or follower described by the "replication"
+    configuration object for maildir dirname.
+    """
+    global leader
+    if bare_maildir.BACKEND != 'maildir':
+        raise ValueError('replication needs the maildir storage backend')
+    role = cfgdict.get('role', 'leader')
+    if role == 'leader':
+        leader = replica_leader(cfgdict, dirname)
+        return leader
+    if role == 'follower':
+        return replica_follower(cfgdict, dirname)
+    raise ValueError('unknown replication role {}'.format(role))
+
+def standby(cfgdict):
+    """Return True if the configuration runs a follower."""
+    return cfgdict.get('replication', {}).get('role') == 'follower'
+
+def sync(func, *args):
+    """Call func(*args) once the changes made so far are acknowledged.
+
+    Unless the leader acknowledges synchronously and a follower is
+    streaming, func is called at once.
+    """
+    if leader is None:
+        func(*args)
+    else:
+        leader.sync(func, args)
+
+def _message_name(name):
+    """Return True if name, relative to the maildir, is where a message
+    file may be: at the top, other than a reserved file or shard, or in a
+    shard.  Absolute paths, '..' and reserved files are refused.
+    """
+    if not isinstance(name, basestring) or '\0' in name:
+        return False
+    parts = name.split('/')
+    for part in parts:
+        if part in ('', '.', '..'):
+            return False
+    if len(parts) == 1:
+        return parts[0] not in bare_maildir.RESERVED and \
+               not parts[0].startswith(bare_maildir.SHARD_PREFIX)
+    return len(parts) == 2 and parts[0] != bare_maildir.SHARD_PREFIX and \
+           parts[0].startswith(bare_maildir.SHARD_PREFIX)
+
+def _names(dirname):
+    """Return the set of message files in maildir dirname, as paths
+    relative to it.  Runs on a disk I/O thread.
+    """
+    names = set()
+    prefix = os.path.join(dirname, '')
+    for path in bare_maildir.message_dirs(dirname):
+        top = path == dirname
+        try:
+            listing = os.listdir(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        for fname in listing:
+            if top and (fname in bare_maildir.RESERVED or
+                        fname.startswith(bare_maildir.SHARD_PREFIX)):
+                continue
+            full = os.path.join(path, fname)
+            if full not in bare_maildir._purging:
+                names.add(full[len(prefix):])
+    return names
+
+class _change():
+    """A message file named in a change record."""
+    def __init__(self, dirname, name):
+        self.path = os.path.join(dirname, name)
+        self.basename = os.path.basename(name)
+        self.length, self.codec, self.digest = bare_maildir._parse_info(
+            self.basename)
+        self.mtime = None
+
+class change_log():
+    """The leader's log of changes, a directory of segment files.
+
+    Each record is a line of JSON.  Positions are byte offsets from the
+    start of the log and each segment is named by the offset of its first
+    record.  Messages may be delivered by baremail_sendmail.py while the
+    server is down and a crash may lose the last records, so each run of
+    the server starts a new log, under a new id.
+    """
+
+    def __init__(self, path, segment_size, segments):
+        self.path = path
+        self.segment_size = segment_size
+        self.segments = segments
+        if not os.path.isdir(path):
+            os.mkdir(path, 0o700)
+        for fname in os.listdir(path):
+            if fname.endswith('.log'):
+                os.unlink(os.path.join(path, fname))
+        self.id = os.urandom(8).encode('hex')
+        self.starts = [0]
+        self.end = 0
+        self.file = open(self._segment(0), 'wb')
+        log.info('Change log {} in {}'.format(self.id, path))
+
+    def _segment(self, start):
+        return os.path.join(self.path, '{:020d}.log'.format(start))
+
+    def oldest(self):
+        return self.starts[0]
+
+    def append(self, record):
+        """Append record and return the log position after it."""
+        line = json.dumps(record) + '\n'
+        self.file.write(line)
+        self.file.flush()
+        self.end += len(line)
+        if self.end - self.starts[-1] >= self.segment_size:
+            self.roll()
+        return self.end
+
+    def roll(self):
+        """Start a new segment and drop the oldest beyond the limit."""
+        self.file.close()
+        self.starts.append(self.end)
+        self.file = open(self._segment(self.end), 'ab')
+        while len(self.starts) > self.segments:
+            os.unlink(self._segment(self.starts.pop(0)))
+
+    def read(self, offset, count):
+        """Return up to count (position after, record) pairs from offset."""
+        records = []
+        i = bisect.bisect_right(self.starts, offset) - 1
+        while i < len(self.starts) and len(records) < count:
+            start = self.starts[i]
+            f = open(self._segment(start), 'rb')
+            try:
+                f.seek(offset - start)
+                for line in f:
+                    offset += len(line)
+                    records.append((offset, json.loads(line)))
+                    if len(records) >= count:
+                        break
+            finally:
+                f.close()
+            i += 1
+        return records
+
+    def close(self):
+        self.file.close()
+
+class file_producer:
+    """Feed a message file to asynchat."""
+    def __init__(self, f):
+        self.f = f
+
+    def more(self):
+        if self.f is None:
+            return ''
+        block = self.f.read(bare_maildir.CHUNK_SIZE)
+        if not block:
+            self.f.close()
+            self.f = None
+        return block
+
+class _waiter():
+    """A reply held until a follower acknowledges a log position."""
+    def __init__(self, offset, func, args):
+        self.offset = offset
+        self.func = func
+        self.args = args
+        self.timer = None
+        self.done = False
+
+    def release(self):
+        if self.done:
+            return
+        self.done = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.func(*self.args)
+
+class _expired():
+    """Timeout of a _waiter."""
+    def __init__(self, leader, waiter):
+        self.leader = leader
+        self.waiter = waiter
+
+    def fire(self):
+        self.waiter.timer = None
+        if not self.waiter.done:
+            self.leader.sync_timeouts += 1
+            if not self.leader.lagging:
+                log.warning('No follower acknowledged position {} in {}s, '
+                            'not waiting until one catches up'.format(
+                                self.waiter.offset, self.leader.sync_timeout))
+            self.leader.lagging = True
+            self.waiter.release()
+
+class _snapshot():
+    """Completion of the listing of a snapshot."""
+    def __init__(self, conn, log_id, offset):
+        self.conn = conn
+        self.log_id = log_id
+        self.offset = offset
+
+    def done(self, names, error):
+        if self.conn.closed:
+            return
+        if error is not None:
+            log.error('Error listing snapshot - {}'.format(error))
+            self.conn.close()
+            return
+        self.conn.send_snapshot(self.log_id, self.offset, names)
+
+class _follower(asynchat.async_chat):
+    """The connection of a follower to the leader."""
+
+    def __init__(self, leader, sock, addr):
+        asynchat.async_chat.__init__(self, sock=sock)
+        # changes and acknowledgements are small and waited for
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.leader = leader
+        self.addr = addr
+        self.set_terminator(CRLF)
+        self.buffer = []
+        self.size = 0
+        self.closed = False
+        self.streaming = False
+        self.feed_timer = None
+        # next log position to send and last acknowledged
+        self.position = 0
+        self.acked = 0
+        # (position, time appended) of records not yet acknowledged
+        self.times = collections.deque()
+        # metrics
+        self.sent = 0
+        self.fetched = 0
+
+    def collect_incoming_data(self, data):
+        self.size += len(data)
+        if self.size > MAX_LINE:
+            log.warning('Follower {} line too long'.format(self.addr))
+            self.close()
+            return
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        log.debug('F: {}'.format(line))
+        parts = line.split(' ')
+        try:
+            if parts[0] == 'FOLLOW' and len(parts) == 3:
+                self.leader.follow(self, parts[1], int(parts[2]))
+            elif parts[0] == 'FETCH' and len(parts) == 2:
+                if not _message_name(parts[1]):
+                    raise ValueError('not a message name')
+                self.fetched += 1
+                self.send_file({'op': 'add', 'name': parts[1]})
+            elif parts[0] == 'ACK' and len(parts) == 2:
+                self.leader.acknowledged(self, int(parts[1]))
+            else:
+                raise ValueError('unknown command')
+        except ValueError:
+            log.warning('Follower {} sent bad line {!r}'.format(self.addr,
+                                                                line))
+            self.close()
+
+    def send_record(self, record):
+        self.push(json.dumps(record) + CRLF)
+
+    def send_file(self, record):
+        """Send an add record followed by the message file it names.
+
+        A file already removed, or on its way out in a purge file, is sent
+        with no size.  So is anything but a plain file.
+        """
+        path = os.path.join(self.leader.dirname, record['name'])
+        f = None
+        if path not in bare_maildir._purging:
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK |
+                             os.O_NOFOLLOW)
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ELOOP):
+                    raise
+            else:
+                f = os.fdopen(fd, 'rb')
+        st = None
+        if f is not None:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                f.close()
+                f = None
+        if f is None:
+            record['size'] = None
+            self.send_record(record)
+            return
+        record['mtime'] = bare_maildir._info_time(os.path.basename(path),
+                                                  st.st_mtime)
+        record['size'] = st.st_size
+        self.send_record(record)
+        self.push_with_producer(file_producer(f))
+
+    def send_snapshot(self, log_id, offset, names):
+        self.send_record({'op': 'snapshot', 'id': log_id, 'offset': offset,
+                          'count': len(names)})
+        lines = []
+        for name in names:
+            lines.append(name + CRLF)
+            if len(lines) >= 1000:
+                self.push(''.join(lines))
+                lines = []
+        lines.append('.' + CRLF)
+        self.push(''.join(lines))
+
+    def start(self, offset):
+        """Stream the log to the follower from offset."""
+        log.info('Follower {} streaming from {}'.format(self.addr, offset))
+        self.streaming = True
+        self.position = offset
+        self.acked = offset
+        self.times.clear()
+        self.send_record({'op': 'start', 'id': self.leader.changes.id,
+                          'offset': offset})
+        self.feed()
+
+    def feed(self):
+        """Queue the next records of the log once the last are sent."""
+        self.feed_timer = None
+        if not self.streaming or self.producer_fifo or self.closed:
+            return
+        changes = self.leader.changes
+        if self.position >= changes.end:
+            return
+        if self.position < changes.oldest():
+            log.warning('Follower {} fell behind the change log'.format(
+                self.addr))
+            self.leader.snapshot(self)
+            return
+        for end, record in changes.read(self.position, FEED_RECORDS):
+            record['offset'] = end
+            if record['op'] == 'add':
+                self.send_file(record)
+            else:
+                self.send_record(record)
+            self.position = end
+            self.sent += 1
+        if not self.producer_fifo and self.position < changes.end:
+            # all sent at once, carry on from the loop
+            self.feed_timer = bare_sched.call_later(0, self.feed)
+
+    def handle_write(self):
+        asynchat.async_chat.handle_write(self)
+        self.feed()
+
+    def handle_error(self):
+        err = sys.exc_info()[1]
+        if isinstance(err, socket.error):
+            log.warning('Follower {} failed - {}'.format(self.addr, err))
+        else:
+            log.exception('Follower {} error'.format(self.addr))
+        self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.streaming = False
+        if self.feed_timer is not None:
+            self.feed_timer.cancel()
+            self.feed_timer = None
+        asynchat.async_chat.close(self)
+        log.info('Follower {} gone after {} changes'.format(self.addr,
+                                                            self.sent))
+        self.leader.gone(self)
+
+class replica_leader(asyncore.dispatcher):
+    """Log the changes to the maildir and stream them to followers."""
+
+    def __init__(self, cfgdict, dirname):
+        """cfgdict gives the "host" and "port" followers connect to and
+        may give "ack", "async" or "sync", "sync_timeout" in seconds, the
+        "log" directory, defaulting to the maildir name with '.replog'
+        appended, "segment_size", the bytes of each log segment, and
+        "segments", the number of segments kept.
+        """
+        self.dirname = dirname
+        self._key = os.path.abspath(dirname)
+        self._prefix = os.path.join(dirname, '')
+        self.ack = cfgdict.get('ack', 'async')
+        if self.ack not in ('async', 'sync'):
+            raise ValueError('unknown replication ack {}'.format(self.ack))
+        self.sync_timeout = float(cfgdict.get('sync_timeout', 5.0))
+        self.changes = change_log(
+            cfgdict.get('log', dirname.rstrip('/') + '.replog'),
+            int(cfgdict.get('segment_size', 4 << 20)),
+            int(cfgdict.get('segments', 16)))
+        self.followers = []
+        self.waiters = collections.deque()
+        # highest position any follower acknowledged
+        self.acked = 0
+        # set when a follower is too slow to be waited for
+        self.lagging = False
+
+        # replication metrics
+        self.records = 0
+        self.snapshots = 0
+        self.acks = 0
+        self.lag = 0.0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.sync_waits = 0
+        self.sync_timeouts = 0
+
+        asyncore.dispatcher.__init__(self)
+        address = (cfgdict.get('host', ''), int(cfgdict['port']))
+        log.info('Replicating {} on {}:{}, {} acknowledgement'.format(
+            dirname, address[0], address[1], self.ack))
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(5)
+        bare_maildir.add_listener(self.changed)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, addr = pair
+            log.info('Follower connected from {}'.format(repr(addr)))
+            self.followers.append(_follower(self, sock, addr))
+
+    def changed(self, event, dirname, msg):
+        """Log a delivery or removal and send it to the followers."""
+        if dirname != self._key:
+            return
+        if msg.path.startswith(self._prefix):
+            name = msg.path[len(self._prefix):]
+        else:
+            name = os.path.relpath(msg.path, self.dirname)
+        if event == 'add':
+            record = {'op': 'add', 'name': name, 'mtime': msg.mtime}
+        else:
+            record = {'op': 'remove', 'name': name}
+        end = self.changes.append(record)
+        self.records += 1
+        now = time.time()
+        for conn in self.followers:
+            if conn.streaming:
+                conn.times.append((end, now))
+                conn.feed()
+
+    def follow(self, conn, log_id, offset):
+        """Resume the follower at offset or send it a snapshot."""
+        if log_id == self.changes.id and \
+           self.changes.oldest() <= offset <= self.changes.end:
+            conn.start(offset)
+        else:
+            self.snapshot(conn)
+
+    def snapshot(self, conn):
+        """List the maildir for conn to catch up from."""
+        self.snapshots += 1
+        conn.streaming = False
+        log.info('Sending follower {} a snapshot at {}'.format(
+            conn.addr, self.changes.end))
+        done = _snapshot(conn, self.changes.id, self.changes.end).done
+        bare_io.run(_names, (self.dirname,), done)
+
+    def acknowledged(self, conn, offset):
+        """A follower has applied and synced the log up to offset."""
+        conn.acked = offset
+        appended = None
+        while conn.times and conn.times[0][0] <= offset:
+            appended = conn.times.popleft()[1]
+        if appended is not None:
+            self.lag = time.time() - appended
+            self.total_lag += self.lag
+            self.max_lag = max(self.max_lag, self.lag)
+            self.acks += 1
+        self.acked = max(self.acked, offset)
+        if self.lagging and self.acked >= self.changes.end:
+            log.info('Follower caught up, waiting for acknowledgements')
+            self.lagging = False
+        while self.waiters and (self.waiters[0].done or
+                                self.waiters[0].offset <= self.acked):
+            self.waiters.popleft().release()
+
+    def streaming(self):
+        for conn in self.followers:
+            if conn.streaming:
+                return True
+        return False
+
+    def sync(self, func, args):
+        """Call func(*args) once a follower has the changes made so far."""
+        offset = self.changes.end
+        if self.ack != 'sync' or self.acked >= offset or self.lagging or \
+           not self.streaming():
+            func(*args)
+            return
+        self.sync_waits += 1
+        waiter = _waiter(offset, func, args)
+        waiter.timer = bare_sched.call_later(self.sync_timeout,
+                                             _expired(self, waiter).fire)
+        self.waiters.append(waiter)
+
+    def release(self):
+        """Answer every held reply."""
+        while self.waiters:
+            self.waiters.popleft().release()
+
+    def gone(self, conn):
+        if conn in self.followers:
+            self.followers.remove(conn)
+        if self.waiters and not self.streaming():
+            log.warning('No follower streaming, answering {} held '
+                        'deliveries'.format(len(self.waiters)))
+            self.release()
+
+    def stats(self):
+        """Return the replication metrics as a dictionary.
+
+        lag is the time from a change being logged to a follower
+        acknowledging it.
+        """
+        mean = 0.0
+        if self.acks:
+            mean = self.total_lag / self.acks
+        followers = {}
+        for conn in self.followers:
+            followers['{}:{}'.format(*conn.addr)] = dict(
+                streaming=conn.streaming, position=conn.position,
+                acked=conn.acked, behind=self.changes.end - conn.acked,
+                sent=conn.sent, fetched=conn.fetched)
+        return dict(id=self.changes.id, end=self.changes.end,
+                    oldest=self.changes.oldest(), records=self.records,
+                    snapshots=self.snapshots, acks=self.acks, lag=self.lag,
+                    mean_lag=mean, max_lag=self.max_lag,
+                    sync_waits=self.sync_waits,
+                    sync_timeouts=self.sync_timeouts, lagging=self.lagging,
+                    waiting=len(self.waiters), followers=followers)
+
+    def close(self):
+        bare_maildir.remove_listener(self.changed)
+        asyncore.dispatcher.close(self)
+        for conn in list(self.followers):
+            conn.close()
+        self.release()
+        self.changes.close()
+
+class _leader_conn(asynchat.async_chat):
+    """The connection of a follower to its leader."""
+
+    def __init__(self, follower):
+        asynchat.async_chat.__init__(self)
+        self.follower = follower
+        self.set_terminator(CRLF)
+        self.buffer = []
+        # the add record whose file is being read
+        self.record = None
+        # the names of a snapshot being read
+        self.names = None
+        self.closed = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect(follower.address)
+
+    def handle_connect(self):
+        log.info('Connected to leader {}:{}'.format(*self.follower.address))
+        self.follower.connected(self)
+
+    def readable(self):
+        """Stop reading while the changes received wait to be applied"""
+        return self.follower.queued_bytes < self.follower.window
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        data = ''.join(self.buffer)
+        self.buffer = []
+        if self.record is not None:
+            record = self.record
+            self.record = None
+            self.set_terminator(CRLF)
+            self.follower.receive(record, data)
+            return
+        if self.names is not None:
+            if data == '.':
+                names = self.names
+                self.names = None
+                self.follower.snapshot(names)
+            else:
+                self.names.add(data)
+            return
+        record = json.loads(data)
+        if record['op'] == 'snapshot':
+            self.names = set()
+            self.follower.snapshot_start(record)
+        elif record['op'] == 'add' and record['size']:
+            self.record = record
+            self.set_terminator(record['size'])
+        elif record['op'] == 'add' and record['size'] == 0:
+            self.follower.receive(record, '')
+        else:
+            self.follower.receive(record, None)
+
+    def handle_error(self):
+        err = sys.exc_info()[1]
+        if isinstance(err, socket.error):
+            log.warning('Connection to leader failed - {}'.format(err))
+        else:
+            log.exception('Connection to leader error')
+        self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        asynchat.async_chat.close(self)
+        self.follower.disconnected(self)
+
+class replica_follower():
+    """Apply the changes streamed by the leader to the maildir."""
+
+    def __init__(self, cfgdict, dirname):
+        """cfgdict gives the leader's "host" and "port" and may give
+        "state", the file the applied log position is kept in, defaulting
+        to the maildir name with '.replica' appended, "batch", the most
+        changes applied at a time, "window", the bytes of changes received
+        before reading pauses, and "retry_min" and "retry_max", the
+        seconds between attempts to reach the leader.
+        """
+        self.address = (cfgdict['host'], int(cfgdict['port']))
+        self.dirname = dirname
+        self.state = cfgdict.get('state', dirname.rstrip('/') + '.replica')
+        self.batch = int(cfgdict.get('batch', 500))
+        self.window = int(cfgdict.get('window', 16 << 20))
+        self.retry_min = float(cfgdict.get('retry_min', 1))
+        self.retry_max = float(cfgdict.get('retry_max', 30))
+        self.mbx = bare_maildir.BareMaildir(dirname, scan=False,
+                                            listing=False)
+        self.log_id, self.applied = self.load_state()
+        # position of the last change received
+        self.received = self.applied
+        # (record, file data) waiting to be applied
+        self.queue = collections.deque()
+        self.queued_bytes = 0
+        self.applying = False
+        self.started = 0.0
+        self.conn = None
+        self.streaming = False
+        # the snapshot being caught up with and the files still to fetch
+        self.catching_up = None
+        self.fetching = None
+        self.failures = 0
+        self.retry_timer = None
+        self.closed = False
+
+        # replication metrics
+        self.copied = 0
+        self.unlinked = 0
+        self.batches = 0
+        self.apply_time = 0.0
+        self.snapshots = 0
+        self.connects = 0
+        log.info('Following {}:{} into {} from {} {}'.format(
+            self.address[0], self.address[1], dirname, self.log_id,
+            self.applied))
+        self.connect()
+
+    def load_state(self):
+        """Return the id and position of the log last applied."""
+        try:
+            f = open(self.state)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None, 0
+        try:
+            state = json.load(f)
+        finally:
+            f.close()
+        return str(state['id']), int(state['offset'])
+
+    def save_state(self, log_id, offset):
+        """Record the position applied.  Runs on a disk I/O thread."""
+        tmp_name = self.state + '.tmp'
+        f = open(tmp_name, 'w')
+        json.dump({'id': log_id, 'offset': offset}, f)
+        bare_maildir._sync_close(f)
+        os.rename(tmp_name, self.state)
+        bare_maildir._sync_dir(os.path.dirname(os.path.abspath(self.state)))
+
+    def connect(self):
+        self.retry_timer = None
+        try:
+            self.conn = _leader_conn(self)
+        except Exception:
+            log.exception('Connect to leader {}:{} failed'.format(
+                *self.address))
+            self.conn = None
+            self.backoff()
+
+    def connected(self, conn):
+        self.failures = 0
+        self.connects += 1
+        conn.push('FOLLOW {} {}'.format(self.log_id or '-', self.received) +
+                  CRLF)
+
+    def disconnected(self, conn):
+        if conn is not self.conn:
+            return
+        self.conn = None
+        self.streaming = False
+        if self.catching_up is not None:
+            log.warning('Snapshot abandoned')
+            self.catching_up = None
+            self.fetching = None
+        if not self.closed:
+            self.backoff()
+
+    def backoff(self):
+        """Wait before reconnecting, doubling the wait on each failure."""
+        if self.retry_timer is not None:
+            return
+        delay = min(self.retry_max, self.retry_min * (2 ** self.failures))
+        self.failures += 1
+        log.info('Leader reconnect in {:.0f}s'.format(delay))
+        self.retry_timer = bare_sched.call_later(delay, self.connect)
+
+    def receive(self, record, data):
+        """Queue a change from the leader."""
+        if record['op'] == 'start':
+            self.streaming = True
+            log.info('Streaming changes of {} from {}'.format(
+                record['id'], record['offset']))
+            return
+        self.queue.append((record, data))
+        if data:
+            self.queued_bytes += len(data)
+        if record.get('offset') is not None:
+            self.received = record['offset']
+        self.apply()
+
+    def snapshot_start(self, record):
+        log.info('Catching up from a snapshot of {} messages'.format(
+            record['count']))
+        self.snapshots += 1
+        self.streaming = False
+        self.catching_up = record
+        self.fetching = None
+
+    def snapshot(self, names):
+        """The names of the leader's messages are in.  Compare them with
+        the maildir once the changes queued before are applied.
+        """
+        self.queue.append(({'op': 'compare'}, names))
+        self.apply()
+
+    def apply(self):
+        """Hand the next batch of changes to the disk I/O threads."""
+        if self.applying or not self.queue:
+            return
+        batch = []
+        while self.queue and len(batch) < self.batch:
+            record, data = self.queue.popleft()
+            if record['op'] == 'add' and data:
+                self.queued_bytes -= len(data)
+            batch.append((record, data))
+        self.applying = True
+        self.started = time.time()
+        bare_io.run(self.write, (batch, self.log_id), self.written)
+
+    def write(self, batch, log_id):
+        """Apply a batch of changes and sync them.  Runs on a disk I/O
+        thread.  Returns (changes, last position, missing files, files
+        fetched).
+        """
+        changes = []
+        offset = None
+        missing = None
+        fetched = 0
+        for record, data in batch:
+            op = record['op']
+            if op in ('add', 'remove') and \
+               not _message_name(record['name']):
+                log.error('Skipping change to {!r}, not a message '
+                          'name'.format(record['name']))
+                op = None
+            if op == 'add':
+                if data is not None:
+                    msg = self.mbx.copy_in(str(record['name']), data,
+                                           record['mtime'])
+                    if msg is not None:
+                        changes.append(('add', msg))
+                if record.get('offset') is None:
+                    fetched += 1
+            elif op == 'remove':
+                msg = _change(self.dirname, str(record['name']))
+                if self.mbx._unlink(msg):
+                    changes.append(('remove', msg))
+            elif op == 'compare':
+                missing = self.compare(data, changes)
+            if record.get('offset') is not None:
+                offset = record['offset']
+        bare_maildir._sync_dir(self.dirname)
+        for shard_dir in self.mbx._shards:
+            bare_maildir._sync_dir(shard_dir)
+        if offset is not None:
+            self.save_state(log_id, offset)
+        return changes, offset, missing, fetched
+
+    def compare(self, names, changes):
+        """Unlink the files not in names and return the names of those
+        missing.
+        """
+        local = _names(self.dirname)
+        for name in list(names):
+            if not _message_name(name):
+                log.error('Ignoring snapshot name {!r}'.format(name))
+                names.discard(name)
+        for name in local - names:
+            msg = _change(self.dirname, name)
+            if self.mbx._unlink(msg):
+                changes.append(('remove', msg))
+        missing = list(names - local)
+        missing.sort()
+        return missing
+
+    def written(self, result, error):
+        """A batch is applied.  Announce it and acknowledge it."""
+        self.applying = False
+        self.batches += 1
+        self.apply_time += time.time() - self.started
+        if error is not None:
+            log.error('Error applying changes, catching up again - '
+                      '{}'.format(error))
+            self.log_id = None
+            self.received = 0
+            self.queue.clear()
+            self.queued_bytes = 0
+            if self.conn is not None:
+                self.conn.close()
+            return
+        changes, offset, missing, fetched = result
+        for event, msg in changes:
+            if event == 'add':
+                self.copied += 1
+                self.mbx.added(msg)
+            else:
+                self.unlinked += 1
+                self.mbx.removed([msg])
+        if offset is not None:
+            self.applied = offset
+            if self.streaming:
+                self.conn.push('ACK {}'.format(offset) + CRLF)
+        if self.catching_up is not None:
+            if missing is not None:
+                log.info('Snapshot: fetching {} messages'.format(
+                    len(missing)))
+                self.fetching = len(missing)
+                for name in missing:
+                    self.conn.push('FETCH {}'.format(name) + CRLF)
+            elif self.fetching is not None:
+                self.fetching -= fetched
+            if self.fetching == 0:
+                self.caught_up()
+        self.apply()
+
+    def caught_up(self):
+        """The maildir matches the snapshot.  Follow the log from it."""
+        record = self.catching_up
+        self.catching_up = None
+        self.fetching = None
+        self.log_id = str(record['id'])
+        self.received = record['offset']
+        log.info('Caught up with snapshot at {}'.format(self.received))
+        # recorded once the files fetched are synced
+        self.queue.append(({'op': 'mark', 'offset': self.received}, None))
+        self.conn.push('FOLLOW {} {}'.format(self.log_id, self.received) +
+                       CRLF)
+        self.apply()
+
+    def stats(self):
+        """Return the replication metrics as a dictionary."""
+        return dict(connected=self.conn is not None,
+                    streaming=self.streaming, id=self.log_id,
+                    received=self.received, applied=self.applied,
+                    queued=len(self.queue), fetching=self.fetching,
+                    copied=self.copied, unlinked=self.unlinked,
+                    batches=self.batches, apply_time=self.apply_time,
+                    snapshots=self.snapshots, connects=self.connects)
+
+    def close(self):
+        self.closed = True
+        if self.retry_timer is not None:
+            self.retry_timer.cancel()
+            self.retry_timer = None
+        if self.conn is not None:
+            self.conn.close()
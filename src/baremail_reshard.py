@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Reshard a BareMail maildir in place
+
+Moves every message of a maildir into the directory given by a new shard
+layout, then removes shard directories left empty.  Messages are moved by
+rename so the maildir is never copied.  Run it while BareMail is stopped,
+or expect POP3 sessions open during the move to report missing messages.
+
+Deletions committed by POP3 clients but not yet carried out by the reaper
+are finished first, since the purge files name messages by the paths the
+move would change.
+
+Usage: baremail_reshard.py <maildir> flat|hash|time [--width N] [--bucket S]
+"""
+
+import argparse
+import bare_maildir
+import bare_reaper
+import errno
+import logging
+import os
+import os.path
+import sys
+
+# create logger
+log = logging.getLogger('baremail.reshard')
+
+def reshard(dirname, layout, width, bucket):
+    """Move the messages of dirname to the shard layout and return a count."""
+    purged = bare_reaper.finish(dirname)
+    if purged:
+        log.info('Unlinked {} messages left by the reaper'.format(purged))
+    mbx = bare_maildir.BareMaildir(dirname)
+    moved = 0
+    made = set()
+    touched = set()
+    for msg in mbx.items():
+        shard = bare_maildir.shard_name(msg.basename, msg.mtime,
+                                        layout, width, bucket)
+        if shard is None:
+            dest_dir = dirname
+        else:
+            dest_dir = os.path.join(dirname, shard)
+        if os.path.dirname(msg.path) == dest_dir:
+            continue
+        if dest_dir not in made and not os.path.isdir(dest_dir):
+            os.mkdir(dest_dir, 0o700)
+        made.add(dest_dir)
+        os.rename(msg.path, os.path.join(dest_dir, msg.basename))
+        touched.add(os.path.dirname(msg.path))
+        moved += 1
+    for path in made | touched:
+        if os.path.isdir(path):
+            bare_maildir._sync_dir(path)
+    for fname in os.listdir(dirname):
+        if fname.startswith(bare_maildir.SHARD_PREFIX):
+            try:
+                os.rmdir(os.path.join(dirname, fname))
+            except OSError as e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                    raise
+    bare_maildir._sync_dir(dirname)
+    return moved
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Reshard a BareMail maildir')
+    parser.add_argument('maildir')
+    parser.add_argument('layout', choices=('flat',) + bare_maildir.LAYOUTS)
+    parser.add_argument('--width', type=int, default=2,
+                        help='hex digits per hash shard (default 2)')
+    parser.add_argument('--bucket', type=int, default=86400,
+                        help='seconds per time shard (default 86400)')
+    opts = parser.parse_args()
+
+    layout = opts.layout
+    if layout == 'flat':
+        layout = None
+    try:
+        bare_maildir.shard_options(dict(layout=layout, width=opts.width,
+                                        bucket=opts.bucket))
+        count = reshard(opts.maildir, layout, opts.width, opts.bucket)
+    except Exception as msg:
+        log.exception('Reshard failed - {}'.format(msg))
+        sys.exit(1)
+    log.info('Moved {} messages'.format(count))
+    sys.exit(0)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""Deliver mail from standard input straight into the BareMail maildir
+
+A stand-in for 'sendmail' for daemons on the BareMail host.  The message
+is read from standard input and stored in the maildir named by the BareMail
+configuration file, with no SMTP round trip.  A running BareMail server
+picks the message up from the maildir journal without rescanning.
+
+Recipients and the usual sendmail options (-t, -i, -oi, -f, -F, -o...) are
+accepted and ignored, since BareMail keeps every message in one mailbox.
+
+With --batch, standard input is an mbox stream.  It is read as it is
+stored, BATCH messages at a time, each batch with one group of disk syncs,
+so memory and open files stay bounded however long the stream.
+
+The configuration file is given with -C or the BAREMAIL_CONFIG environment
+variable.  A relative maildir is taken from the daemon working directory
+when the configuration has one, and from the current directory otherwise.
+The caller needs write access to the maildir.
+
+Exit status follows sendmail: 0 on success, 64 for usage errors and 75
+when the message could not be stored and should be retried.
+"""
+
+import bare_maildir
+import calendar
+import json
+import logging
+import os
+import os.path
+import re
+import sys
+import time
+
+# create logger
+log = logging.getLogger('baremail.sendmail')
+
+EX_OK = 0
+EX_USAGE = 64
+EX_TEMPFAIL = 75
+
+# Options that take a value as the next argument when given alone.
+VALUE_OPTS = ('-C', '-f', '-F', '-r', '-o', '-O', '-B', '-N', '-R', '-V',
+              '-X', '-L', '-p', '-q', '-h')
+
+FROM_LINE = re.compile(r'^>+From ')
+
+# Most messages, and message bytes, --batch stores with one group of syncs.
+BATCH = 500
+BATCH_BYTES = 64 << 20
+
+def usage():
+    print('Usage: {} [-C config] [--batch] [-t] [-i] [-f sender] '
+          '[recipient ...]'.format(sys.argv[0]))
+
+def parse_args(args):
+    """Return (config file, batch, dot ends message) from sendmail arguments."""
+    cfile_name = os.environ.get('BAREMAIL_CONFIG')
+    batch = False
+    dot_ends = True
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '--batch':
+            batch = True
+        elif arg == '--':
+            break
+        elif arg in ('-i', '-oi'):
+            dot_ends = False
+        elif arg.startswith('-C'):
+            if arg == '-C':
+                i += 1
+                cfile_name = args[i]
+            else:
+                cfile_name = arg[2:]
+        elif arg in VALUE_OPTS:
+            i += 1
+        i += 1
+    return cfile_name, batch, dot_ends
+
+def to_crlf(lines):
+    """Join message lines with CRLF as the SMTP server stores them."""
+    out = []
+    for line in lines:
+        out.append(line.rstrip('\r\n'))
+    return '\r\n'.join(out)
+
+def read_message(stream, dot_ends):
+    """Read one message from stream, ending at EOF or a lone '.' line."""
+    lines = []
+    for line in stream:
+        if dot_ends and line.rstrip('\r\n') == '.':
+            break
+        lines.append(line)
+    return to_crlf(lines)
+
+def from_time(line):
+    """Return the time of an mbox 'From ' line, or None."""
+    try:
+        return calendar.timegm(time.strptime(line.rstrip()[-24:],
+                                             '%a %b %d %H:%M:%S %Y'))
+    except ValueError:
+        return None
+
+def read_mbox(stream):
+    """Yield (mtime, message) for the messages of an mbox stream, mtime
+    being the time of its 'From ' line or None.
+    """
+    mtime = None
+    lines = None
+    for line in stream:
+        if line.startswith('From '):
+            if lines is not None:
+                yield mtime, to_crlf(trim(lines))
+            mtime = from_time(line)
+            lines = []
+            continue
+        if lines is None:
+            lines = []
+        if FROM_LINE.match(line):
+            line = line[1:]
+        lines.append(line)
+    if lines is not None:
+        yield mtime, to_crlf(trim(lines))
+
+def trim(lines):
+    """Drop the blank line mbox places before each From_ line."""
+    if lines and lines[-1].strip('\r\n') == '':
+        return lines[:-1]
+    return lines
+
+def maildir_path(cfgdict):
+    maildir = cfgdict['servers']['maildir']
+    if not os.path.isabs(maildir) and cfgdict.has_key('daemon'):
+        maildir = os.path.join(cfgdict['daemon']['working_dir'], maildir)
+    return maildir
+
+def deliver(maildir, messages):
+    """Store messages and list them in the journal.  Returns their paths."""
+    mbx = bare_maildir.BareMaildir(maildir, scan=False)
+    mbx.add_many(messages)
+    paths = []
+    for msg in mbx.items():
+        paths.append(msg.path)
+    bare_maildir.journal_append(maildir, paths)
+    return paths
+
+def deliver_stream(maildir, records):
+    """Deliver the messages of an iterable of (mtime, message), as
+    read_mbox() yields them, a batch at a time.  They are delivered now,
+    not at mtime.
+
+    Returns the number delivered.  Each batch is in the journal before the
+    next is read, so a failure leaves the earlier batches delivered.
+    """
+    count = 0
+    batch = []
+    size = 0
+    for mtime, msg_str in records:
+        batch.append(msg_str)
+        size += len(msg_str)
+        if len(batch) >= BATCH or size >= BATCH_BYTES:
+            deliver(maildir, batch)
+            count += len(batch)
+            batch = []
+            size = 0
+    if batch:
+        deliver(maildir, batch)
+        count += len(batch)
+    return count
+
+def main(args):
+    logging.basicConfig(level=logging.WARNING)
+    cfile_name, batch, dot_ends = parse_args(args)
+    if not cfile_name:
+        print('Error: missing configuration file name')
+        usage()
+        return EX_USAGE
+    try:
+        cfile = open(cfile_name, 'r')
+        cfgdict = json.load(cfile)
+        cfile.close()
+        bare_maildir.configure(cfgdict.get('storage', {}))
+        maildir = maildir_path(cfgdict)
+    except Exception as msg:
+        print('Configuration file error - {}'.format(msg))
+        return EX_USAGE
+    if bare_maildir.BACKEND != 'maildir':
+        print('Error: direct delivery needs the maildir backend, use SMTP')
+        return EX_USAGE
+
+    try:
+        if batch:
+            deliver_stream(maildir, read_mbox(sys.stdin))
+        else:
+            deliver(maildir, [read_message(sys.stdin, dot_ends)])
+    except Exception as msg:
+        log.exception('Delivery failed - {}'.format(msg))
+        return EX_TEMPFAIL
+    return EX_OK
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
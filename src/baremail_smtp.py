@@ -6,15 +6,54 @@ features always return positive responses.
 
 import asynchat
 import asyncore
+import bare_digest
+import bare_filter
 import bare_maildir
+import bare_sched
+import bare_server
+import baremail_relay
+import baremail_replica
 import logging
+import re
 import socket
+import time
 
 # create logger
 log = logging.getLogger('baremail.smtp')
 
 CRLF = '\r\n'
 
+# Seconds a client may take before its first command, to finish a command
+# line it has started, to send its next command and to send the next part
+# of a message after DATA.  Replaced by the "timeouts" of an SMTP server
+# entry.
+TIMEOUTS = dict(greeting=60, command=60, idle=300, data=180)
+
+# Seconds a timed out client is given to read the 421 reply.
+LINGER = 10
+
+# address in a MAIL FROM:<...> or RCPT TO:<...> argument
+PATH = re.compile(r'^(?:FROM|TO):\s*<?([^<>\s]*)>?', re.IGNORECASE)
+
+# This host's name, looked up by the first session.  See server_name().
+_fqdn = None
+
+def server_name():
+    """Return the fully qualified name of this host, looked up once."""
+    global _fqdn
+    if _fqdn is None:
+        _fqdn = socket.getfqdn()
+    return _fqdn
+
+class _relayed():
+    """Completion of the relay queueing of a delivered message."""
+    def __init__(self, handler, msg_id):
+        self.handler = handler
+        self.msg_id = msg_id
+
+    def done(self, error):
+        self.handler.relayed(self.msg_id, error)
+
 class smtp_handler(asynchat.async_chat):
     """Service an individual POP3 connection.
 
@@ -26,23 +65,90 @@ class smtp_handler(asynchat.async_chat):
     STATE_COMMAND = 0
     STATE_DATA = 1
 
-    def __init__(self, sock, mb_name):
+    # the method serving each command
+    commands = dict(EHLO='handleHelo', HELO='handleHelo', MAIL='handleMail',
+                    RCPT='handleRcpt', DATA='handleData', RSET='handleRset',
+                    NOOP='handleOK', QUIT='handleQuit')
+
+    def __init__(self, sock, mb_name, timeouts=TIMEOUTS):
         """Initialize minimal state and return greeting to client
+
+        Sessions share the host name and a mailbox that lists no
+        messages, so a new session costs little however large the
+        mailbox.
         """
-        log.debug('new smpt handler - {}'.format(mb_name))
         asynchat.async_chat.__init__(self, sock=sock)
-        self.dispatch = dict(EHLO=self.handleHelo, HELO=self.handleHelo,
-                             MAIL=self.handleOK, RCPT=self.handleOK,
-                             DATA=self.handleData, RSET=self.handleOK,
-                             NOOP=self.handleOK, QUIT=self.handleQuit)
-        self.fqdn = socket.getfqdn()
-        self.mbx = bare_maildir.BareMaildir(mb_name)
+        self.fqdn = server_name()
+        self.mbx = bare_maildir.delivery_mailbox(mb_name)
         self.set_terminator(CRLF)
         self.buffer = []
         self.data = []
+        self.sender = ''
+        self.recipients = []
+        # lines received while a message is filtered and stored
+        self.storing = False
+        self.held = []
+        self.message = None
         self.state = self.STATE_COMMAND
+        # session timeout, checked by the timer wheel
+        self.timeouts = timeouts
+        self.greeted = False
+        self.expired = False
+        self.touch()
+        bare_sched.watch(self)
         self.push('220 {}'.format(self.fqdn))
 
+    def handle_read(self):
+        asynchat.async_chat.handle_read(self)
+        self.touch()
+
+    def handle_write(self):
+        self.touch()
+        asynchat.async_chat.handle_write(self)
+
+    def handle_close(self):
+        bare_sched.unwatch(self)
+        asynchat.async_chat.handle_close(self)
+
+    def touch(self):
+        """Set the deadline for the client's next move
+        """
+        if self.expired:
+            return
+        if self.state == self.STATE_DATA:
+            timeout = self.timeouts['data']
+        elif not self.greeted:
+            timeout = self.timeouts['greeting']
+        elif self.buffer:
+            timeout = self.timeouts['command']
+        else:
+            timeout = self.timeouts['idle']
+        self.deadline = time.time() + timeout
+
+    def timed_out(self):
+        """Close a session whose client has gone quiet
+
+        Called by the timer wheel.  A message being stored is not a
+        reason to time out.  A client that does not read the 421 reply
+        is dropped LINGER seconds later.
+        """
+        if self.expired:
+            log.info('Dropping SMTP client that did not read 421')
+            self.handle_close()
+            return
+        if self.storing:
+            self.touch()
+            bare_sched.watch(self)
+            return
+        log.info('SMTP session timed out')
+        self.expired = True
+        self.set_terminator(None)
+        self.data = []
+        self.push('421 {} Timeout, closing connection'.format(self.fqdn))
+        self.close_when_done()
+        self.deadline = time.time() + LINGER
+        bare_sched.watch(self)
+
     def collect_incoming_data(self, data):
         """Marshal data chunks into buffer
         """
@@ -58,26 +164,27 @@ class smtp_handler(asynchat.async_chat):
 
         In the DATA state, client input lines are handed off to runData()
         to be marshalled into a message for the mailbox.
+
+        Input that arrives while a message is filtered and stored is held
+        until the client has been answered.
         """
         msg = ''.join(self.buffer)
+        self.greeted = True
+        if self.storing:
+            self.held.append(msg)
+            self.buffer = []
+            return
         if self.state == self.STATE_COMMAND:
-            args = ''
             if msg:
-                command = msg.split(None, 1)
-                cmd = command[0].upper()
-                if len(command) > 1:
-                    args = command[1]
-                log.debug('C: {} {}'.format(cmd, args))
-                try:
-                    smtp_cmd = self.dispatch[cmd]
-                except KeyError:
-                    log.debug('S: 502 Command not implemented')
+                cmd, args = bare_server.parse_command(msg, self.commands)
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug('C: {} {}'.format(cmd, args))
+                name = self.commands.get(cmd)
+                if name is None:
                     self.push('502 Command not implemented')
                 else:
-                    ret_str = smtp_cmd(cmd, args)
-                    log.debug('S: {}'.format(ret_str))
-                    self.push(ret_str)
-                    if smtp_cmd == self.handleQuit:
+                    self.push(getattr(self, name)(cmd, args))
+                    if cmd == 'QUIT':
                         log.info('Closing connection')
                         self.close_when_done()
             else:
@@ -85,7 +192,6 @@ class smtp_handler(asynchat.async_chat):
         elif self.state == self.STATE_DATA:
             ret_str = self.runData(msg)
             if ret_str:
-                log.debug('S: {}'.format(ret_str))
                 self.push(ret_str)
         else:
             self.push('451 Internal confusion')
@@ -99,7 +205,8 @@ class smtp_handler(asynchat.async_chat):
         Every response to client ends in CRLF.  Adding it here
         ensures consistency.
         """
-        log.debug('S:{}'.format(msg))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('S: {}'.format(msg))
         asynchat.async_chat.push(self, msg + CRLF)
 
     def runData(self, msg):
@@ -108,30 +215,81 @@ class smtp_handler(asynchat.async_chat):
         In the DATA state, the client is sending the messages one line at
         a time.  Here the individual lines are collected until the message
         terminator is received.  At that time, the message is converted to
-        the mail box format and stored then the state is returned to COMMAND
-        mode.
+        the mail box format and handed to the filters, which pass it on to
+        store(), then the state is returned to COMMAND mode.
         """
         ret_str = ''
-        log.debug('C: {}'.format(msg))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('C: {}'.format(msg))
         if msg == '.':
             msg = CRLF.join(self.data)
-            # write to mailbox
-            try:
-                log.info('accessing mbx in runData()')
-                msg_id = self.mbx.add(msg)
-                ret_str = '250 Ok: queued as {}'.format(msg_id)
-            except Exception as e:
-                ret_str = '451 could not save message {}'.format(msg_id)
-                log.exception('Error writing mailbox {}'.format(e))
-                msg_id = 'Error!!'
             self.data = []
             self.state = self.STATE_COMMAND
+            self.storing = True
+            bare_filter.run(msg, self.store)
         elif msg and msg[0] == '.':
             self.data.append(msg[1:])
         else:
             self.data.append(msg)
         return ret_str
 
+    def store(self, msg, action):
+        """Store a message that has passed the filters
+
+        Called by the filter pipeline, possibly after runData() has
+        returned.  The message is written by the disk I/O threads and the
+        client is answered from delivered().
+        """
+        if action is not None and action[0] == 'drop':
+            self.answer('250 Ok: dropped')
+            return
+        mbx = self.mbx
+        if action is not None:
+            mbx = bare_filter.pipeline.mailbox(action[1])
+        log.info('accessing mbx in store()')
+        self.message = msg
+        bare_digest.deliver(mbx, self.sender, msg, self.delivered)
+
+    def delivered(self, msg_id, error):
+        """Answer the client once the message is safely on disk, and on
+        a follower if replication acknowledges synchronously
+        """
+        if error is not None:
+            log.error('Error writing mailbox {}'.format(error))
+            self.message = None
+            self.answer('451 could not save message')
+            return
+        message = self.message
+        self.message = None
+        baremail_relay.enqueue(self.sender, self.recipients, message,
+                               _relayed(self, msg_id).done)
+
+    def relayed(self, msg_id, error):
+        """Answer the client once copies for the smarthost are queued"""
+        if error is not None:
+            log.error('Error queueing relay {}'.format(error))
+        baremail_replica.sync(self.answer,
+                              '250 Ok: queued as {}'.format(msg_id))
+
+    def answer(self, ret_str):
+        """Send the reply to a message and process held input
+        """
+        self.sender = ''
+        self.recipients = []
+        self.storing = False
+        if self.connected:
+            self.push(ret_str)
+        while self.held and not self.storing:
+            self.buffer = [self.held.pop(0)]
+            self.found_terminator()
+
+    def readable(self):
+        """Stop reading while a message is filtered and stored
+        """
+        if self.storing:
+            return False
+        return asynchat.async_chat.readable(self)
+
     def handleHelo(self, cmd, args):
         """Acknowlege client with this server's domain name
         """
@@ -142,6 +300,33 @@ class smtp_handler(asynchat.async_chat):
         """
         return '250 Ok'
 
+    def handleMail(self, cmd, args):
+        """Start a new transaction from the given sender
+        """
+        match = PATH.match(args)
+        if match is None:
+            return '501 Syntax: MAIL FROM:<address>'
+        self.sender = match.group(1)
+        self.recipients = []
+        return '250 Ok'
+
+    def handleRcpt(self, cmd, args):
+        """Add a recipient to the transaction
+        """
+        match = PATH.match(args)
+        if match is None or not match.group(1):
+            return '501 Syntax: RCPT TO:<address>'
+        self.recipients.append(match.group(1))
+        return '250 Ok'
+
+    def handleRset(self, cmd, args):
+        """Abandon the current transaction
+        """
+        self.sender = ''
+        self.recipients = []
+        self.data = []
+        return '250 Ok'
+
     def handleData(self, cmd, args):
         """Enter state DATA and acknowlege client with termination
         instruction.
@@ -156,14 +341,16 @@ class smtp_handler(asynchat.async_chat):
 class smtp_server(asyncore.dispatcher):
     """Listens on SMTP port and launch SMTP handler on connection.
     """
-    def __init__(self, host, port, mb_name):
-        log.info('Serving SMTP on {}:{}'.format(host, port))
+    def __init__(self, address, mb_name, timeouts=None):
+        """Listen on address, a (host, port) pair or a Unix socket path.
+
+        timeouts may replace any of the TIMEOUTS.
+        """
         self.mb_name = mb_name
+        self.timeouts = dict(TIMEOUTS)
+        self.timeouts.update(timeouts or {})
         asyncore.dispatcher.__init__(self)
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.set_reuse_addr()
-        self.bind((host, port))
-        self.listen(5)
+        bare_server.listen_on(self, address, 'SMTP')
 
     def handle_accept(self):
         """Creates handler for each SMTP connection.
@@ -173,5 +360,8 @@ class smtp_server(asyncore.dispatcher):
             sock, addr = pair
             log.info('Incoming SMTP connection from %s' % repr(addr))
             #handler = smtp_handler(sock, self.mb_name)
-            smtp_handler(sock, self.mb_name)
+            smtp_handler(sock, self.mb_name, self.timeouts)
 
+    def close(self):
+        """Stop listening and remove the socket file, if any."""
+        bare_server.unlisten(self)
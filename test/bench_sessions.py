@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""Microbenchmarks of the SMTP and POP3 session paths
+
+Measures the time from connecting to reading the greeting and the cost
+of each command, sent lock-step or pipelined, against servers started in
+this process on a scratch maildir:
+
+    test/bench_sessions.py --messages 5000
+
+Compare runs before and after a change to the session code.  The numbers
+include the client, so only differences between runs mean anything.
+"""
+
+import argparse
+import logging
+import os
+import os.path
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+import support
+
+import bare_io
+import bare_maildir
+import baremail_pop3
+import baremail_smtp
+
+CRLF = '\r\n'
+
+class client():
+    """A blocking client reading CRLF terminated lines."""
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.data = ''
+
+    def readline(self):
+        while CRLF not in self.data:
+            block = self.sock.recv(65536)
+            if not block:
+                raise EOFError('connection closed')
+            self.data += block
+        line, self.data = self.data.split(CRLF, 1)
+        return line
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        self.sock.close()
+
+def greeting(port, count):
+    """Return the mean and 99th percentile seconds to the greeting."""
+    times = []
+    for i in xrange(count):
+        start = time.time()
+        c = client(port)
+        c.readline()
+        times.append(time.time() - start)
+        c.send('QUIT' + CRLF)
+        c.readline()
+        c.close()
+    times.sort()
+    return sum(times) / count, times[int(count * 0.99)]
+
+def per_command(port, commands, count, pipelined):
+    """Return the seconds per command of commands sent count times.
+
+    commands holds one or more CRLF terminated command lines, each
+    answered by one line.
+    """
+    lines = commands.count(CRLF)
+    c = client(port)
+    c.readline()
+    start = time.time()
+    if pipelined:
+        c.send(commands * count)
+        for i in xrange(count * lines):
+            c.readline()
+    else:
+        for i in xrange(count):
+            c.send(commands)
+            for j in xrange(lines):
+                c.readline()
+    elapsed = time.time() - start
+    c.close()
+    return elapsed / (count * lines)
+
+def fill(dirname, count):
+    """Deliver count small messages to maildir dirname."""
+    mbx = bare_maildir.BareMaildir(dirname)
+    batch = []
+    for i in xrange(count):
+        batch.append('Subject: {}\r\n\r\nbody\r\n'.format(i))
+        if len(batch) == 500:
+            mbx.add_many(batch)
+            batch = []
+    if batch:
+        mbx.add_many(batch)
+
+def report(name, seconds):
+    print('{:<36} {:10.1f} us'.format(name, seconds * 1e6))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time SMTP and POP3 greetings and commands')
+    parser.add_argument('--messages', type=int, default=5000,
+                        help='messages in the POP3 maildir')
+    parser.add_argument('--connections', type=int, default=500,
+                        help='connections timed for the greeting')
+    parser.add_argument('--commands', type=int, default=20000,
+                        help='commands timed per measurement')
+    opts = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    support.start_loop()
+    bare_io.configure({})
+    dirname = tempfile.mkdtemp()
+    try:
+        maildir = os.path.join(dirname, 'MailboxDir')
+        fill(maildir, opts.messages)
+        smtp = support.in_loop(baremail_smtp.smtp_server,
+                               ('127.0.0.1', 0), maildir)
+        pop3 = support.in_loop(baremail_pop3.pop3_server,
+                               ('127.0.0.1', 0), maildir)
+        smtp_port = smtp.socket.getsockname()[1]
+        pop3_port = pop3.socket.getsockname()[1]
+
+        mean, p99 = greeting(smtp_port, opts.connections)
+        report('SMTP greeting mean', mean)
+        report('SMTP greeting p99', p99)
+        # a POP3 session lists the maildir before the greeting
+        mean, p99 = greeting(pop3_port, opts.connections)
+        report('POP3 greeting mean', mean)
+        report('POP3 greeting p99', p99)
+
+        n = opts.commands
+        report('SMTP NOOP lock-step',
+               per_command(smtp_port, 'NOOP' + CRLF, n / 4, False))
+        report('SMTP NOOP pipelined',
+               per_command(smtp_port, 'NOOP' + CRLF, n, True))
+        report('SMTP MAIL/RCPT/RSET pipelined',
+               per_command(smtp_port, 'MAIL FROM:<a@b>' + CRLF +
+                           'RCPT TO:<c@d>' + CRLF + 'RSET' + CRLF,
+                           n / 3, True))
+        report('POP3 NOOP lock-step',
+               per_command(pop3_port, 'NOOP' + CRLF, n / 4, False))
+        report('POP3 NOOP pipelined',
+               per_command(pop3_port, 'NOOP' + CRLF, n, True))
+        report('POP3 STAT pipelined',
+               per_command(pop3_port, 'STAT' + CRLF, n, True))
+        support.in_loop(smtp.close)
+        support.in_loop(pop3.close)
+    finally:
+        shutil.rmtree(dirname)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""A stand-in smarthost for testing the BareMail relay
+
+Accepts SMTP connections and keeps every message it is sent.  It offers
+PIPELINING only when asked to.  Recipients matching the refuse pattern
+are answered 550 and those matching the defer pattern 450.
+
+Run alone it prints a line per message and the rate every few seconds:
+
+    test/smtp_sink.py --port 2525 --pipelining
+
+Tests start it in a thread with smtp_sink(...).start().
+
+.. warning::
+   The sink keeps every message in memory.  Use it for tests only.
+"""
+
+import argparse
+import re
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+CRLF = '\r\n'
+
+class sink_message():
+    """A message as the sink received it."""
+    def __init__(self, conn, sender, recipients, data):
+        self.conn = conn
+        self.sender = sender
+        self.recipients = recipients
+        self.data = data
+
+class sink_handler(SocketServer.StreamRequestHandler):
+    """Serve one SMTP connection."""
+
+    def handle(self):
+        sink = self.server.sink
+        conn = sink.connected()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reply('220 sink ready')
+        sender = None
+        recipients = []
+        while True:
+            try:
+                line = self.rfile.readline()
+            except socket.error:
+                # the client dropped the connection
+                return
+            if not line:
+                return
+            cmd = line[:4].upper()
+            arg = line[5:].strip()
+            if cmd == 'EHLO':
+                if sink.pipelining:
+                    self.reply('250-sink' + CRLF + '250-PIPELINING' + CRLF +
+                               '250 8BITMIME')
+                else:
+                    self.reply('250-sink' + CRLF + '250 8BITMIME')
+            elif cmd == 'HELO':
+                self.reply('250 sink')
+            elif cmd == 'MAIL':
+                sender = _address(arg)
+                recipients = []
+                self.reply('250 ok')
+            elif cmd == 'RCPT':
+                rcpt = _address(arg)
+                sink.rcpt_commands.append(rcpt)
+                if sink.refuse is not None and sink.refuse.search(rcpt):
+                    self.reply('550 no such user')
+                elif sink.defer is not None and sink.defer.search(rcpt):
+                    self.reply('450 try again later')
+                else:
+                    recipients.append(rcpt)
+                    self.reply('250 ok')
+            elif cmd == 'DATA':
+                if not recipients:
+                    self.reply('554 no valid recipients')
+                    continue
+                self.reply('354 go ahead')
+                lines = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == '.' + CRLF:
+                        break
+                    if line.startswith('.'):
+                        line = line[1:]
+                    lines.append(line)
+                sink.received(sink_message(conn, sender, recipients,
+                                           ''.join(lines)))
+                recipients = []
+                self.reply('250 queued')
+            elif cmd == 'RSET':
+                sender = None
+                recipients = []
+                self.reply('250 ok')
+            elif cmd == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+    def reply(self, text):
+        self.wfile.write(text + CRLF)
+        self.wfile.flush()
+
+def _address(arg):
+    """Return the address of a FROM:<...> or TO:<...> argument."""
+    arg = arg.split(':', 1)[-1].strip()
+    return arg.lstrip('<').split('>', 1)[0]
+
+class _server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class smtp_sink():
+    """A threaded SMTP sink listening on host and port.
+
+    port 0 picks a free port, found afterwards in address.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, pipelining=False,
+                 refuse=None, defer=None):
+        self.pipelining = pipelining
+        self.refuse = None
+        self.defer = None
+        if refuse:
+            self.refuse = re.compile(refuse)
+        if defer:
+            self.defer = re.compile(defer)
+        self.lock = threading.Condition()
+        self.messages = []
+        self.rcpt_commands = []
+        self.connections = 0
+        self.server = _server((host, port), sink_handler)
+        self.server.sink = self
+        self.address = self.server.server_address
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='smtp-sink')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def connected(self):
+        self.lock.acquire()
+        try:
+            self.connections += 1
+            return self.connections
+        finally:
+            self.lock.release()
+
+    def received(self, msg):
+        self.lock.acquire()
+        try:
+            self.messages.append(msg)
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+    def wait(self, count, timeout=10.0):
+        """Wait until count messages arrived.  Returns the messages."""
+        end = time.time() + timeout
+        self.lock.acquire()
+        try:
+            while len(self.messages) < count and time.time() < end:
+                self.lock.wait(end - time.time())
+            return list(self.messages)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Accept and count SMTP messages for relay tests')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2525)
+    parser.add_argument('--pipelining', action='store_true',
+                        help='offer PIPELINING')
+    parser.add_argument('--refuse', help='regex of recipients refused 550')
+    parser.add_argument('--defer', help='regex of recipients deferred 450')
+    parser.add_argument('--quiet', action='store_true',
+                        help='print only the rate')
+    opts = parser.parse_args()
+
+    sink = smtp_sink(opts.host, opts.port, opts.pipelining, opts.refuse,
+                     opts.defer).start()
+    print('SMTP sink on {}:{}'.format(*sink.address))
+    seen = 0
+    last = time.time()
+    try:
+        while True:
+            time.sleep(5)
+            messages = sink.wait(0, 0)
+            if not opts.quiet:
+                for msg in messages[seen:]:
+                    print('conn {} from {} to {} {} bytes'.format(
+                        msg.conn, msg.sender, ','.join(msg.recipients),
+                        len(msg.data)))
+            now = time.time()
+            print('{} messages, {:.1f} msg/s on {} connections'.format(
+                len(messages), (len(messages) - seen) / (now - last),
+                sink.connections))
+            seen = len(messages)
+            last = now
+    except KeyboardInterrupt:
+        sink.close()
+    sys.exit(0)
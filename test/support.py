@@ -0,0 +1,64 @@
+"""Helpers shared by the BareMail tests
+
+The servers run in the asyncore loop of bare_sched, started once in a
+background thread.  Tests build and drive them through in_loop() so only
+the loop thread touches them.
+"""
+
+import os
+import os.path
+import sys
+import threading
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+if SRC not in sys.path:
+    sys.path.insert(0, SRC)
+
+import bare_sched
+
+_loop = None
+
+class _call():
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+def start_loop():
+    """Start the bare_sched loop in a daemon thread, once."""
+    global _loop
+    if _loop is not None:
+        return
+    bare_sched.enable_wakeup()
+    _loop = threading.Thread(target=bare_sched.loop, name='baremail-loop')
+    _loop.daemon = True
+    _loop.start()
+
+def in_loop(func, *args):
+    """Call func(*args) in the loop thread and return its result."""
+    call = _call(func, args)
+    bare_sched.call_soon_threadsafe(call.run)
+    if not call.done.wait(10):
+        raise RuntimeError('loop did not run {}'.format(func))
+    if call.error is not None:
+        raise call.error
+    return call.result
+
+def wait_for(predicate, timeout=10.0):
+    """Poll predicate until it returns true.  Returns its last value."""
+    end = time.time() + timeout
+    while True:
+        value = predicate()
+        if value or time.time() > end:
+            return value
+        time.sleep(0.01)
@@ -0,0 +1,93 @@
+"""Export, import, sendmail and reshard tests"""
+
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+
+import support
+
+import bare_maildir
+import baremail_export
+import baremail_reshard
+import baremail_sendmail
+
+class archive_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.maildir = os.path.join(self.dir, 'MailboxDir')
+        self.mbx = bare_maildir.BareMaildir(self.maildir)
+
+    def tearDown(self):
+        bare_maildir._purging.clear()
+        shutil.rmtree(self.dir)
+
+    def exported(self):
+        uids = []
+        for mtime, uid, path in baremail_export.list_messages(self.maildir):
+            uids.append(uid)
+        return uids
+
+    def test_purged_not_exported(self):
+        messages = []
+        for i in range(3):
+            messages.append('Subject: {}\r\n\r\nbody'.format(i))
+        keys = self.mbx.add_many(messages)
+        self.mbx.delete(1)
+        purge_file, gone = self.mbx.condemn()
+        # the server stopped before its reaper unlinked the file
+        bare_maildir._purging.clear()
+        self.assertTrue(os.path.exists(gone[0].path))
+        self.assertEqual(sorted(self.exported()), sorted([keys[0], keys[2]]))
+        os.unlink(purge_file)
+        self.assertEqual(sorted(self.exported()), sorted(keys))
+
+    def test_reshard_finishes_purge(self):
+        messages = []
+        for i in range(3):
+            messages.append('Subject: {}\r\n\r\nbody'.format(i))
+        keys = self.mbx.add_many(messages)
+        self.mbx.delete(1)
+        purge_file, gone = self.mbx.condemn()
+        bare_maildir._purging.clear()
+        self.assertEqual(baremail_reshard.reshard(self.maildir, 'hash', 2,
+                                                  86400), 2)
+        self.assertFalse(os.path.exists(purge_file))
+        self.assertFalse(os.path.exists(gone[0].path))
+        listed = []
+        for msg in bare_maildir.BareMaildir(self.maildir).items():
+            self.assertTrue(os.path.basename(os.path.dirname(msg.path))
+                            .startswith(bare_maildir.SHARD_PREFIX))
+            listed.append(msg.basename)
+        self.assertEqual(sorted(listed), sorted([keys[0], keys[2]]))
+
+    def test_mbox_round_trip(self):
+        when = 1500000000
+        text = ''
+        for i, body in enumerate(['From here\r\n', '>From there\r\nend\r\n']):
+            text += ''.join(baremail_export.mbox_blocks(
+                when + i, ['Subject: {}\r\n\r\n'.format(i) + body]))
+        records = list(baremail_sendmail.read_mbox(text.splitlines(True)))
+        self.assertEqual(records, [
+            (when, 'Subject: 0\r\n\r\nFrom here'),
+            (when + 1, 'Subject: 1\r\n\r\n>From there\r\nend')])
+
+    def test_mbox_without_time(self):
+        records = list(baremail_sendmail.read_mbox(
+            ['From someone\n', 'Subject: x\n', '\n', 'body\n']))
+        self.assertEqual(records, [(None, 'Subject: x\r\n\r\nbody')])
+
+    def test_sendmail_batch_delivered_now(self):
+        start = time.time() - 1
+        records = [(1000000000, 'Subject: old\r\n\r\nbody')]
+        self.assertEqual(baremail_sendmail.deliver_stream(self.maildir,
+                                                          records), 1)
+        listed = baremail_export.list_messages(self.maildir)
+        self.assertEqual(len(listed), 1)
+        self.assertTrue(listed[0][0] >= start)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""Delivery filter tests
+
+Heavy filters run in the worker pool, so their callables live in this
+module where the workers can import them.
+"""
+
+import threading
+import time
+import unittest
+
+import support
+
+import bare_filter
+
+def slow_tag(msg_str):
+    time.sleep(1.0)
+    return ('tag', 'X-Slow: yes')
+
+def reroute(msg_str):
+    time.sleep(0.3)
+    return ('reroute', 'Elsewhere')
+
+def passing(msg_str):
+    time.sleep(0.3)
+    return None
+
+class _result():
+    def __init__(self):
+        self.done = threading.Event()
+        self.msg_str = None
+        self.action = None
+
+    def callback(self, msg_str, action):
+        self.msg_str = msg_str
+        self.action = action
+        self.done.set()
+
+MESSAGE = 'Subject: filtered\r\n\r\nbody\r\n'
+
+class filter_tests(unittest.TestCase):
+
+    def setUp(self):
+        support.start_loop()
+        self.pipeline = None
+
+    def tearDown(self):
+        if self.pipeline is not None:
+            support.in_loop(self.pipeline.close)
+
+    def configure(self, cfglist, timeout):
+        self.pipeline = support.in_loop(bare_filter.BareFilters, cfglist,
+                                        {'processes': 2, 'timeout': timeout})
+
+    def run_filters(self, msg_str=MESSAGE):
+        result = _result()
+        support.in_loop(self.pipeline.run, msg_str, result.callback)
+        self.assertTrue(result.done.wait(10))
+        return result
+
+    def test_inline(self):
+        self.configure([{'name': 'noise', 'header': 'subject',
+                         'match': '^filt', 'action': 'drop'}], 5)
+        result = self.run_filters()
+        self.assertEqual(result.action, ('drop', None))
+        self.assertEqual(self.pipeline.stats()['noise']['matches'], 1)
+
+    def test_heavy_tag(self):
+        self.configure([{'name': 'slow', 'heavy': True,
+                         'callable': 'test_filter.slow_tag'}], 5)
+        result = self.run_filters()
+        self.assertEqual(result.action, None)
+        self.assertEqual(result.msg_str, 'X-Slow: yes\r\n' + MESSAGE)
+
+    def test_late_result_ignored(self):
+        # slow times out; its tag arrives while passing runs and must not
+        # be applied, nor be taken for the verdict of passing
+        self.configure([{'name': 'slow', 'heavy': True,
+                         'callable': 'test_filter.slow_tag'},
+                        {'name': 'passing', 'heavy': True,
+                         'callable': 'test_filter.passing'},
+                        {'name': 'passing2', 'heavy': True,
+                         'callable': 'test_filter.passing'}], 0.8)
+        result = self.run_filters()
+        self.assertEqual(result.action, None)
+        self.assertEqual(result.msg_str, MESSAGE)
+        stats = support.in_loop(self.pipeline.stats)
+        self.assertEqual(stats['slow']['errors'], 1)
+        self.assertEqual(stats['slow']['late'], 1)
+        self.assertEqual(stats['slow']['matches'], 0)
+        self.assertEqual(stats['passing']['calls'], 1)
+        self.assertEqual(stats['passing2']['calls'], 1)
+
+    def test_late_result_after_reroute(self):
+        self.configure([{'name': 'slow', 'heavy': True,
+                         'callable': 'test_filter.slow_tag'},
+                        {'name': 'reroute', 'heavy': True,
+                         'callable': 'test_filter.reroute'}], 0.8)
+        result = self.run_filters()
+        self.assertEqual(result.action, ('reroute', 'Elsewhere'))
+        self.assertEqual(result.msg_str, MESSAGE)
+
+if __name__ == '__main__':
+    unittest.main()
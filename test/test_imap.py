@@ -0,0 +1,77 @@
+"""IMAP4 server tests"""
+
+import os
+import os.path
+import shutil
+import socket
+import tempfile
+import unittest
+
+import support
+
+import bare_io
+import bare_maildir
+import baremail_imap
+
+class imap_tests(unittest.TestCase):
+
+    def setUp(self):
+        support.start_loop()
+        self.dir = tempfile.mkdtemp()
+        self.maildir = os.path.join(self.dir, 'MailboxDir')
+        self.mbx = bare_maildir.BareMaildir(self.maildir)
+        # the mailbox is listed on the disk I/O threads, as in the server
+        self.executor = support.in_loop(bare_io.configure, {})
+        self.server = support.in_loop(baremail_imap.imap_server,
+                                      ('127.0.0.1', 0), self.maildir)
+        self.address = self.server.socket.getsockname()
+
+    def tearDown(self):
+        support.in_loop(self.server.close)
+        self.executor.close()
+        bare_io.executor = None
+        shutil.rmtree(self.dir)
+
+    def session(self, commands):
+        """Send commands in one write and return the response lines up to
+        the completion of the last.
+        """
+        sock = socket.create_connection(self.address, 10)
+        f = sock.makefile('rb')
+        try:
+            self.assertTrue(f.readline().startswith('* OK'))
+            sock.sendall(''.join(commands))
+            last = commands[-1].split()[0] + ' '
+            lines = []
+            while True:
+                line = f.readline()
+                self.assertTrue(line)
+                lines.append(line.rstrip('\r\n'))
+                if line.startswith(last):
+                    return lines
+        finally:
+            f.close()
+            sock.close()
+
+    def test_pipelined_while_listing(self):
+        self.mbx.add_many(['Subject: one\r\n\r\nbody\r\n',
+                           'Subject: two\r\n\r\nbody\r\n'])
+        lines = self.session(['a STATUS INBOX (MESSAGES)\r\n',
+                              'b SELECT INBOX\r\n',
+                              'c FETCH 1:* (FLAGS)\r\n',
+                              'd LOGOUT\r\n'])
+        self.assertEqual(lines[0], '* STATUS INBOX (MESSAGES 2)')
+        self.assertEqual(lines[1], 'a OK STATUS completed')
+        self.assertTrue('* 2 EXISTS' in lines)
+        self.assertTrue('b OK [READ-WRITE] SELECT completed' in lines)
+        fetched = lines.index('b OK [READ-WRITE] SELECT completed') + 1
+        self.assertEqual(lines[fetched:fetched + 3],
+                         ['* 1 FETCH (FLAGS ())', '* 2 FETCH (FLAGS ())',
+                          'c OK FETCH completed'])
+        self.assertEqual(lines[-1], 'd OK LOGOUT completed')
+        # STATUS and SELECT each listed the mailbox off the loop
+        stats = support.in_loop(self.executor.stats)
+        self.assertEqual(stats['completed'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
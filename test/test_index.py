@@ -0,0 +1,75 @@
+"""Header index tests
+
+Run from the repository directory with:
+
+    python -m unittest discover test
+"""
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import support
+
+import bare_index
+import bare_maildir
+import baremail_reshard
+
+MESSAGE = 'Subject: message {}\r\n\r\nbody\r\n'
+
+class index_tests(unittest.TestCase):
+
+    def setUp(self):
+        support.start_loop()
+        self.dir = tempfile.mkdtemp()
+        self.maildir = os.path.join(self.dir, 'Mail')
+        self.index = None
+
+    def tearDown(self):
+        if self.index is not None:
+            support.in_loop(self.index.close)
+        shutil.rmtree(self.dir)
+
+    def open_index(self):
+        if self.index is not None:
+            support.in_loop(self.index.close)
+        self.index = support.in_loop(bare_index.BareIndex, self.maildir, {})
+        self.assertTrue(support.wait_for(self.complete))
+
+    def complete(self):
+        return not support.in_loop(self.index.stats)['pending']
+
+    def query(self):
+        return support.in_loop(self.index.query)[0]
+
+    def test_open_after_reshard(self):
+        mbx = bare_maildir.BareMaildir(self.maildir)
+        keys = mbx.add_many([MESSAGE.format(1), MESSAGE.format(2)])
+        self.open_index()
+        self.assertEqual(len(support.wait_for(self.query)), 2)
+        support.in_loop(self.index.close)
+        self.index = None
+        self.assertEqual(baremail_reshard.reshard(self.maildir, 'hash', 2,
+                                                  86400), 2)
+        self.open_index()
+        for i, key in enumerate(keys):
+            entry = support.in_loop(self.index.get, key)
+            self.assertFalse(os.path.isabs(entry['path']))
+            self.assertTrue(entry['path'].startswith(
+                bare_maildir.SHARD_PREFIX))
+            length, blocks = support.in_loop(self.index.open, key)
+            self.assertEqual(''.join(blocks), MESSAGE.format(i + 1))
+
+    def test_delivery_indexed(self):
+        self.open_index()
+        mbx = bare_maildir.BareMaildir(self.maildir)
+        support.in_loop(mbx.add, MESSAGE.format(1))
+        messages = support.wait_for(self.query)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]['subject'], u'message 1')
+        self.assertEqual(messages[0]['path'], messages[0]['uid'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""POP3 server tests"""
+
+import os
+import os.path
+import poplib
+import shutil
+import tempfile
+import time
+import unittest
+
+import support
+
+import baremail_pop3
+
+class pop3_tests(unittest.TestCase):
+
+    def setUp(self):
+        support.start_loop()
+        self.dir = tempfile.mkdtemp()
+        self.maildir = os.path.join(self.dir, 'MailboxDir')
+        os.mkdir(self.maildir)
+        os.mkdir(os.path.join(self.maildir, 'tmp'))
+        self.server = support.in_loop(baremail_pop3.pop3_server,
+                                      ('127.0.0.1', 0), self.maildir)
+        self.address = self.server.socket.getsockname()
+
+    def tearDown(self):
+        support.in_loop(self.server.close)
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        f = open(os.path.join(self.maildir, name), 'wb')
+        f.write(text)
+        f.close()
+
+    def session(self):
+        """Return the STAT and UIDL answers of one POP3 session."""
+        pop = poplib.POP3(*self.address)
+        try:
+            pop.user('user')
+            pop.pass_('secret')
+            return pop.stat(), pop.uidl()[1]
+        finally:
+            pop.quit()
+
+    def test_listing_reused(self):
+        self.write('1.a', 'Subject: one\r\n\r\nfirst\r\n')
+        self.write('2.b', 'Subject: two\r\n\r\nsecond\r\n')
+        first = self.session()
+        self.assertEqual(first[0][0], 2)
+        self.assertEqual(self.session(), first)
+        self.assertEqual(self.server.cache.stats()['hits'], 1)
+
+    def test_replaced_behind_the_server(self):
+        # the same number of messages in an unchanged generation, but one
+        # replaced by another process
+        self.write('1.a', 'Subject: one\r\n\r\nfirst\r\n')
+        self.write('2.b', 'Subject: two\r\n\r\nsecond\r\n')
+        stat, uidl = self.session()
+        # directory times may be as coarse as a second
+        time.sleep(1.1)
+        os.unlink(os.path.join(self.maildir, '2.b'))
+        self.write('3.c', 'Subject: three\r\n\r\nthe third message\r\n')
+        new_stat, new_uidl = self.session()
+        self.assertEqual(new_stat[0], 2)
+        self.assertNotEqual(new_stat, stat)
+        self.assertNotEqual(new_uidl, uidl)
+
+if __name__ == '__main__':
+    unittest.main()
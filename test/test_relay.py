@@ -0,0 +1,173 @@
+"""Relay tests against the stand-in smarthost of smtp_sink.py
+
+Run from the repository directory with:
+
+    python -m unittest discover test
+"""
+
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import support
+import smtp_sink
+
+import bare_io
+import baremail_relay
+
+MESSAGE = 'Subject: relay test\r\n\r\n.leading dot\r\nbody\r\n'
+
+class _answer():
+    def __init__(self, queued):
+        self.queued = queued
+        self.calls = []
+
+    def callback(self, error):
+        self.calls.append((error, self.queued()))
+
+    def count(self):
+        return len(self.calls)
+
+class relay_tests(unittest.TestCase):
+
+    def setUp(self):
+        support.start_loop()
+        self.dir = tempfile.mkdtemp()
+        self.sink = None
+        self.pool = None
+
+    def tearDown(self):
+        if self.pool is not None:
+            support.in_loop(self.pool.close)
+        if self.sink is not None:
+            self.sink.close()
+        shutil.rmtree(self.dir)
+
+    def start(self, pipelining, refuse=None, defer=None):
+        self.sink = smtp_sink.smtp_sink(pipelining=pipelining, refuse=refuse,
+                                        defer=defer).start()
+        cfgdict = {'smarthost': {'host': self.sink.address[0],
+                                 'port': self.sink.address[1]},
+                   'rules': [r'@remote\.org$'],
+                   'queue_dir': os.path.join(self.dir, 'queue'),
+                   'connections': 2, 'retry_min': 0.2, 'idle_timeout': 5}
+        self.pool = support.in_loop(baremail_relay.configure, cfgdict)
+
+    def enqueue(self, recipients, msg_str=MESSAGE):
+        support.in_loop(self.pool.enqueue, 'me@here', recipients, msg_str)
+
+    def queued(self):
+        names = os.listdir(os.path.join(self.dir, 'queue'))
+        names.remove('tmp')
+        names.remove('failed')
+        return names
+
+    def drained(self):
+        return not self.queued()
+
+    def failed(self):
+        return os.listdir(os.path.join(self.dir, 'queue', 'failed'))
+
+    def test_relay_matching(self):
+        self.start(False)
+        self.enqueue(['a@remote.org', 'x@local', 'b@remote.org'])
+        msgs = self.sink.wait(1)
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual(msgs[0].recipients, ['a@remote.org', 'b@remote.org'])
+        self.assertEqual(msgs[0].data, MESSAGE)
+        self.assertTrue(support.wait_for(self.drained))
+
+    def test_local_only(self):
+        self.start(False)
+        self.enqueue(['x@local'])
+        self.assertEqual(self.queued(), [])
+
+    def check_duplicates(self, pipelining):
+        self.start(pipelining)
+        self.enqueue(['a@remote.org', 'a@remote.org', 'b@remote.org'])
+        msgs = self.sink.wait(1)
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual(self.sink.rcpt_commands,
+                         ['a@remote.org', 'b@remote.org'])
+
+    def test_duplicate_recipients(self):
+        self.check_duplicates(False)
+
+    def test_duplicate_recipients_pipelined(self):
+        self.check_duplicates(True)
+
+    def test_duplicates_left_in_queue(self):
+        # a queue file written before recipients were made unique
+        queue_dir = os.path.join(self.dir, 'queue')
+        os.mkdir(queue_dir)
+        f = open(os.path.join(queue_dir, 'relayold'), 'wb')
+        f.write(json.dumps(dict(sender='me@here',
+                                recipients=['a@remote.org',
+                                            'a@remote.org'])) + '\n')
+        f.write(MESSAGE)
+        f.close()
+        self.start(False)
+        msgs = self.sink.wait(1)
+        self.assertEqual(len(msgs), 1)
+        self.assertTrue(support.wait_for(self.drained))
+        self.assertEqual(len(self.sink.rcpt_commands), 2)
+
+    def test_refused_recipient(self):
+        self.start(True, refuse='^bad@')
+        self.enqueue(['bad@remote.org', 'good@remote.org'])
+        msgs = self.sink.wait(1)
+        self.assertEqual(msgs[0].recipients, ['good@remote.org'])
+        self.assertTrue(support.wait_for(self.drained))
+
+    def test_all_refused(self):
+        self.start(False, refuse='^bad@')
+        self.enqueue(['bad@remote.org'])
+        self.assertTrue(support.wait_for(self.failed))
+        self.assertEqual(self.sink.messages, [])
+
+    def test_deferred_recipient(self):
+        self.start(False, defer='^later@')
+        self.enqueue(['later@remote.org', 'now@remote.org'])
+        msgs = self.sink.wait(1)
+        self.assertEqual(msgs[0].recipients, ['now@remote.org'])
+        # the deferred recipient is queued again on its own
+        self.assertTrue(support.wait_for(self.queued))
+        self.assertEqual(self.sink.rcpt_commands.count('later@remote.org'), 1)
+        self.sink.defer = None
+        self.assertEqual(len(self.sink.wait(2)), 2)
+
+    def test_queued_off_the_loop(self):
+        self.start(False)
+        executor = support.in_loop(bare_io.configure, {})
+        try:
+            answer = _answer(self.queued)
+            support.in_loop(self.pool.enqueue, 'me@here', ['a@remote.org'],
+                            MESSAGE, answer.callback)
+            self.assertTrue(support.wait_for(answer.count))
+            # answered once the queue file was in place
+            error, queued = answer.calls[0]
+            self.assertEqual(error, None)
+            self.assertEqual(len(queued), 1)
+            self.assertEqual(support.in_loop(executor.stats)['completed'], 1)
+        finally:
+            executor.close()
+            bare_io.executor = None
+        self.assertEqual(len(self.sink.wait(1)), 1)
+
+    def test_throughput_per_connection(self):
+        self.start(True)
+        for i in range(50):
+            self.enqueue(['a@remote.org'],
+                         'Subject: {}\r\n\r\nbody\r\n'.format(i))
+        self.assertEqual(len(self.sink.wait(50)), 50)
+        stats = support.in_loop(self.pool.stats)
+        self.assertEqual(stats['relayed'], 50)
+        self.assertTrue(stats['connections'])
+        for conn, rate in stats['connections'].items():
+            self.assertTrue(rate.endswith('msg/s'))
+
+if __name__ == '__main__':
+    unittest.main()
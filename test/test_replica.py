@@ -0,0 +1,143 @@
+"""Replication tests: a leader and a follower on two maildirs
+
+Both run in the loop of this process and talk over TCP as two servers
+would.
+"""
+
+import json
+import os
+import os.path
+import shutil
+import socket
+import tempfile
+import unittest
+
+import support
+
+import bare_maildir
+import baremail_replica
+
+MESSAGE = 'Subject: replicated\r\n\r\nbody\r\n'
+
+class replica_tests(unittest.TestCase):
+
+    def setUp(self):
+        support.start_loop()
+        self.dir = tempfile.mkdtemp()
+        self.leader_dir = os.path.join(self.dir, 'leader', 'MailboxDir')
+        self.follower_dir = os.path.join(self.dir, 'follower', 'MailboxDir')
+        os.makedirs(self.leader_dir)
+        os.makedirs(self.follower_dir)
+        # a file beside the maildir a follower must not reach
+        f = open(os.path.join(self.dir, 'leader', 'secret'), 'wb')
+        f.write('secret\n')
+        f.close()
+        self.leader = support.in_loop(baremail_replica.replica_leader,
+                                      {'host': '127.0.0.1', 'port': 0},
+                                      self.leader_dir)
+        self.port = self.leader.socket.getsockname()[1]
+        self.follower = None
+
+    def tearDown(self):
+        if self.follower is not None:
+            support.in_loop(self.follower.close)
+        support.in_loop(self.leader.close)
+        shutil.rmtree(self.dir)
+
+    def start_follower(self):
+        self.follower = support.in_loop(
+            baremail_replica.replica_follower,
+            {'host': '127.0.0.1', 'port': self.port, 'retry_min': 0.1},
+            self.follower_dir)
+
+    def deliver(self, msg_str):
+        mbx = bare_maildir.delivery_mailbox(self.leader_dir)
+        return support.in_loop(mbx.add, msg_str)
+
+    def remove_all(self):
+        mbx = support.in_loop(bare_maildir.BareMaildir, self.leader_dir)
+        for i in range(len(mbx.entries)):
+            mbx.delete(i)
+        support.in_loop(mbx.close)
+
+    def follower_files(self):
+        return sorted(baremail_replica._names(self.follower_dir))
+
+    def leader_files(self):
+        return sorted(baremail_replica._names(self.leader_dir))
+
+    def in_step(self):
+        return self.follower_files() == self.leader_files()
+
+    def test_follow_and_catch_up(self):
+        # delivered before the follower starts: caught up by a snapshot
+        self.deliver(MESSAGE)
+        self.start_follower()
+        self.assertTrue(support.wait_for(self.in_step))
+        # then streamed
+        self.deliver('Subject: second\r\n\r\nbody\r\n')
+        self.assertTrue(support.wait_for(self.in_step))
+        self.assertEqual(len(self.follower_files()), 2)
+        name = self.follower_files()[0]
+        f = open(os.path.join(self.follower_dir, name), 'rb')
+        self.assertTrue(f.read() in (MESSAGE, 'Subject: second\r\n\r\nbody\r\n'))
+        f.close()
+        self.remove_all()
+        self.assertTrue(support.wait_for(self.in_step))
+        self.assertEqual(self.follower_files(), [])
+
+    def fetch(self, name):
+        """Send FETCH name to the leader and return what it answers
+        before closing or the first record.
+        """
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.settimeout(5)
+        try:
+            sock.sendall('FETCH {}\r\n'.format(name))
+            data = ''
+            while '\r\n' not in data:
+                block = sock.recv(65536)
+                if not block:
+                    break
+                data += block
+            return data
+        finally:
+            sock.close()
+
+    def test_fetch(self):
+        key = self.deliver(MESSAGE)
+        record = json.loads(self.fetch(key).split('\r\n')[0])
+        self.assertEqual(record['name'], key)
+        self.assertEqual(record['size'], len(MESSAGE))
+        record = json.loads(self.fetch('bare-gone').split('\r\n')[0])
+        self.assertEqual(record['size'], None)
+
+    def test_fetch_outside_maildir(self):
+        names = ['../secret', '/etc/passwd', os.path.join(self.dir, 'secret'),
+                 'tmp', 'journal', 'dedup/ab', 'purge/x', '_ab/../../secret',
+                 './x', '_/x', '_ab', '_ab/c/d', 'a//b']
+        for name in names:
+            self.assertEqual(self.fetch(name), '', name)
+        self.assertEqual(support.in_loop(self.leader.stats)['followers'], {})
+
+    def test_follower_skips_bad_names(self):
+        self.start_follower()
+        batch = [({'op': 'add', 'name': '../escaped', 'mtime': 0,
+                   'offset': None}, 'data'),
+                 ({'op': 'remove', 'name': '../../leader/secret',
+                   'offset': None}, None)]
+        support.in_loop(self.follower.write, batch, None)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.dir, 'follower', 'escaped')))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.dir, 'leader', 'secret')))
+
+    def test_message_names(self):
+        for name in ('bare1,S=3', '_ab/bare1,S=3', '_2024-01-01/x'):
+            self.assertTrue(baremail_replica._message_name(name), name)
+        for name in ('', '/x', '..', 'tmp', 'dedup', '_ab', '_ab/', 'a/b',
+                     '_ab/../x', 'a\0b', None):
+            self.assertFalse(baremail_replica._message_name(name), name)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+"""Storage tests: the dedup store and the segment backend"""
+
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import support
+
+import bare_io
+import bare_maildir
+import bare_retention
+import bare_segment
+
+class _adder():
+    """Add one message from its own thread."""
+    def __init__(self, mbx, msg_str, start):
+        self.mbx = mbx
+        self.msg_str = msg_str
+        self.start = start
+        self.msg = None
+        self.error = None
+
+    def run(self):
+        self.start.wait()
+        try:
+            self.msg = self.mbx.write(self.msg_str)
+        except Exception as e:
+            self.error = e
+
+class dedup_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dedup = bare_maildir.DEDUP
+        bare_maildir.DEDUP = True
+
+    def tearDown(self):
+        bare_maildir.DEDUP = self.dedup
+        shutil.rmtree(self.dir)
+
+    def test_concurrent_first_copies(self):
+        # every thread finds no stored copy and writes its own
+        mbx = bare_maildir.BareMaildir(os.path.join(self.dir, 'Mail'))
+        start = threading.Event()
+        adders = []
+        threads = []
+        for i in range(16):
+            adder = _adder(mbx, 'Subject: same\r\n\r\nbody\r\n', start)
+            adders.append(adder)
+            threads.append(threading.Thread(target=adder.run))
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        inodes = set()
+        for adder in adders:
+            self.assertEqual(adder.error, None)
+            inodes.add(os.stat(adder.msg.path).st_ino)
+        self.assertEqual(len(inodes), 1)
+        store = bare_maildir._dedup_store(mbx._path, adder.msg.digest, None)
+        self.assertEqual(os.stat(store).st_nlink, 17)
+        self.assertEqual(os.listdir(os.path.join(mbx._path, 'tmp')), [])
+
+    def test_store_kept(self):
+        mbx = bare_maildir.BareMaildir(os.path.join(self.dir, 'Mail'))
+        first = mbx.write('Subject: same\r\n\r\nbody\r\n')
+        # a copy stored meanwhile by another process is not replaced
+        tmp_name = mbx._write_tmp('Subject: same\r\n\r\nbody\r\n', None)
+        store = bare_maildir._dedup_store(mbx._path, first.digest, None)
+        mbx._store_copy(tmp_name, store)
+        self.assertEqual(os.stat(store).st_ino, os.stat(first.path).st_ino)
+        self.assertFalse(os.path.exists(tmp_name))
+
+    def test_repeat_keeps_delivery_time(self):
+        path = os.path.join(self.dir, 'Mail')
+        mbx = bare_maildir.BareMaildir(path)
+        old = time.time() - 30 * 86400
+        mbx.add_many(['Subject: same\r\n\r\nbody\r\n'], [old])
+        fresh = mbx.write('Subject: same\r\n\r\nbody\r\n')
+        mbx.added(fresh)
+        # a rescan sees the time of each copy, not of the shared file
+        times = {}
+        for msg in bare_maildir.BareMaildir(path).items():
+            times[msg.basename] = msg.mtime
+        self.assertEqual(len(times), 2)
+        self.assertTrue(abs(times[fresh.basename] - fresh.mtime) < 0.01)
+        del times[fresh.basename]
+        self.assertTrue(abs(times.values()[0] - old) < 0.01)
+        support.start_loop()
+        self.sweeper = support.in_loop(bare_retention.BareSweeper, path,
+                                       {'max_age': 86400})
+        try:
+            support.in_loop(self.sweeper.sweep)
+            self.assertTrue(support.wait_for(self.swept))
+        finally:
+            support.in_loop(self.sweeper.close)
+        self.assertEqual(support.in_loop(self.sweeper.stats)['expired'], 1)
+        self.assertTrue(os.path.exists(fresh.path))
+
+    def swept(self):
+        return support.in_loop(self.sweeper.stats)['sweeps']
+
+class _answer():
+    def __init__(self):
+        self.calls = []
+
+    def callback(self, key, error):
+        self.calls.append((key, error))
+
+    def count(self):
+        return len(self.calls)
+
+class segment_tests(unittest.TestCase):
+
+    def setUp(self):
+        support.start_loop()
+        self.dir = tempfile.mkdtemp()
+        self.segment_size = bare_segment.SEGMENT_SIZE
+
+    def tearDown(self):
+        bare_segment.SEGMENT_SIZE = self.segment_size
+        shutil.rmtree(self.dir)
+
+    def reopen(self, path):
+        # as after a restart: the old store is left as it was
+        del bare_segment._stores[os.path.abspath(path)]
+        return support.in_loop(bare_segment.BareSegmentStore, path)
+
+    def contents(self, mbx):
+        texts = {}
+        for msg in mbx.items():
+            texts[msg.basename] = ''.join(mbx.open_entry(msg))
+        return texts
+
+    def test_answered_after_sync(self):
+        path = os.path.join(self.dir, 'Segments')
+        mbx = support.in_loop(bare_segment.BareSegmentStore, path, False)
+        answer = _answer()
+        support.in_loop(mbx.add_synced, 'Subject: one\r\n\r\nbody\r\n',
+                        answer.callback)
+        self.assertEqual(answer.calls, [])
+        self.assertTrue(mbx._store.pending)
+        # answered by the sync timer of the loop
+        self.assertTrue(support.wait_for(answer.count))
+        key, error = answer.calls[0]
+        self.assertEqual(error, None)
+        self.assertEqual(mbx._store.pending, 0)
+        self.assertTrue(mbx._store.records.has_key(key))
+
+    def test_tools_answered_at_once(self):
+        # without disk I/O threads, as in the tools, there is no waiting
+        path = os.path.join(self.dir, 'Segments')
+        mbx = support.in_loop(bare_segment.BareSegmentStore, path, False)
+        answer = _answer()
+        support.in_loop(bare_io.add, mbx, 'Subject: one\r\n\r\nbody\r\n',
+                        answer.callback)
+        self.assertEqual(len(answer.calls), 1)
+        self.assertEqual(mbx._store.pending, 0)
+
+    def test_compact_survives_restart(self):
+        path = os.path.join(self.dir, 'Segments')
+        bare_segment.SEGMENT_SIZE = 2 * len('Subject: 0\r\n\r\nbody\r\n')
+        mbx = support.in_loop(bare_segment.BareSegmentStore, path)
+        msg_list = []
+        for i in range(5):
+            msg_list.append('Subject: {}\r\n\r\nbody\r\n'.format(i))
+        support.in_loop(mbx.add_many, msg_list)
+        expected = self.contents(mbx)
+        del expected[mbx.items()[0].basename]
+        support.in_loop(mbx.discard, mbx.items()[0])
+        support.in_loop(mbx._store.sync)
+        self.assertEqual(mbx._store.pending, 0)
+        support.in_loop(mbx._store.compact)
+        self.assertFalse(mbx._store.seg_size.has_key(1))
+        self.assertEqual(self.contents(self.reopen(path)), expected)
+
+    def test_torn_index_tail(self):
+        path = os.path.join(self.dir, 'Segments')
+        mbx = support.in_loop(bare_segment.BareSegmentStore, path)
+        support.in_loop(mbx.add_many, ['Subject: one\r\n\r\nbody\r\n'])
+        # a crash in the middle of writing an index record
+        f = open(os.path.join(path, 'index'), 'ab')
+        f.write('A 1.2 1 0')
+        f.close()
+        mbx = self.reopen(path)
+        support.in_loop(mbx.add_many, ['Subject: two\r\n\r\nbody\r\n'])
+        mbx = self.reopen(path)
+        self.assertEqual(sorted(self.contents(mbx).values()),
+                         ['Subject: one\r\n\r\nbody\r\n',
+                          'Subject: two\r\n\r\nbody\r\n'])
+
+if __name__ == '__main__':
+    unittest.main()